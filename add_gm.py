@@ -1,23 +1,33 @@
-import pickle
+import time
 
-from dnd_bot import Campaign, Player, Transaction
+from dnd_bot import ProcessLocks, fcntl, storage_backend
 
 def main():
     name = input('Enter campaign to add new GM to: ')
     gm = int(input('Enter player ID to add as GM: '))
 
-    with open(f'data/{name}', 'rb') as file:
-        campaign = pickle.load(file)
+    #The same storage as the bot, from DND_STORAGE, DND_DATA and DND_DATABASE.
+    backend = storage_backend()
+    id = int(name)
+
+    #A running bot may be editing the campaign, so wait for its lock. Bots
+    #sharing storage notice the saved change and reload the campaign.
+    locks = None
+    if fcntl is not None:
+        locks = ProcessLocks(backend.lock_directory())
+        while not locks.try_acquire(id):
+            time.sleep(0.1)
 
     try:
+        #Reads legacy pickles too, mapping the classes they place in the
+        #bot's __main__ to dnd_bot.
+        campaign, _size = backend.read(id)
         if gm not in campaign.gms:
-            campaign.gms.append(gm)
-    except AttributeError:
-        campaign.gms = [campaign.gm, gm]
-        del campaign.gm
-
-    with open(f'data/{name}', 'wb') as file:
-        pickle.dump(campaign, file)
+            campaign.record(('add_gm', gm))
+            backend.save(campaign, campaign.journal)
+    finally:
+        if locks is not None:
+            locks.release(id)
 
     print('GM added successfully.')
 
@@ -0,0 +1,457 @@
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import pickle
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import dnd_bot
+from dnd_bot import Campaign, DatabaseManager, Transaction
+
+GM_ID = 1
+PLAYER_BASE = 1000
+
+################################################################################
+#Fake Discord objects start
+
+class FakeChannel:
+    def __init__(self, id):
+        self.id = id
+        self.name = 'channel-{0}'.format(id)
+        self.sent = []
+
+
+    async def send(self, content = None, file = None, **kwargs):
+        self.sent.append(content if file is None else file)
+
+
+
+class FakeAuthor:
+    def __init__(self, id):
+        self.id = id
+        self.name = 'user-{0}'.format(id)
+
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel, attachments = ()):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.attachments = list(attachments)
+
+
+
+class FakeContext:
+    def __init__(self, content, author = GM_ID, channel = 1):
+        self.author = FakeAuthor(author)
+        self.channel = FakeChannel(channel)
+        self.message = FakeMessage(content, self.author, self.channel)
+        self.sent = []
+
+
+    async def send(self, content = None, file = None, **kwargs):
+        self.sent.append(content if file is None else file)
+
+#Fake Discord objects end
+################################################################################
+#Synthetic data start
+
+def build_campaign(id, players, pending, archive, seed = 0, gm = GM_ID,
+                   player_base = PLAYER_BASE):
+    rng = random.Random(seed)
+    campaign = Campaign(id, gm)
+    for index in range(players):
+        campaign.add_player(player_base + index, 'player{0}'.format(index))
+    ids = list(campaign.players)
+
+    def transaction():
+        initiator = campaign.players[rng.choice(ids)]
+        participant = None
+        if rng.random() < 0.5 and len(ids) > 1:
+            participant = campaign.players[rng.choice(ids)]
+            while participant is initiator:
+                participant = campaign.players[rng.choice(ids)]
+        coins = [rng.randrange(20) for _ in range(4)]
+        reason = rng.choice((None, 'loot', 'rent, food and drink', 'repairs'))
+        return Transaction(initiator, rng.choice(('give', 'take')), coins,
+                           participant, reason)
+
+    for _ in range(archive):
+        campaign.add_transaction(transaction())
+    campaign.approve(list(campaign.pending.items))
+    for _ in range(pending):
+        campaign.add_transaction(transaction())
+    campaign.journal = []
+    return campaign
+
+
+def make_backend(kind, path):
+    if kind == 'sqlite':
+        return dnd_bot.SQLiteBackend(os.path.join(path, 'campaigns.db'))
+    os.makedirs(os.path.join(path, 'data'), exist_ok = True)
+    return dnd_bot.FileBackend(os.path.join(path, 'data'))
+
+#Synthetic data end
+################################################################################
+#Measurement start
+
+class Result:
+    def __init__(self, name, samples, peak, size = None):
+        self.name = name
+        self.samples = samples
+        self.peak = peak
+        self.size = size
+
+
+    def percentile(self, fraction):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction*len(ordered)))]
+
+
+    def summary(self):
+        total = sum(self.samples)
+        return {
+            'iterations': len(self.samples),
+            'ops_per_sec': len(self.samples)/total if total else float('inf'),
+            'mean_ms': 1000*statistics.mean(self.samples),
+            'p50_ms': 1000*self.percentile(0.50),
+            'p95_ms': 1000*self.percentile(0.95),
+            'p99_ms': 1000*self.percentile(0.99),
+            'peak_kib': self.peak/1024,
+            'size_kib': None if self.size is None else self.size/1024,
+        }
+
+
+async def call(function, state):
+    result = function(state)
+    if asyncio.iscoroutine(result):
+        await result
+
+
+async def measure(name, function, iterations, setup = None, size = None):
+    #Tracing allocations slows everything down, so peak memory comes from a
+    #separate run after the timed ones.
+    samples = []
+    for _ in range(iterations):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        await call(function, state)
+        samples.append(time.perf_counter() - start)
+
+    state = setup() if setup is not None else None
+    tracemalloc.start()
+    await call(function, state)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Result(name, samples, peak, size)
+
+#Measurement end
+################################################################################
+#Benchmarks start
+
+async def bench_storage(args, path):
+    results = []
+    backend = make_backend(args.backend, path)
+    campaign = build_campaign(1, args.players, args.pending, args.archive)
+    dbm = DatabaseManager(backend, shared = args.shared)
+    await dbm.acquire(campaign.id)
+    await dbm.save_campaign(campaign)
+
+    def cold_manager(_state):
+        return DatabaseManager(make_backend(args.backend, path),
+                               shared = args.shared)
+
+    async def load(manager):
+        await manager.load_campaign(campaign.id)
+        manager.executor.shutdown(wait = False)
+
+    results.append(await measure('load_campaign (cold)', load,
+                                 args.iterations, lambda: cold_manager(None)))
+
+    async def save(_state):
+        await dbm.load_campaign(campaign.id, blocking = True)
+        player = next(iter(campaign.players.values()))
+        campaign.add_transaction(Transaction(player, 'take', (1, 0, 0, 0),
+                                             None, 'benchmark'))
+        await dbm.save_campaign(campaign)
+
+    results.append(await measure('save_campaign (one entry)', save,
+                                 args.iterations))
+    await dbm.close()
+    return results
+
+
+async def bench_format(args):
+    results = []
+    campaign = build_campaign(1, args.players, args.pending, args.archive)
+    #Only the unsealed tail is stored with the campaign; the rest of the
+    #archive is written out a page at a time.
+    page = campaign.archive.tail[:dnd_bot.ARCHIVE_PAGE]
+    while campaign.archive.full_pages():
+        campaign.archive.seal((0, 0))
+
+    formats = (
+        ('pickle', pickle.dumps, pickle.loads, pickle.dumps, pickle.loads),
+        ('binary', dnd_bot.encode_campaign, dnd_bot.decode_campaign,
+         dnd_bot.encode_page, dnd_bot.decode_page),
+    )
+    for name, encode, decode, encode_page, decode_page in formats:
+        data = encode(campaign)
+        results.append(await measure('{0} campaign (encode)'.format(name),
+                                     lambda _state, encode = encode:
+                                     encode(campaign), args.iterations,
+                                     size = len(data)))
+        results.append(await measure('{0} campaign (decode)'.format(name),
+                                     lambda _state, decode = decode,
+                                     data = data: decode(data),
+                                     args.iterations))
+        data = encode_page(page)
+        results.append(await measure('{0} page (encode)'.format(name),
+                                     lambda _state, encode = encode_page:
+                                     encode(page), args.iterations,
+                                     size = len(data)))
+        results.append(await measure('{0} page (decode)'.format(name),
+                                     lambda _state, decode = decode_page,
+                                     data = data: decode(data),
+                                     args.iterations))
+    return results
+
+
+async def bench_ledger(args):
+    results = []
+    campaign = build_campaign(1, args.players, args.pending, args.archive)
+
+    def fresh():
+        return copy.deepcopy(campaign)
+
+    def approve_all(state):
+        state.approve(list(state.pending.items))
+
+    results.append(await measure('Campaign.approve (all pending)',
+                                 approve_all, args.iterations, fresh))
+
+    results.append(await measure('Campaign.to_csv', lambda _state:
+                                 campaign.to_csv(), args.iterations))
+
+    #Just short of a checkpoint, so the most rows are replayed.
+    middle = max(0, len(campaign.archive) // 2 - 1)
+    results.append(await measure('Archive.balances_at (middle)',
+                                 lambda _state:
+                                 campaign.archive.balances_at(middle),
+                                 args.iterations))
+
+    results.append(await measure('Campaign.audit_balances', lambda _state:
+                                 campaign.audit_balances(), args.iterations))
+
+    async def parse_all(_state):
+        ctx = FakeContext('dnd-approve all')
+        await dnd_bot.parse_indices(ctx, campaign, 'all')
+
+    results.append(await measure('parse_indices (all)', parse_all,
+                                 args.iterations))
+
+    terms = '1-{0}, 2, 3'.format(max(2, args.pending//2))
+
+    async def parse_ranges(_state):
+        ctx = FakeContext('dnd-approve ' + terms)
+        await dnd_bot.parse_indices(ctx, campaign, terms)
+
+    results.append(await measure('parse_indices (ranges)', parse_ranges,
+                                 args.iterations))
+    return results
+
+
+async def bench_parsing(args):
+    results = []
+    messages = (
+        ('transact', dnd_bot.parse_transact,
+         'as player0 give 12 gp, 4.5 egp at -10% to player1 for a fairly '
+         'ordinary purchase'),
+        ('convert', dnd_bot.parse_convert, 'as player0 20 sp to gp, 3 pp to cp'),
+        ('register', dnd_bot.parse_registration, '123456789 as player0'),
+        ('balance', dnd_bot.parse_balance, 'of player0'),
+        ('selection', dnd_bot.parse_selection, '1-20, 25, 30-40'),
+    )
+    for name, parse, text in messages:
+        content = 'dnd-{0} {1}'.format(name, text)
+        results.append(await measure('parse {0}'.format(name), lambda _state,
+                                     parse = parse, content = content:
+                                     parse(dnd_bot.command_arguments(content)),
+                                     args.iterations))
+    return results
+
+
+async def bench_commands(args, path):
+    results = []
+    backend = make_backend(args.backend, path)
+    #Shared storage can't defer writes, so commands write through instead.
+    dnd_bot.dbm = DatabaseManager(backend, durability = 'write' if args.shared
+                                  else 'deferred', flush_delay = 3600,
+                                  flush_threshold = float('inf'),
+                                  shared = args.shared)
+    campaign = build_campaign(2, args.players, args.pending, args.archive)
+    await dnd_bot.dbm.add_campaign(campaign)
+    content = ('dnd-transact as player0 give 12 gp, 4.5 egp at -10% '
+               'to player1 for a fairly ordinary purchase')
+    transact = dnd_bot.bot.get_command('transact').callback
+
+    async def run_transact(_state):
+        await transact(FakeContext(content, channel = 2))
+
+    results.append(await measure('transact command', run_transact,
+                                 args.iterations))
+
+    async def run_concurrent(_state):
+        await asyncio.gather(*(transact(FakeContext(content, channel = 2))
+                               for _ in range(20)))
+
+    results.append(await measure('transact command (20 at once)',
+                                 run_concurrent, args.iterations))
+
+    lines = ['as player{0} give 1 gp to player{1} for shopping'.format(
+        index % args.players, (index + 1) % args.players) for index in range(50)]
+    bulk = dnd_bot.bot.get_command('bulk').callback
+
+    async def run_bulk(_state):
+        await bulk(FakeContext('dnd-bulk\n' + '\n'.join(lines), channel = 2))
+
+    results.append(await measure('bulk command (50 lines)', run_bulk,
+                                 args.iterations))
+
+    for name, content in (('pending', 'dnd-pending'),
+                          ('balance', 'dnd-balance of all')):
+        command = dnd_bot.bot.get_command(name).callback
+
+        async def run_listing(_state, command = command, content = content):
+            await command(FakeContext(content, channel = 2))
+
+        results.append(await measure('{0} command'.format(content[4:]),
+                                     run_listing, args.iterations))
+
+    balance = dnd_bot.bot.get_command('balance').callback
+    content = 'dnd-balance of all at #{0}'.format(args.archive // 2)
+
+    async def run_balance_at(_state):
+        await balance(FakeContext(content, channel = 2))
+
+    results.append(await measure('balance of all at command', run_balance_at,
+                                 args.iterations))
+
+    history = dnd_bot.bot.get_command('history').callback
+
+    async def run_history(_state):
+        await history(FakeContext('dnd-history page 1', channel = 2))
+
+    results.append(await measure('history page command', run_history,
+                                 args.iterations))
+
+    roll = dnd_bot.bot.get_command('roll').callback
+    for expression in ('4d6+3', '4d6kh3 + 2d8 - 1', '100d20',
+                       '100000d20'):
+        async def run_roll(_state, expression = expression):
+            await roll(FakeContext('dnd-roll ' + expression, channel = 2))
+
+        results.append(await measure('roll {0}'.format(expression), run_roll,
+                                     args.iterations))
+
+    odds = dnd_bot.bot.get_command('odds').callback
+    for expression in ('3d6+4 >= 15', '4d6kh3 + 2d8 - 1', '100d20'):
+        async def run_odds(_state, expression = expression):
+            await odds(FakeContext('dnd-odds ' + expression, channel = 2))
+
+        results.append(await measure('odds {0} (uncached)'.format(expression),
+                                     run_odds, args.iterations,
+                                     dnd_bot.odds_cache.clear))
+    dnd_bot.dbm.dirty.clear()
+    await dnd_bot.dbm.close()
+    return results
+
+#Benchmarks end
+################################################################################
+
+def report(results, baseline = None):
+    print('{0:<32} {1:>11} {2:>9} {3:>9} {4:>9} {5:>10} {6:>10}'.format(
+        'benchmark', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'peak KiB',
+        'size KiB'))
+    for name, summary in results.items():
+        line = '{0:<32} {1:>11.1f} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>10.1f}'
+        line = line.format(name, summary['ops_per_sec'], summary['p50_ms'],
+                           summary['p95_ms'], summary['p99_ms'],
+                           summary['peak_kib'])
+        size = summary.get('size_kib')
+        line += ' {0:>10}'.format('' if size is None else
+                                  '{0:.1f}'.format(size))
+        if baseline is not None and name in baseline:
+            before = baseline[name]['p50_ms']
+            if before:
+                line += '  ({0:+.1f}% p50)'.format(
+                    100*(summary['p50_ms'] - before)/before)
+        print(line)
+
+
+async def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as path:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            if 'storage' in args.only:
+                results += await bench_storage(args, path)
+            if 'format' in args.only:
+                results += await bench_format(args)
+            if 'ledger' in args.only:
+                results += await bench_ledger(args)
+            if 'parsing' in args.only:
+                results += await bench_parsing(args)
+            if 'commands' in args.only:
+                results += await bench_commands(args, path)
+        finally:
+            os.chdir(cwd)
+    return {result.name: result.summary() for result in results}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the bot\'s hot paths without Discord.')
+    parser.add_argument('--players', type = int, default = 50)
+    parser.add_argument('--pending', type = int, default = 1000)
+    parser.add_argument('--archive', type = int, default = 10000)
+    parser.add_argument('--iterations', type = int, default = 50)
+    parser.add_argument('--backend', choices = ('file', 'sqlite'),
+                        default = 'file')
+    parser.add_argument('--shared', action = 'store_true',
+                        help = 'lock and revalidate as shard processes do')
+    parser.add_argument('--only', nargs = '+',
+                        choices = ('storage', 'format', 'ledger', 'parsing',
+                                   'commands'),
+                        default = ('storage', 'format', 'ledger', 'parsing',
+                                   'commands'))
+    parser.add_argument('--json', help = 'write results to this file')
+    parser.add_argument('--compare', help = 'results file to compare against')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    random.seed(0)
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+    report(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'args': vars(args), 'results': results}, file,
+                      indent = 2, default = list)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,158 @@
+import array
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import decimal
+import functools
+import gzip
 import io
+import itertools
+import json
 import logging
 import math
 import os
 import pickle
 import random
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import weakref
+import zlib
 
 import discord
 from discord.ext import commands
 
+try:
+    import numpy
+except ImportError: #NumPy only speeds up large dice rolls.
+    numpy = None
+
+try:
+    import fcntl
+except ImportError: #Only needed to share storage between processes.
+    fcntl = None
+
 FORMAT = '%(levelname)s:%(name)s:(%(asctime)s): %(message)s'
 DATEFMT = '%d-%b-%y %H:%M:%S'
 logging.basicConfig(format = FORMAT, datefmt = DATEFMT, level = logging.INFO)
 
-bot = commands.Bot('dnd-')
+class AccountantBot(commands.Bot):
+    async def invoke(self, ctx):
+        start = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            if ctx.command is not None:
+                metrics.observe('dnd_command_seconds',
+                                time.perf_counter() - start,
+                                command = ctx.command.name)
+
+
+    async def close(self):
+        #Deferred writes must reach storage before the process exits.
+        await scheduler.close()
+        await dbm.close()
+        await super().close()
+
+
+def shard_options():
+    #discord.py only takes the shard when the bot is created, so it is read
+    #from the environment before anything else.
+    shard_count = int(os.environ.get('DND_SHARD_COUNT', 1))
+    if shard_count <= 1:
+        return {}
+    return {'shard_id': int(os.environ['DND_SHARD_ID']),
+            'shard_count': shard_count}
+
+
+bot = AccountantBot('dnd-', **shard_options())
 
 RESERVED_NAMES = {'World', 'all'}
 CONVERSIONS = {'cp': 1, 'sp': 10, 'gp': 100, 'pp': 1000}
+COINS = ('cp', 'sp', 'gp', 'pp')
+DATA_DIR = 'data' #Directory used by the file storage backend.
+DATABASE = 'campaigns.db' #Database used by the SQLite storage backend.
+JOURNAL_LIMIT = 500 #Journal entries to accumulate before compacting.
+CACHE_ENTRIES = 100 #Campaigns to keep in memory.
+CACHE_BYTES = None #Serialized campaign bytes to keep in memory, if limited.
+IO_WORKERS = 4 #Threads available for campaign file I/O.
+CSV_HEADER = ('Initiator', 'Giver', 'Taker', 'CP', 'SP', 'GP', 'PP', 'Reason',
+              'Approved')
+CSV_CHUNK = 64*1024 #Characters of CSV to buffer before writing them out.
+CSV_SPOOL = 1024*1024 #Bytes of exported history to hold before using disk.
+ARCHIVE_PAGE = 1000 #Archived transactions stored together as one page.
+COMPRESSION = 1 #zlib level for campaign files and archive pages, 0 for none.
+ARCHIVE_CACHE = 4 #Archive pages to keep in memory per campaign.
+CHECKPOINT_ROWS = 250 #Archived transactions between balance checkpoints.
+HISTORY_ROWS = 20 #Archived transactions shown per page of dnd-history.
+MESSAGE_LIMIT = 2000 #Characters Discord allows in one message.
+LISTING_MESSAGES = 3 #Messages a listing may take before it is sent as a file.
+REGISTRY_MISSING = 10000 #Channels without campaigns to remember.
+DURABILITY = 'write' #One of 'sync', 'write' or 'deferred'; see DatabaseManager.
+FLUSH_DELAY = 2.0 #Seconds to coalesce deferred writes for.
+FLUSH_THRESHOLD = 50 #Dirty campaigns that trigger an early deferred flush.
+LOCK_TIMEOUT = 10.0 #Seconds to wait for a campaign lock before giving up.
+COMMIT_RETRIES = 3 #Times a command is rerun after its campaign changed.
+LOCK_POLL = 0.05 #Longest pause between tries at another process's lock.
+USER_RATE = 1.0 #Commands per second a user may keep sending.
+USER_BURST = 5 #Commands a user may send at once after a quiet spell.
+CHANNEL_RATE = 4.0 #Commands per second a channel may keep sending.
+CHANNEL_BURST = 20 #Commands a channel may send at once after a quiet spell.
+RATE_BUCKETS = 10000 #Users or channels to track before forgetting idle ones.
+COMMAND_WORKERS = 32 #Commands run at the same time.
+QUEUE_LIMIT = 256 #Commands waiting to run before new ones are turned away.
+QUEUE_SHARES = (1.0, 0.75, 0.5) #Share of QUEUE_LIMIT each priority may fill.
+QUEUE_TIMEOUT = 5.0 #Seconds a command may wait to start before it is dropped.
+BREAKDOWN_DICE = 100 #Dice rolled individually so each result can be shown.
+MAX_DICE = 10**6 #Dice that may be rolled at once.
+MAX_SIDES = 10**6 #Sides a die may have.
+DICE_CHUNK = 65536 #Dice sampled per batch when summing large rolls.
+EXACT_BUDGET = 5*10**5 #Work allowed to build an exact sum distribution.
+DISTRIBUTION_CACHE = 64 #Exact sum distributions to keep.
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0) #Upper bounds of latency histogram buckets.
+METRICS_HOST = '127.0.0.1' #Interface the metrics endpoint listens on.
+METRICS_TIMEOUT = 5.0 #Seconds a metrics client may take to send its request.
+DICE_CACHE = 256 #Compiled dice expressions to keep.
+DICE_LENGTH = 200 #Characters allowed in a dice expression.
+DICE_DEPTH = 20 #Parentheses that may be nested in a dice expression.
+EXPLODE_LIMIT = 100 #Rounds of rerolls an exploding pool may take.
+ODDS_BUDGET = 2*10**6 #Work allowed to compute an exact roll distribution.
+ODDS_SPAN = 10**5 #Distinct totals a roll distribution may cover.
+ODDS_CACHE = 10**6 #Probabilities to keep across cached roll distributions.
+DICE_WORKERS = 2 #Threads available for large rolls and odds.
+ODDS_EPSILON = 1e-12 #Probability below which exploding dice stop rerolling.
+ODDS_ROWS = 25 #Totals small enough to list every probability.
+FFT_LENGTH = 256 #Shortest input convolved with an FFT when NumPy is present.
+TRANSACT_KEYWORDS = frozenset(('as', 'give', 'take', 'at', 'to', 'from', 'for'))
+AMOUNT = re.compile(r'([+-]?(?:\d+(?:\.\d*)?|\.\d+))\s*(cp|sp|gp|pp|egp)',
+                    re.I)
+OFFSET = re.compile(r'([+-]\d+)\s*%')
+CONVERSION = re.compile(r'(\d+)\s*(cp|sp|gp|pp)\s+to\s+(cp|sp|gp|pp)', re.I)
+AS_PREFIX = re.compile(r'as\s+(\S+)(?:\s+(.*))?', re.S)
+REGISTRATION = re.compile(r'(?:(\d+)\s+)?as\s+(\S+)')
+BALANCE_TARGET = re.compile(r'(?:of\s+(\S+))?(?:(?:^|\s+)at\s+(\S+))?')
+BALANCE_ROW = re.compile(r'#(\d+)')
+BALANCE_TIMES = (('%Y-%m-%d', datetime.timedelta(days = 1)),
+                 ('%Y-%m-%dT%H:%M', datetime.timedelta(minutes = 1)))
+SELECTION = re.compile(r'(\d+)(?:\s*-\s*(\d+))?')
+SPLIT = re.compile(r'split\s+(.+?)\s+among\s+(.+?)(?:\s+from\s+(\S+))?'
+                   r'(?:\s+for\s+(.*))?', re.S)
+BULK_LIMIT = 500 #Transactions a single dnd-bulk may add.
+BULK_BYTES = 1024*1024 #Size of the largest file dnd-bulk will read.
+BULK_ERRORS = 10 #Invalid lines to list when rejecting a dnd-bulk.
+ODDS_TARGET = re.compile(r'^(?P<expression>.*?)\s*(?P<comparison>>=|<=|>|<|=)'
+                         r'\s*(?P<target>-?\d+)$')
+DICE_TOKEN = re.compile(r'\s*(?:(?P<number>\d+)|(?P<keep>kh|kl|dh|dl|k)|'
+                        r'(?P<advantage>adv|dis)|(?P<dice>d%?)|'
+                        r'(?P<symbol>[-+*/()!]))')
 
 ################################################################################
 #Internal classes and functions start
@@ -26,73 +162,452 @@ class Campaign:
         self.VERSION = '1.1'
         self.names = {}
         self.players = {}
-        self.pending = []
-        self.archive = []
+        self.pending = PendingQueue()
+        self.archive = Archive()
         self.id = id
         self.gms = [gm]
+        self.revision = 0
+        self.next_transaction = 0
+        self.journal = []
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['journal']
+        return state
+
+
+    def __setstate__(self, state):
+        if 'gm' in state: #Campaigns from before multiple GMs were supported.
+            state['gms'] = [state.pop('gm')]
+        state.setdefault('revision', 0)
+        if isinstance(state['pending'], list): #Before stable transaction IDs.
+            pending = PendingQueue()
+            for id, transaction in enumerate(state['pending']):
+                transaction.id = id
+                pending.append(transaction)
+            state['pending'] = pending
+            state['next_transaction'] = len(pending)
+        if isinstance(state['archive'], list): #Before the paged archive.
+            archive = Archive()
+            archive.tail = [transaction.row for transaction in state['archive']]
+            state['archive'] = archive
+        self.__dict__.update(state)
+        self.journal = []
+
+
+    def view(self):
+        #A shallow copy whose archive is unaffected by later approvals and
+        #sealing, for reading the history on another thread.
+        view = Campaign.__new__(Campaign)
+        view.__dict__.update(self.__dict__)
+        view.archive = self.archive.copy()
+        return view
+
+
+    def record(self, entry):
+        self.apply(entry)
+        self.journal.append((self.revision, entry))
+
+
+    def apply(self, entry):
+        op, *args = entry
+        if op == 'register':
+            id, name = args
+            self.players[id] = Player(id, name)
+            self.names[name] = id
+        elif op == 'rename':
+            id, name = args
+            del self.names[self.players[id].name]
+            self.players[id].name = name
+            self.names[name] = id
+        elif op == 'transact':
+            initiator, mode, amounts, participant, reason, *id = args
+            if participant is not None:
+                participant = self.players[participant]
+            transaction = Transaction(self.players[initiator], mode, amounts,
+                                      participant, reason)
+            transaction.id = id[0] if id else self.next_transaction
+            self.next_transaction = max(self.next_transaction,
+                                        transaction.id + 1)
+            self.pending.append(transaction)
+        elif op in ('approve', 'approve_ids'):
+            ids = args[0]
+            if op == 'approve': #Entries from before stable transaction IDs.
+                ids = self.pending.ids_at(ids)
+            timestamp = args[1] if len(args) > 1 else None
+            for id in ids:
+                transaction = self.pending.pop(id)
+                transaction.complete()
+                transaction.time = timestamp
+                self.archive.append(transaction.row)
+        elif op in ('deny', 'deny_ids'):
+            ids = args[0]
+            if op == 'deny':
+                ids = self.pending.ids_at(ids)
+            for id in ids:
+                self.pending.pop(id)
+        elif op == 'convert':
+            initiator, amounts = args
+            coins = to_coins(amounts)
+            self.players[initiator].adjust(coins, convert_to_copper(coins), 1)
+        elif op == 'add_gm':
+            if args[0] not in self.gms:
+                self.gms.append(args[0])
+        else:
+            raise ValueError('Invalid journal entry "{0}"'.format(op))
+        self.revision += 1
+
+
+    def add_player(self, id, name):
+        self.record(('register', id, name))
+
+
+    def rename_player(self, id, name):
+        self.record(('rename', id, name))
+
 
-    
     def add_transaction(self, transaction):
-        self.pending.append(transaction)
-
-
-    def approve(self, indices):
-        for index in indices:
-            self.pending[index].complete()
-            self.archive.append(self.pending[index])
-        self.pending = [item for index, item in enumerate(self.pending)
-                        if index not in indices]
-
-
-    def deny(self, indices):
-        self.pending = [item for index, item in enumerate(self.pending)
-                        if index not in indices]
-
-    
-    def to_csv(self):
-        vals = ['Initiator,Giver,Taker,CP,SP,GP,PP,Reason']
-        for transaction in self.archive:
-            initiator = transaction.initiator.name
-            if transaction.mode == 'give':
-                giver = transaction.initiator.name
-                taker = transaction.participant.name
-            elif transaction.mode == 'take':
-                giver = transaction.participant.name
-                taker = transaction.initiator.name
+        if transaction.participant.id is None:
+            participant = None
+        else:
+            participant = transaction.participant.id
+        self.record(('transact', transaction.initiator.id, transaction.mode,
+                     transaction.coins, participant, transaction.reason,
+                     self.next_transaction))
+
+
+    def approve(self, ids):
+        ids = tuple(id for id in ids if id in self.pending)
+        self.record(('approve_ids', ids, time.time()))
+
+
+    def deny(self, ids):
+        ids = tuple(id for id in ids if id in self.pending)
+        self.record(('deny_ids', ids))
+
+
+    def convert(self, initiator, amounts):
+        self.record(('convert', initiator.id, to_coins(amounts)))
+
+
+    def audit_balances(self):
+        #Conversions never reach the archive, but they don't change a
+        #player's copper value either.
+        balances = dict.fromkeys(self.players, 0)
+        for row in self.archive.rows():
+            settle(balances, row)
+        return balances
+
+
+    def past_balances(self, row = None, until = None):
+        #Copper balances after the first row archived transactions, or after
+        #those approved before until, along with how many that was.
+        if row is None:
+            row = self.archive.position_before(until)
+        return row, self.archive.balances_at(row)
+
+
+    def archived(self, row):
+        initiator, mode, participant, *coins, reason, timestamp = row
+        if participant is not None:
+            participant = self.players[participant]
+        transaction = Transaction(self.players[initiator], mode, coins,
+                                  participant, reason)
+        transaction.time = timestamp
+        return transaction
+
+
+    def archive_rows(self, rows = None, player = None, start = None,
+                     end = None):
+        if rows is None:
+            archive = self.archive.rows()
+        else:
+            archive = self.archive.rows(rows[0] - 1, rows[1])
+        for row in archive:
+            if player is not None and player not in (row[0], row[2]):
+                continue
+            if start is not None or end is not None:
+                timestamp = row[-1]
+                if timestamp is None:
+                    continue
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp >= end:
+                    continue
+            yield row
+
+
+    def iter_csv(self, **filters):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator = '\n')
+        writer.writerow(CSV_HEADER)
+        names = {id: player.name for id, player in self.players.items()}
+        names[None] = 'World'
+        for initiator, mode, participant, *coins, reason, timestamp in \
+                self.archive_rows(**filters):
+            initiator = names[initiator]
+            if mode == 'give':
+                giver = initiator
+                taker = names[participant]
+            elif mode == 'take':
+                giver = names[participant]
+                taker = initiator
             else:
                 raise ValueError('Invalid transaction mode')
-            cp = transaction.amounts['cp']
-            sp = transaction.amounts['sp']
-            gp = transaction.amounts['gp']
-            pp = transaction.amounts['pp']
-            reason = transaction.reason
-            vals.append(','.join(str(val) for val in (
-                initiator, giver, taker,
-                cp, sp, gp, pp, reason,
-            )))
-        return '\n'.join(vals)
+            if timestamp is None:
+                approved = ''
+            else:
+                approved = datetime.datetime.fromtimestamp(
+                    timestamp, datetime.timezone.utc
+                ).isoformat(timespec = 'seconds')
+            writer.writerow((initiator, giver, taker, *coins, reason,
+                             approved))
+            if buffer.tell() >= CSV_CHUNK:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+
+    def to_csv(self, **filters):
+        return ''.join(self.iter_csv(**filters))
+
+
+    def export_csv(self, file, compress = False, **filters):
+        if compress:
+            file = gzip.GzipFile(fileobj = file, mode = 'wb')
+        for chunk in self.iter_csv(**filters):
+            file.write(chunk.encode())
+        if compress:
+            file.close() #Only flushes the gzip trailer; the target stays open.
+
+
+
+class PendingQueue:
+    def __init__(self):
+        self.items = {}
+        self.by_participant = {}
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def __iter__(self):
+        return iter(list(self.items.values()))
+
+
+    def __contains__(self, id):
+        return id in self.items
+
+
+    def __getitem__(self, id):
+        return self.items[id]
+
+
+    def append(self, transaction):
+        self.items[transaction.id] = transaction
+        participant = transaction.participant.id
+        if participant is not None:
+            self.by_participant.setdefault(participant, {})[transaction.id] = (
+                transaction)
+
+
+    def pop(self, id):
+        transaction = self.items.pop(id)
+        participant = transaction.participant.id
+        if participant is not None:
+            visible = self.by_participant[participant]
+            del visible[id]
+            if not visible:
+                del self.by_participant[participant]
+        return transaction
+
+
+    def visible(self, user, gm = False):
+        if gm:
+            return list(self.items.values())
+        return list(self.by_participant.get(user, {}).values())
+
+
+    def ids_at(self, indices):
+        ids = list(self.items)
+        return [ids[index] for index in indices]
+
+
+
+class Archive:
+    #Approved transactions, as rows in TRANSACTION_COLUMNS order. Only the
+    #tail is kept with the campaign; once it holds a full page, the backend
+    #seals the page into its own storage and records where in index. Sealed
+    #pages never change, and are read back through source when needed.
+    #After every CHECKPOINT_ROWS rows, checkpoints records the time of the
+    #last row and each player's copper balance so far, so a past balance
+    #replays no more than CHECKPOINT_ROWS rows.
+    def __init__(self):
+        self.index = []
+        self.tail = []
+        self.checkpoints = []
+        self.source = None
+        self.pages = collections.OrderedDict()
+        self.pages_lock = threading.Lock()
+
+
+    def __getstate__(self):
+        return {'index': self.index, 'tail': self.tail,
+                'checkpoints': self.checkpoints}
+
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+
+
+    def __len__(self):
+        return len(self.index)*ARCHIVE_PAGE + len(self.tail)
+
+
+    def append(self, row):
+        self.tail.append(row)
+        count = len(self)
+        #Archives from before checkpoints only get theirs when first
+        #queried, which fills in every checkpoint up to the query.
+        if count % CHECKPOINT_ROWS == 0 and \
+                len(self.checkpoints) == count // CHECKPOINT_ROWS - 1:
+            self.balances_at(count)
+
+
+    def copy(self):
+        #Shares the loaded pages, which are the same for every copy.
+        archive = Archive.__new__(Archive)
+        archive.__dict__.update(self.__dict__)
+        archive.index = list(self.index)
+        archive.tail = list(self.tail)
+        archive.checkpoints = list(self.checkpoints)
+        return archive
+
+
+    def adopt(self, checkpoints):
+        #Takes checkpoints filled in on a copy; the rows never change, so
+        #they hold for this archive too.
+        if len(checkpoints) > len(self.checkpoints):
+            self.checkpoints.extend(checkpoints[len(self.checkpoints):])
+
+
+    def balances_at(self, stop):
+        #Copper balance of each player after the first stop rows, adding
+        #any checkpoints that are missing on the way.
+        number = min(stop // CHECKPOINT_ROWS, len(self.checkpoints))
+        balances = dict(self.checkpoints[number - 1][1]) if number else {}
+        position = number*CHECKPOINT_ROWS
+        for row in self.rows(position, stop):
+            settle(balances, row)
+            position += 1
+            if position % CHECKPOINT_ROWS == 0 and \
+                    position // CHECKPOINT_ROWS > len(self.checkpoints):
+                self.checkpoints.append((row[-1], dict(balances)))
+        return balances
+
+
+    def position_before(self, timestamp):
+        #Rows approved before timestamp. Rows are archived in order of
+        #approval, and those from before approval times were recorded come
+        #first, so they count as earlier than any time.
+        times = [-math.inf if time is None else time
+                 for time, _balances in self.checkpoints]
+        position = bisect.bisect_left(times, timestamp)*CHECKPOINT_ROWS
+        for row in self.rows(position):
+            if row[-1] is not None and row[-1] >= timestamp:
+                break
+            position += 1
+        return position
+
+
+    def page_count(self):
+        return -(-len(self) // ARCHIVE_PAGE)
+
+
+    def page(self, number):
+        sealed = len(self.index)
+        if number >= sealed:
+            start = (number - sealed)*ARCHIVE_PAGE
+            return self.tail[start:start + ARCHIVE_PAGE]
+        with self.pages_lock:
+            if number in self.pages:
+                self.pages.move_to_end(number)
+                return self.pages[number]
+        rows = self.source(self.index[number])
+        with self.pages_lock:
+            self.pages[number] = rows
+            while len(self.pages) > ARCHIVE_CACHE:
+                self.pages.popitem(last = False)
+        return rows
+
+
+    def rows(self, start = 0, stop = None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        while start < stop:
+            number, offset = divmod(start, ARCHIVE_PAGE)
+            page = self.page(number)
+            yield from page[offset:offset + stop - start]
+            start = (number + 1)*ARCHIVE_PAGE
+
+
+    def full_pages(self):
+        return len(self.tail) // ARCHIVE_PAGE
+
+
+    def seal(self, location):
+        self.index.append(location)
+        del self.tail[:ARCHIVE_PAGE]
+
 
 
 class Player:
     def __init__(self, id, name):
-        self.cp = 0
-        self.sp = 0
-        self.gp = 0
-        self.pp = 0
+        self.coins = [0, 0, 0, 0]
+        self.copper = 0
         self.id = id
         self.name = name
+        self.rendered = None #Balance text, until the coins next change.
+
+
+    def __setstate__(self, state):
+        if 'coins' not in state: #Players from before the copper ledger.
+            state['coins'] = [state.pop(coin) for coin in COINS]
+            state['copper'] = convert_to_copper(state['coins'])
+        state.setdefault('rendered', None)
+        self.__dict__.update(state)
+
+
+    cp = property(lambda self: self.coins[0])
+    sp = property(lambda self: self.coins[1])
+    gp = property(lambda self: self.coins[2])
+    pp = property(lambda self: self.coins[3])
+
+
+    def set_coins(self, coins):
+        self.coins = list(coins)
+        self.copper = convert_to_copper(coins)
+        self.rendered = None
+
+
+    def adjust(self, coins, copper, mult):
+        for index, count in enumerate(coins):
+            self.coins[index] += count*mult
+        self.copper += copper*mult
+        self.rendered = None
 
 
     @property
     def balance(self):
-        coins =  '[{0.cp} CP | {0.sp} SP | {0.gp} GP | {0.pp} PP]'.format(self)
-        egp = ' ({0:.2f} EGP)'.format(convert_to_egp({
-            'cp': self.cp,
-            'sp': self.sp,
-            'gp': self.gp,
-            'pp': self.pp,
-        }))
-        return coins + egp
+        if self.rendered is None:
+            coins = '[{0.cp} CP | {0.sp} SP | {0.gp} GP | {0.pp} PP]'.format(
+                self)
+            egp = ' ({0} EGP)'.format(format_egp(self.copper))
+            self.rendered = coins + egp
+        return self.rendered
 
 
 
@@ -100,204 +615,2926 @@ class Transaction:
     def __init__(self, initiator, mode, amounts, participant, reason):
         self.participant = participant
         self.initiator = initiator
-        self.amounts = amounts
+        self.coins = to_coins(amounts)
+        self.copper = convert_to_copper(self.coins)
         self.reason = reason
         self.mode = mode
+        self.time = None
+        self.id = None
+        self.rendered = None
 
         if participant is None:
             self.participant = Player(None, 'World')
 
 
-    def complete(self):
-        if self.mode == 'give':
-            mult = -1
-        elif self.mode == 'take':
-            mult = 1
+    def __setstate__(self, state):
+        if 'amounts' in state: #Transactions from before the copper ledger.
+            state['coins'] = to_coins(state.pop('amounts'))
+            state['copper'] = convert_to_copper(state['coins'])
+        state.setdefault('time', None)
+        state.setdefault('id', None)
+        state.setdefault('rendered', None)
+        self.__dict__.update(state)
+
+
+    @property
+    def amounts(self):
+        return dict(zip(COINS, self.coins))
+
+
+    @property
+    def row(self):
+        return (self.initiator.id, self.mode, self.participant.id, *self.coins,
+                self.reason, self.time)
+
+
+    @property
+    def mult(self):
+        if self.mode == 'give':
+            return -1
+        elif self.mode == 'take':
+            return 1
+        raise ValueError('Mode should be "give" or "take"')
+
+
+    def complete(self):
+        mult = self.mult
+        self.initiator.adjust(self.coins, self.copper, mult)
+        if self.participant.id is not None:
+            self.participant.adjust(self.coins, self.copper, -mult)
+
+
+    @property
+    def text(self):
+        #Recorded transactions never change, so the text is kept until one
+        #of the players is renamed.
+        names = (self.initiator.name, self.participant.name)
+        if self.rendered is None or self.rendered[0] != names:
+            self.rendered = (names, self.render())
+        return self.rendered[1]
+
+
+    def render(self):
+        initiator = self.initiator.name
+
+        if self.mode == 'give':
+            arrow = '->'
+        elif self.mode == 'take':
+            arrow = '<-'
+        else:
+            raise ValueError('Mode should be "give" or "take"')
+
+        amount = ', '.join('{0} {1}'.format(count, coin.upper())
+                           for coin, count in zip(COINS, self.coins) if count)
+
+        if not self.reason:
+            reason = 'No reason given'
+        else:
+            reason = self.reason
+
+        participant = self.participant.name
+
+        return f'{initiator} {arrow} {participant}: {amount} ({reason})'
+
+
+
+#Campaign files, their journals and archive pages start with a magic
+#number, the format version and flags. Players are stored once and
+#referred to by ID, and transactions are stored column by column, so each
+#column packs or unpacks in a single struct call. Files without the magic
+#number are pickles from before this format. Version 2 added the archive's
+#balance checkpoints to campaign files.
+CAMPAIGN_MAGIC = b'DNDC'
+JOURNAL_MAGIC = b'DNDJ'
+PAGE_MAGIC = b'DNDP'
+FORMAT_VERSION = 2
+FORMAT_HEADER = struct.Struct('<4sBB')
+JOURNAL_RECORD = struct.Struct('<I')
+COMPRESSED = 1 #Format flag for a zlib compressed body.
+NO_PLAYER = -1 #Stands in for the World in player ID columns.
+MODES = ('give', 'take')
+MODE_CODES = {mode: code for code, mode in enumerate(MODES)}
+INT_TAGS = ((b'b', 2**7), (b'h', 2**15), (b'i', 2**31), (b'q', 2**63))
+VALUE_FORMATS = {b'b': '<b', b'h': '<h', b'i': '<i', b'q': '<q', b'd': '<d'}
+
+
+class BinaryReader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+
+    def unpack(self, format):
+        values = struct.unpack_from(format, self.data, self.offset)
+        self.offset += struct.calcsize(format)
+        return values
+
+
+    def read(self, size):
+        data = self.data[self.offset:self.offset + size]
+        if len(data) < size:
+            raise EOFError('Unexpected end of data')
+        self.offset += size
+        return data
+
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    #The bot used to be run as a script, so older pickles place its classes
+    #in __main__, which is a different module under migrate.py or add_gm.py.
+    def find_class(self, module, name):
+        if module == '__main__':
+            module = __name__
+        return super().find_class(module, name)
+
+
+
+def load_pickle(file):
+    return LegacyUnpickler(file).load()
+
+
+def encode_header(magic, body, compression = 0):
+    if compression:
+        body = zlib.compress(body, compression)
+    return FORMAT_HEADER.pack(magic, FORMAT_VERSION,
+                              COMPRESSED if compression else 0) + body
+
+
+def decode_header(data, magic):
+    #Returns the format version and the body.
+    found, version, flags = FORMAT_HEADER.unpack_from(data)
+    if found != magic:
+        raise ValueError('Unrecognized file format')
+    if version > FORMAT_VERSION:
+        raise ValueError('Written by a newer format version {0}'.format(
+            version))
+    body = data[FORMAT_HEADER.size:]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    return version, body
+
+
+def encode_strings(strings, out):
+    #Lengths are in characters, so the text is decoded in one go; None is
+    #stored with a length of -1.
+    strings = list(strings)
+    blob = ''.join(string for string in strings if string is not None).encode()
+    out.append(struct.pack('<{0}iI'.format(len(strings)),
+                           *(-1 if string is None else len(string)
+                             for string in strings), len(blob)))
+    out.append(blob)
+
+
+def decode_strings(reader, count):
+    *lengths, size = reader.unpack('<{0}iI'.format(count))
+    text = reader.read(size).decode()
+    strings = []
+    offset = 0
+    for length in lengths:
+        if length < 0:
+            strings.append(None)
+        else:
+            strings.append(text[offset:offset + length])
+            offset += length
+    return strings
+
+
+def encode_ints(values, out):
+    #Coin counts are unbounded, so a column that doesn't fit in 64 bits is
+    #stored as text instead.
+    values = list(values)
+    try:
+        data = struct.pack('<{0}q'.format(len(values)), *values)
+    except struct.error:
+        out.append(b's')
+        encode_strings(map(str, values), out)
+    else:
+        out.append(b'q')
+        out.append(data)
+
+
+def decode_ints(reader, count):
+    if reader.read(1) == b'q':
+        return reader.unpack('<{0}q'.format(count))
+    return [int(value) for value in decode_strings(reader, count)]
+
+
+def encode_rows(rows, out):
+    out.append(struct.pack('<I', len(rows)))
+    if not rows:
+        return
+    (initiators, modes, participants, cps, sps, gps, pps, reasons,
+     times) = zip(*rows)
+    encode_ints(initiators, out)
+    out.append(bytes(map(MODE_CODES.__getitem__, modes)))
+    encode_ints([NO_PLAYER if participant is None else participant
+                 for participant in participants], out)
+    encode_ints(cps + sps + gps + pps, out)
+    out.append(struct.pack('<{0}d'.format(len(rows)),
+                           *[math.nan if time is None else time
+                             for time in times]))
+    encode_strings(reasons, out)
+
+
+def decode_rows(reader):
+    count, = reader.unpack('<I')
+    if not count:
+        return []
+    initiators = decode_ints(reader, count)
+    modes = [MODES[code] for code in reader.read(count)]
+    participants = [None if participant == NO_PLAYER else participant
+                    for participant in decode_ints(reader, count)]
+    coins = decode_ints(reader, 4*count)
+    times = [None if time != time else time
+             for time in reader.unpack('<{0}d'.format(count))]
+    reasons = decode_strings(reader, count)
+    return list(zip(initiators, modes, participants, coins[:count],
+                    coins[count:2*count], coins[2*count:3*count],
+                    coins[3*count:], reasons, times))
+
+
+def encode_campaign(campaign, compression = COMPRESSION):
+    players = list(campaign.players.values())
+    pending = list(campaign.pending)
+    index = campaign.archive.index
+    out = [struct.pack('<IIII', len(campaign.gms), len(players), len(pending),
+                       len(index))]
+    encode_strings([campaign.VERSION], out)
+    encode_ints((campaign.id, campaign.revision, campaign.next_transaction,
+                 *campaign.gms), out)
+    encode_ints((player.id for player in players), out)
+    encode_ints((count for player in players for count in player.coins), out)
+    encode_strings((player.name for player in players), out)
+    encode_ints((transaction.id for transaction in pending), out)
+    encode_rows([transaction.row for transaction in pending], out)
+    encode_ints((value for location in index for value in location), out)
+    encode_rows(campaign.archive.tail, out)
+    encode_checkpoints(list(campaign.archive.checkpoints), out)
+    return encode_header(CAMPAIGN_MAGIC, b''.join(out), compression)
+
+
+def decode_campaign(data):
+    if not data.startswith(CAMPAIGN_MAGIC):
+        return load_pickle(io.BytesIO(data))
+    format_version, body = decode_header(data, CAMPAIGN_MAGIC)
+    reader = BinaryReader(body)
+    gms, players, pending, pages = reader.unpack('<IIII')
+    version, = decode_strings(reader, 1)
+    id, revision, next_transaction, *gms = decode_ints(reader, 3 + gms)
+    campaign = Campaign(id, None)
+    campaign.VERSION = version
+    campaign.revision = revision
+    campaign.next_transaction = next_transaction
+    campaign.gms = gms
+
+    ids = decode_ints(reader, players)
+    coins = decode_ints(reader, 4*players)
+    for index, name in enumerate(decode_strings(reader, players)):
+        player = Player(ids[index], name)
+        player.set_coins(coins[4*index:4*index + 4])
+        campaign.players[player.id] = player
+        campaign.names[name] = player.id
+
+    ids = decode_ints(reader, pending)
+    for id, row in zip(ids, decode_rows(reader)):
+        transaction = campaign.archived(row)
+        transaction.id = id
+        campaign.pending.append(transaction)
+
+    values = decode_ints(reader, 2*pages)
+    campaign.archive.index = list(zip(values[::2], values[1::2]))
+    campaign.archive.tail = decode_rows(reader)
+    if format_version >= 2:
+        campaign.archive.checkpoints = decode_checkpoints(reader)
+    return campaign
+
+
+def encode_checkpoints(checkpoints, out):
+    out.append(struct.pack('<I', len(checkpoints)))
+    if not checkpoints:
+        return
+    times, balances = zip(*checkpoints)
+    out.append(struct.pack('<{0}d'.format(len(times)),
+                           *[math.nan if timestamp is None else timestamp
+                             for timestamp in times]))
+    encode_ints(map(len, balances), out)
+    encode_ints((id for players in balances for id in players), out)
+    encode_ints((copper for players in balances
+                 for copper in players.values()), out)
+
+
+def decode_checkpoints(reader):
+    count, = reader.unpack('<I')
+    if not count:
+        return []
+    times = [None if timestamp != timestamp else timestamp
+             for timestamp in reader.unpack('<{0}d'.format(count))]
+    sizes = decode_ints(reader, count)
+    ids = decode_ints(reader, sum(sizes))
+    coppers = decode_ints(reader, len(ids))
+    checkpoints = []
+    start = 0
+    for timestamp, size in zip(times, sizes):
+        balances = dict(zip(ids[start:start + size],
+                            coppers[start:start + size]))
+        checkpoints.append((timestamp, balances))
+        start += size
+    return checkpoints
+
+
+def encode_page(rows, compression = COMPRESSION):
+    out = []
+    encode_rows(rows, out)
+    return encode_header(PAGE_MAGIC, b''.join(out), compression)
+
+
+def decode_page(data):
+    if not data.startswith(PAGE_MAGIC):
+        return load_pickle(io.BytesIO(data))
+    _version, body = decode_header(data, PAGE_MAGIC)
+    return decode_rows(BinaryReader(body))
+
+
+def encode_value(value, out):
+    #Journal entries are small tuples of numbers and strings, so they get a
+    #tagged encoding where integers, including sizes, take as few bytes as
+    #their value allows.
+    if value is None:
+        out.append(b'N')
+    elif isinstance(value, int):
+        for tag, limit in INT_TAGS:
+            if -limit <= value < limit:
+                out.append(tag + struct.pack(VALUE_FORMATS[tag], value))
+                return
+        data = str(value).encode()
+        out.append(b'n')
+        encode_value(len(data), out)
+        out.append(data)
+    elif isinstance(value, float):
+        out.append(b'd' + struct.pack('<d', value))
+    elif isinstance(value, str):
+        data = value.encode()
+        out.append(b's')
+        encode_value(len(data), out)
+        out.append(data)
+    elif isinstance(value, (tuple, list)):
+        out.append(b't' if isinstance(value, tuple) else b'l')
+        encode_value(len(value), out)
+        for item in value:
+            encode_value(item, out)
+    else:
+        raise TypeError('Cannot encode {0!r}'.format(value))
+
+
+def decode_value(reader):
+    tag = reader.read(1)
+    if tag in VALUE_FORMATS:
+        return reader.unpack(VALUE_FORMATS[tag])[0]
+    elif tag == b'N':
+        return None
+    elif tag in (b's', b'n'):
+        text = reader.read(decode_value(reader)).decode()
+        return text if tag == b's' else int(text)
+    elif tag in (b't', b'l'):
+        items = [decode_value(reader) for _ in range(decode_value(reader))]
+        return tuple(items) if tag == b't' else items
+    raise ValueError('Invalid value tag {0!r}'.format(tag))
+
+
+def encode_journal_entry(entry):
+    out = []
+    encode_value(entry, out)
+    body = b''.join(out)
+    return JOURNAL_RECORD.pack(len(body)) + body
+
+
+
+class FileBackend:
+    def __init__(self, path = DATA_DIR):
+        self.path = path
+        self.journal_sizes = {}
+        self.sync = False
+
+
+    def list_campaigns(self):
+        return [int(id) for id in os.listdir(self.path) if id.isdigit()]
+
+
+    def exists(self, id):
+        return os.path.isfile('{0}/{1}'.format(self.path, id))
+
+
+    def lock_directory(self):
+        return self.path
+
+
+    def stamp(self, id):
+        #Changes whenever any process rewrites or appends to the campaign.
+        stamp = []
+        for path in ('{0}/{1}', '{0}/{1}.journal'):
+            try:
+                stat = os.stat(path.format(self.path, id))
+            except FileNotFoundError:
+                stamp.append(None)
+            else:
+                stamp.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return tuple(stamp)
+
+
+    def read(self, id):
+        with open('{0}/{1}'.format(self.path, id), 'rb') as file:
+            data = file.read()
+        campaign = decode_campaign(data)
+        campaign.archive.source = functools.partial(self.read_page, id)
+        count, journal_size, legacy = self.replay_journal(campaign)
+        if legacy or not data.startswith(CAMPAIGN_MAGIC):
+            #Pickled files are upgraded by the next save writing a snapshot.
+            self.journal_sizes.pop(id, None)
+        else:
+            self.journal_sizes[id] = count
+        return campaign, len(data) + journal_size
+
+
+    def read_page(self, id, location):
+        offset, size = location
+        with open('{0}/{1}.archive'.format(self.path, id), 'rb') as file:
+            file.seek(offset)
+            return decode_page(file.read(size))
+
+
+    def save(self, campaign, entries):
+        count = self.journal_sizes.get(campaign.id, 0) + len(entries)
+        if campaign.id not in self.journal_sizes or count > JOURNAL_LIMIT:
+            logging.info('Writing {0}'.format(campaign.id))
+            size = self.write_snapshot(campaign)
+            self.journal_sizes[campaign.id] = 0
+            return size, True
+        logging.info('Journaling {0} entries for {1}'.format(
+            len(entries), campaign.id))
+        size = self.append_journal(campaign.id, entries)
+        self.journal_sizes[campaign.id] = count
+        return size, False
+
+
+    def delete(self, id):
+        os.remove('{0}/{1}'.format(self.path, id))
+        for suffix in ('journal', 'archive'):
+            try:
+                os.remove('{0}/{1}.{2}'.format(self.path, id, suffix))
+            except FileNotFoundError:
+                pass
+        self.journal_sizes.pop(id, None)
+
+
+    def write_snapshot(self, campaign):
+        path = '{0}/{1}'.format(self.path, campaign.id)
+        self.seal_pages(campaign)
+        data = encode_campaign(campaign)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+            size = len(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+        #The snapshot records its revision, so a crash before the journal is
+        #removed only leaves entries that replay_journal will skip.
+        try:
+            os.remove(path + '.journal')
+        except FileNotFoundError:
+            pass
+        return size
+
+
+    def seal_pages(self, campaign):
+        #Full pages are appended to the archive file before the snapshot that
+        #indexes them is written. Anything past the last indexed page was
+        #left by an interrupted write, and is overwritten.
+        archive = campaign.archive
+        if not archive.full_pages():
+            return
+        end = sum(archive.index[-1]) if archive.index else 0
+        path = '{0}/{1}.archive'.format(self.path, campaign.id)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+            file.seek(end)
+            file.truncate()
+            while archive.full_pages():
+                data = encode_page(archive.tail[:ARCHIVE_PAGE])
+                file.write(data)
+                archive.seal((end, len(data)))
+                end += len(data)
+            file.flush()
+            os.fsync(file.fileno())
+        if archive.source is None:
+            archive.source = functools.partial(self.read_page, campaign.id)
+
+
+    def append_journal(self, id, entries):
+        data = b''.join(map(encode_journal_entry, entries))
+        with open('{0}/{1}.journal'.format(self.path, id), 'ab') as file:
+            if not file.tell():
+                data = encode_header(JOURNAL_MAGIC, data)
+            file.write(data)
+            if self.sync:
+                file.flush()
+                os.fsync(file.fileno())
+            return len(data)
+
+
+    def replay_journal(self, campaign):
+        #Returns the number of entries, the size of the journal and whether
+        #it was pickled before the binary format.
+        try:
+            file = open('{0}/{1}.journal'.format(self.path, campaign.id), 'rb+')
+        except FileNotFoundError:
+            return 0, 0, False
+        with file:
+            data = file.read()
+            if len(data) < FORMAT_HEADER.size or \
+                    not data.startswith(JOURNAL_MAGIC):
+                file.seek(0)
+                count = self.replay_pickle_journal(file, campaign)
+                return count, file.tell(), count > 0
+            _version, body = decode_header(data, JOURNAL_MAGIC)
+            reader = BinaryReader(body)
+            count = 0
+            end = 0
+            while end < len(body):
+                try:
+                    size, = reader.unpack(JOURNAL_RECORD.format)
+                    record = BinaryReader(reader.read(size))
+                    revision, entry = decode_value(record)
+                except (struct.error, EOFError, ValueError, TypeError):
+                    self.truncate_journal(file, FORMAT_HEADER.size + end,
+                                          campaign.id)
+                    break
+                if revision > campaign.revision:
+                    campaign.apply(entry)
+                count += 1
+                end = reader.offset
+            return count, FORMAT_HEADER.size + end, False
+
+
+    def replay_pickle_journal(self, file, campaign):
+        count = 0
+        while True:
+            offset = file.tell()
+            try:
+                revision, entry = load_pickle(file)
+            except EOFError:
+                if file.tell() != offset:
+                    self.truncate_journal(file, offset, campaign.id)
+                break
+            except (pickle.UnpicklingError, ValueError, TypeError):
+                self.truncate_journal(file, offset, campaign.id)
+                break
+            if revision > campaign.revision:
+                campaign.apply(entry)
+            count += 1
+        return count
+
+
+    def truncate_journal(self, file, offset, id):
+        logging.warning('Discarding torn journal entry in {0}'.format(id))
+        file.truncate(offset)
+
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS campaigns (
+    id INTEGER PRIMARY KEY,
+    version TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    next_transaction INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS gms (
+    campaign INTEGER NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+    user INTEGER NOT NULL,
+    PRIMARY KEY (campaign, user)
+);
+CREATE TABLE IF NOT EXISTS players (
+    campaign INTEGER NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    cp INTEGER NOT NULL DEFAULT 0,
+    sp INTEGER NOT NULL DEFAULT 0,
+    gp INTEGER NOT NULL DEFAULT 0,
+    pp INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (campaign, id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS player_names ON players (campaign, name);
+CREATE TABLE IF NOT EXISTS pending (
+    campaign INTEGER NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    initiator INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    participant INTEGER,
+    cp INTEGER NOT NULL,
+    sp INTEGER NOT NULL,
+    gp INTEGER NOT NULL,
+    pp INTEGER NOT NULL,
+    reason TEXT,
+    time REAL,
+    PRIMARY KEY (campaign, seq)
+);
+CREATE TABLE IF NOT EXISTS archive (
+    campaign INTEGER NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    initiator INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    participant INTEGER,
+    cp INTEGER NOT NULL,
+    sp INTEGER NOT NULL,
+    gp INTEGER NOT NULL,
+    pp INTEGER NOT NULL,
+    reason TEXT,
+    time REAL,
+    PRIMARY KEY (campaign, seq)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    campaign INTEGER NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    player INTEGER NOT NULL,
+    time REAL,
+    copper INTEGER NOT NULL,
+    PRIMARY KEY (campaign, seq, player)
+);
+'''
+
+TRANSACTION_COLUMNS = ('initiator, mode, participant, cp, sp, gp, pp, reason, '
+                       'time')
+TRANSACTION_ROW = '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+
+class SQLiteBackend:
+    def __init__(self, path = DATABASE):
+        self.path = path
+        self.local = threading.local()
+        self.sync = False
+        with self.connect() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+            #Databases created before these columns existed.
+            self.add_column(conn, 'pending', 'time REAL')
+            self.add_column(conn, 'archive', 'time REAL')
+            self.add_column(conn, 'campaigns',
+                            'next_transaction INTEGER NOT NULL DEFAULT 0')
+
+
+    def add_column(self, conn, table, column):
+        columns = [row[1] for row in conn.execute(
+            'PRAGMA table_info({0})'.format(table))]
+        if column.split()[0] not in columns:
+            conn.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(table, column))
+
+
+    def connect(self):
+        #SQLite connections can't be shared between threads, so each I/O
+        #worker keeps its own.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout = 30)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA foreign_keys = ON')
+            conn.execute('PRAGMA synchronous = {0}'.format(
+                'FULL' if self.sync else 'NORMAL'))
+            self.local.conn = conn
+        return conn
+
+
+    def list_campaigns(self):
+        return [id for id, in self.connect().execute(
+            'SELECT id FROM campaigns')]
+
+
+    def exists(self, id):
+        return self.connect().execute('SELECT 1 FROM campaigns WHERE id = ?',
+                                      (id, )).fetchone() is not None
+
+
+    def lock_directory(self):
+        return self.path + '.locks'
+
+
+    def stamp(self, id):
+        #Every save bumps the stored revision.
+        row = self.connect().execute('SELECT revision FROM campaigns '
+                                     'WHERE id = ?', (id, )).fetchone()
+        return None if row is None else row[0]
+
+
+    def read(self, id):
+        conn = self.connect()
+        row = conn.execute('SELECT version, revision, next_transaction '
+                           'FROM campaigns WHERE id = ?', (id, )).fetchone()
+        if row is None:
+            raise FileNotFoundError('No campaign with ID {0}'.format(id))
+
+        gms = [user for user, in conn.execute(
+            'SELECT user FROM gms WHERE campaign = ? ORDER BY rowid', (id, ))]
+        campaign = Campaign(id, None)
+        campaign.VERSION, campaign.revision, campaign.next_transaction = row
+        campaign.gms = gms
+
+        for player_id, name, *coins in conn.execute(
+                'SELECT id, name, cp, sp, gp, pp FROM players '
+                'WHERE campaign = ?', (id, )):
+            player = Player(player_id, name)
+            player.set_coins(coins)
+            campaign.players[player_id] = player
+            campaign.names[name] = player_id
+
+        for transaction in self.read_transactions(conn, 'pending', campaign):
+            campaign.pending.append(transaction)
+            campaign.next_transaction = max(campaign.next_transaction,
+                                            transaction.id + 1)
+        #Archive rows are numbered from zero, so page n is simply the rows
+        #numbered from n*ARCHIVE_PAGE, and only the last page is read here.
+        count, = conn.execute('SELECT COUNT(*) FROM archive WHERE campaign = ?',
+                              (id, )).fetchone()
+        campaign.archive.index = list(range(count // ARCHIVE_PAGE))
+        campaign.archive.tail = self.read_page(id, len(campaign.archive.index))
+        campaign.archive.source = functools.partial(self.read_page, id)
+        checkpoints = campaign.archive.checkpoints
+        for seq, player, timestamp, copper in conn.execute(
+                'SELECT seq, player, time, copper FROM checkpoints '
+                'WHERE campaign = ? ORDER BY seq', (id, )):
+            if seq == len(checkpoints):
+                checkpoints.append((timestamp, {}))
+            checkpoints[-1][1][player] = copper
+        return campaign, None
+
+
+    def read_page(self, id, number):
+        return self.connect().execute(
+            'SELECT {0} FROM archive WHERE campaign = ? AND seq >= ? '
+            'AND seq < ? ORDER BY seq'.format(TRANSACTION_COLUMNS),
+            (id, number*ARCHIVE_PAGE, (number + 1)*ARCHIVE_PAGE)).fetchall()
+
+
+    def read_transactions(self, conn, table, campaign):
+        transactions = []
+        for row in conn.execute(
+                'SELECT seq, {0} FROM {1} WHERE campaign = ? ORDER BY seq'
+                .format(TRANSACTION_COLUMNS, table), (campaign.id, )):
+            transactions.append(self.read_transaction(campaign, row))
+        return transactions
+
+
+    def read_transaction(self, campaign, row):
+        seq, initiator, mode, participant, *coins, reason, timestamp = row
+        if participant is not None:
+            participant = campaign.players[participant]
+        transaction = Transaction(campaign.players[initiator], mode, coins,
+                                  participant, reason)
+        transaction.time = timestamp
+        transaction.id = seq
+        return transaction
+
+
+    def save(self, campaign, entries):
+        conn = self.connect()
+        with conn:
+            exists = conn.execute('SELECT 1 FROM campaigns WHERE id = ?',
+                                  (campaign.id, )).fetchone()
+            if exists is None:
+                logging.info('Writing {0}'.format(campaign.id))
+                self.write_campaign(conn, campaign)
+                rewritten = True
+            else:
+                logging.info('Applying {0} entries to {1}'.format(
+                    len(entries), campaign.id))
+                for _revision, entry in entries:
+                    self.apply(conn, campaign.id, entry)
+                conn.execute('UPDATE campaigns SET revision = ?, '
+                             'next_transaction = ? WHERE id = ?',
+                             (campaign.revision, campaign.next_transaction,
+                              campaign.id))
+                self.write_checkpoints(conn, campaign)
+                rewritten = False
+        #Everything archived is in the table now, so full pages can leave
+        #the tail.
+        archive = campaign.archive
+        while archive.full_pages():
+            archive.seal(len(archive.index))
+        if archive.source is None:
+            archive.source = functools.partial(self.read_page, campaign.id)
+        return None, rewritten
+
+
+    def delete(self, id):
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM campaigns WHERE id = ?', (id, ))
+
+
+    def write_campaign(self, conn, campaign):
+        conn.execute('INSERT INTO campaigns '
+                     '(id, version, revision, next_transaction) '
+                     'VALUES (?, ?, ?, ?)',
+                     (campaign.id, campaign.VERSION, campaign.revision,
+                      campaign.next_transaction))
+        conn.executemany('INSERT OR IGNORE INTO gms (campaign, user) '
+                         'VALUES (?, ?)',
+                         [(campaign.id, gm) for gm in campaign.gms])
+        conn.executemany(
+            'INSERT INTO players (campaign, id, name, cp, sp, gp, pp) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(campaign.id, player.id, player.name, *player.coins)
+             for player in campaign.players.values()])
+        conn.executemany(
+            'INSERT INTO pending (campaign, seq, {0}) VALUES {1}'.format(
+                TRANSACTION_COLUMNS, TRANSACTION_ROW),
+            [(campaign.id, transaction.id, *transaction.row)
+             for transaction in campaign.pending])
+        conn.executemany(
+            'INSERT INTO archive (campaign, seq, {0}) VALUES {1}'.format(
+                TRANSACTION_COLUMNS, TRANSACTION_ROW),
+            ((campaign.id, seq, *row)
+             for seq, row in enumerate(campaign.archive.rows())))
+        self.write_checkpoints(conn, campaign)
+
+
+    def write_checkpoints(self, conn, campaign):
+        #Checkpoints are only ever added, so only the new ones are written.
+        start = self.next_seq(conn, 'checkpoints', campaign.id)
+        conn.executemany(
+            'INSERT INTO checkpoints (campaign, seq, player, time, copper) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(campaign.id, seq, player, timestamp, copper)
+             for seq, (timestamp, balances) in enumerate(
+                 campaign.archive.checkpoints[start:], start)
+             for player, copper in balances.items()])
+
+
+    def next_seq(self, conn, table, id):
+        seq, = conn.execute('SELECT MAX(seq) FROM {0} WHERE campaign = ?'
+                            .format(table), (id, )).fetchone()
+        return 0 if seq is None else seq + 1
+
+
+    def pending_seqs(self, conn, id, indices):
+        seqs = [seq for seq, in conn.execute(
+            'SELECT seq FROM pending WHERE campaign = ? ORDER BY seq', (id, ))]
+        return [seqs[index] for index in indices]
+
+
+    def adjust(self, conn, id, player, coins, mult):
+        conn.execute('UPDATE players SET cp = cp + ?, sp = sp + ?, '
+                     'gp = gp + ?, pp = pp + ? WHERE campaign = ? AND id = ?',
+                     (*(count*mult for count in coins), id, player))
+
+
+    def apply(self, conn, id, entry):
+        op, *args = entry
+        if op == 'register':
+            player, name = args
+            conn.execute('INSERT INTO players (campaign, id, name) '
+                         'VALUES (?, ?, ?)', (id, player, name))
+        elif op == 'rename':
+            player, name = args
+            conn.execute('UPDATE players SET name = ? '
+                         'WHERE campaign = ? AND id = ?', (name, id, player))
+        elif op == 'transact':
+            initiator, mode, amounts, participant, reason, *seq = args
+            if not seq:
+                seq = [self.next_seq(conn, 'pending', id)]
+            conn.execute(
+                'INSERT INTO pending (campaign, seq, {0}) VALUES {1}'.format(
+                    TRANSACTION_COLUMNS, TRANSACTION_ROW),
+                (id, seq[0], initiator, mode, participant, *to_coins(amounts),
+                 reason, None))
+        elif op in ('approve', 'approve_ids'):
+            seqs = args[0]
+            if op == 'approve':
+                seqs = self.pending_seqs(conn, id, seqs)
+            timestamp = args[1] if len(args) > 1 else None
+            archive_seq = self.next_seq(conn, 'archive', id)
+            for seq in seqs:
+                row = conn.execute(
+                    'SELECT {0} FROM pending WHERE campaign = ? AND seq = ?'
+                    .format(TRANSACTION_COLUMNS), (id, seq)).fetchone()
+                initiator, mode, participant, *coins, _reason, _time = row
+                mult = -1 if mode == 'give' else 1
+                self.adjust(conn, id, initiator, coins, mult)
+                if participant is not None:
+                    self.adjust(conn, id, participant, coins, -mult)
+                conn.execute(
+                    'INSERT INTO archive (campaign, seq, {0}) VALUES {1}'
+                    .format(TRANSACTION_COLUMNS, TRANSACTION_ROW),
+                    (id, archive_seq, *row[:-1], timestamp))
+                conn.execute('DELETE FROM pending '
+                             'WHERE campaign = ? AND seq = ?', (id, seq))
+                archive_seq += 1
+        elif op in ('deny', 'deny_ids'):
+            seqs = args[0]
+            if op == 'deny':
+                seqs = self.pending_seqs(conn, id, seqs)
+            conn.executemany('DELETE FROM pending '
+                             'WHERE campaign = ? AND seq = ?',
+                             [(id, seq) for seq in seqs])
+        elif op == 'convert':
+            initiator, amounts = args
+            self.adjust(conn, id, initiator, to_coins(amounts), 1)
+        elif op == 'add_gm':
+            conn.execute('INSERT OR IGNORE INTO gms (campaign, user) '
+                         'VALUES (?, ?)', (id, args[0]))
+        else:
+            raise ValueError('Invalid journal entry "{0}"'.format(op))
+
+
+
+def storage_backend():
+    #The backend chosen by DND_STORAGE, shared by the bot and its scripts.
+    if os.environ.get('DND_STORAGE', 'file') == 'sqlite':
+        return SQLiteBackend(os.environ.get('DND_DATABASE', DATABASE))
+    return FileBackend(os.environ.get('DND_DATA', DATA_DIR))
+
+
+class Metrics:
+    #Counters, gauges and histograms keyed by name and a sorted tuple of
+    #label pairs, rendered in the Prometheus text format.
+    def __init__(self, buckets = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.types = {}
+        self.values = {}
+        self.histograms = {}
+        self.sources = weakref.WeakSet() #Objects with a collect_metrics method.
+
+
+    def increment(self, name, amount = 1, **labels):
+        self.types[name] = 'counter'
+        key = name, tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+    def set(self, name, value, kind = 'gauge', **labels):
+        self.types[name] = kind
+        self.values[name, tuple(sorted(labels.items()))] = value
+
+
+    def observe(self, name, value, **labels):
+        self.types[name] = 'histogram'
+        key = name, tuple(sorted(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0]*len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[0][index] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+
+    def value(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+
+    def count(self, name, **labels):
+        histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+        return histogram[2] if histogram else 0
+
+
+    def quantile(self, name, fraction, **labels):
+        #Upper bound of the bucket holding the quantile, or None past the
+        #last bucket.
+        histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+        if not histogram or not histogram[2]:
+            return None
+        total = 0
+        for bound, count in zip(self.buckets, histogram[0]):
+            total += count
+            if total >= fraction*histogram[2]:
+                return bound
+        return None
+
+
+    def labelled(self, name):
+        return [dict(labels) for metric, labels in
+                itertools.chain(self.values, self.histograms)
+                if metric == name]
+
+
+    def collect(self):
+        for source in list(self.sources):
+            source.collect_metrics(self)
+
+
+    def render(self):
+        self.collect()
+        lines = []
+        series = collections.defaultdict(list)
+        for (name, labels), value in self.values.items():
+            series[name].append((labels, value))
+        for (name, labels), histogram in self.histograms.items():
+            series[name].append((labels, histogram))
+
+        for name in sorted(series):
+            lines.append('# TYPE {0} {1}'.format(name, self.types[name]))
+            for labels, value in sorted(series[name], key = lambda item:
+                                        item[0]):
+                if self.types[name] != 'histogram':
+                    lines.append('{0}{1} {2}'.format(name,
+                                                     format_labels(labels),
+                                                     value))
+                    continue
+                buckets, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, buckets):
+                    cumulative += bucket
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, format_labels(labels + (('le', bound),)),
+                        cumulative))
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append('{0}_sum{1} {2}'.format(name,
+                                                     format_labels(labels),
+                                                     total))
+                lines.append('{0}_count{1} {2}'.format(name,
+                                                       format_labels(labels),
+                                                       count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+
+class LockTimeout(TimeoutError):
+    pass
+
+
+
+class VersionConflict(Exception):
+    pass
+
+
+
+class MissingCampaign(FileNotFoundError):
+    pass
+
+
+
+class ProcessLocks:
+    #Advisory file locks, one per campaign, so that several processes can
+    #share a storage backend. Only the holder of the campaign's lock within
+    #a process ever takes its file lock.
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError('Sharing storage between processes needs '
+                               'fcntl file locks')
+        self.path = path
+        self.files = {}
+        os.makedirs(path, exist_ok = True)
+
+
+    def try_acquire(self, id):
+        file = open('{0}/{1}.lock'.format(self.path, id), 'ab')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        self.files[id] = file
+        return True
+
+
+    def release(self, id):
+        self.files.pop(id).close()
+
+
+
+class CampaignCache:
+    def __init__(self, max_entries = CACHE_ENTRIES, max_bytes = CACHE_BYTES,
+                 pinned = None):
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.pinned = pinned
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __contains__(self, id):
+        return id in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get(self, id):
+        try:
+            campaign = self.entries[id]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(id)
+        self.hits += 1
+        return campaign
+
+
+    def put(self, id, campaign, size = None):
+        self.entries[id] = campaign
+        self.entries.move_to_end(id)
+        if size is not None:
+            self.bytes += size - self.sizes.get(id, 0)
+            self.sizes[id] = size
+        self.evict()
+
+
+    def grow(self, id, size):
+        if id in self.entries:
+            self.put(id, self.entries[id], self.sizes.get(id, 0) + size)
+
+
+    def pop(self, id):
+        self.bytes -= self.sizes.pop(id, 0)
+        return self.entries.pop(id, None)
+
+
+    def over_budget(self):
+        if len(self.entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.bytes > self.max_bytes
+
+
+    def evict(self):
+        #Walk from the least recently used end, skipping anything in use.
+        for id in list(self.entries):
+            if not self.over_budget():
+                break
+            if self.pinned is not None and self.pinned(id):
+                continue
+            self.pop(id)
+            self.evictions += 1
+            logging.info('Evicted {0} from cache'.format(id))
+
+
+
+class CampaignRegistry:
+    def __init__(self, max_missing = REGISTRY_MISSING):
+        self.known = set()
+        self.missing = set()
+        self.max_missing = max_missing
+
+
+    def lookup(self, id):
+        if id in self.known:
+            return True
+        if id in self.missing:
+            return False
+        return None
+
+
+    def record(self, id, exists):
+        if exists:
+            self.missing.discard(id)
+            self.known.add(id)
+        else:
+            self.known.discard(id)
+            if len(self.missing) >= self.max_missing:
+                self.missing.clear()
+            self.missing.add(id)
+
+
+
+class DatabaseManager:
+    #Durability modes:
+    #  'sync'     - every save is written and fsynced before the lock is freed
+    #  'write'    - every save is written, leaving flushing to the OS
+    #  'deferred' - saves mark the campaign dirty, and dirty campaigns are
+    #               written together after flush_delay seconds, once
+    #               flush_threshold campaigns are dirty, or on close()
+    #With 'sync' and 'write', the lock is freed once a change is applied, and
+    #saves that come in before their write starts share it. Each save still
+    #waits for its write, so commands only reply once the change is stored.
+    #With shared set, other processes may use the same backend at once.
+    #Campaign locks then also take a file lock, and cached campaigns are
+    #reread when their stored copy changed. Deferred writes would be
+    #invisible to the other processes, so they aren't allowed.
+    def __init__(self, backend = None, max_entries = CACHE_ENTRIES,
+                 max_bytes = CACHE_BYTES, io_workers = IO_WORKERS,
+                 durability = DURABILITY, flush_delay = FLUSH_DELAY,
+                 flush_threshold = FLUSH_THRESHOLD, metrics = metrics,
+                 shared = False):
+        if durability not in ('sync', 'write', 'deferred'):
+            raise ValueError('Invalid durability "{0}"'.format(durability))
+        if shared and durability == 'deferred':
+            raise ValueError('Deferred durability can\'t be used with shared '
+                             'storage')
+        if backend is None:
+            backend = FileBackend()
+        backend.sync = durability == 'sync'
+        self.backend = backend
+        self.durability = durability
+        self.flush_delay = flush_delay
+        self.flush_threshold = flush_threshold
+        self.dirty = {}
+        self.flush_timer = None
+        self.flushing = None
+        self.writes = {}
+        self.writers = set()
+        self.campaigns = CampaignRegistry()
+        self.locks = weakref.WeakValueDictionary()
+        self.held = {}
+        self.owners = {}
+        self.depths = {}
+        self.waiters = collections.Counter()
+        self.cache = CampaignCache(max_entries, max_bytes, self.is_pinned)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = io_workers, thread_name_prefix = 'dnd-io')
+        self.io_slots = asyncio.Semaphore(io_workers)
+        self.process_locks = None
+        self.stamps = {}
+        if shared:
+            self.process_locks = ProcessLocks(backend.lock_directory())
+        self.metrics = metrics
+        metrics.sources.add(self)
+
+
+    def collect_metrics(self, metrics):
+        metrics.set('dnd_cache_hits_total', self.cache.hits, 'counter')
+        metrics.set('dnd_cache_misses_total', self.cache.misses, 'counter')
+        metrics.set('dnd_cache_evictions_total', self.cache.evictions,
+                    'counter')
+        metrics.set('dnd_cache_campaigns', len(self.cache))
+        metrics.set('dnd_cache_bytes', self.cache.bytes)
+        metrics.set('dnd_locks_held', len(self.held))
+        metrics.set('dnd_dirty_campaigns', len(self.dirty))
+
+
+    async def run_io(self, function, *args):
+        async with self.io_slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, function, *args)
+
+
+    async def has_campaign(self, id):
+        exists = self.campaigns.lookup(id)
+        #Other processes may have created the campaign since; one deleted
+        #elsewhere is only noticed when it fails to load.
+        if exists is None or (exists is False and self.process_locks):
+            exists = await self.run_io(self.backend.exists, id)
+            self.campaigns.record(id, exists)
+        return exists
+
+
+    async def add_campaign(self, campaign, timeout = LOCK_TIMEOUT):
+        await self.acquire(campaign.id, timeout)
+        try:
+            if await self.has_campaign(campaign.id):
+                raise FileExistsError('Campaign with this ID already exists')
+            #New campaigns are written straight away even when deferring, so
+            #a rollback always has a stored copy to start from.
+            await self.write_campaign(campaign)
+            self.cache.put(campaign.id, campaign)
+        finally:
+            self.release(campaign.id)
+
+        logging.info('Created {0}'.format(campaign.id))
+
+        self.campaigns.record(campaign.id, True)
+        self.cache.evict()
+
+
+    async def del_campaign(self, id, timeout = LOCK_TIMEOUT):
+        await self.acquire(id, timeout)
+        try:
+            self.dirty.pop(id, None)
+            self.stamps.pop(id, None)
+            await self.run_io(self.backend.delete, id)
+            self.campaigns.record(id, False)
+            self.cache.pop(id)
+        finally:
+            self.release(id)
+
+        logging.info('Successfully deleted {0}'.format(id))
+
+
+    def lock(self, id):
+        #Locks are only kept alive by whoever holds or waits on them, so idle
+        #campaigns don't accumulate one each.
+        lock = self.locks.get(id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[id] = lock
+        return lock
+
+
+    async def acquire(self, id, timeout = None):
+        #Locks are reentrant for the task holding them, so a command can keep
+        #its campaign locked across the loads and commits it makes.
+        task = asyncio.current_task()
+        if id in self.held and self.owners[id] is task:
+            self.depths[id] += 1
+            return
+        lock = self.lock(id)
+        start = time.perf_counter()
+        if not lock.locked() and not self.waiters[id]:
+            #wait_for() would yield to the loop even for a free lock, letting
+            #other commands in between a command's validation and commit.
+            await lock.acquire()
+        else:
+            self.metrics.increment('dnd_lock_contended_total')
+            #A released lock stays unlocked until its next waiter runs, so
+            #waiters are counted to keep newcomers from jumping the queue.
+            self.waiters[id] += 1
+            try:
+                await asyncio.wait_for(lock.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self.metrics.increment('dnd_lock_timeouts_total')
+                logging.warning('Timed out waiting for {0}'.format(id))
+                raise LockTimeout('Campaign {0} is busy'.format(id))
+            finally:
+                self.waiters[id] -= 1
+                if not self.waiters[id]:
+                    del self.waiters[id]
+        if self.process_locks is not None:
+            try:
+                await self.acquire_process_lock(id, timeout, start)
+            except BaseException:
+                lock.release()
+                raise
+        self.metrics.observe('dnd_lock_wait_seconds',
+                             time.perf_counter() - start)
+        self.held[id] = lock
+        self.owners[id] = task
+        self.depths[id] = 1
+
+
+    async def acquire_process_lock(self, id, timeout, start):
+        delay = 0.001
+        while not self.process_locks.try_acquire(id):
+            if timeout is not None and \
+               time.perf_counter() + delay - start > timeout:
+                self.metrics.increment('dnd_lock_timeouts_total')
+                logging.warning('Timed out waiting for {0} in another '
+                                'process'.format(id))
+                raise LockTimeout('Campaign {0} is busy'.format(id))
+            await asyncio.sleep(delay)
+            delay = min(2*delay, LOCK_POLL)
+
+        try:
+            self.revalidate(id)
+        except BaseException:
+            self.process_locks.release(id)
+            raise
+
+
+    def revalidate(self, id):
+        #Another process may have written the campaign since it was cached.
+        if id not in self.cache.entries:
+            return
+        #A stat or a one row lookup is cheaper than handing it to a thread.
+        if self.backend.stamp(id) != self.stamps.get(id):
+            logging.info('{0} was changed by another process'.format(id))
+            self.metrics.increment('dnd_cache_invalidations_total')
+            self.cache.pop(id)
+
+
+    def release(self, id):
+        self.depths[id] -= 1
+        if not self.depths[id]:
+            del self.depths[id], self.owners[id]
+            if self.process_locks is not None:
+                self.process_locks.release(id)
+            self.held.pop(id).release()
+
+
+    @contextlib.asynccontextmanager
+    async def hold(self, id, timeout = LOCK_TIMEOUT):
+        #Write-through saves free the lock before the block ends.
+        await self.acquire(id, timeout)
+        task = asyncio.current_task()
+        try:
+            yield
+        finally:
+            if self.owners.get(id) is task:
+                self.release(id)
+
+
+    def is_locked(self, id):
+        #A freed lock with tasks waiting is already promised to them.
+        return id in self.held or id in self.waiters
+
+
+    def is_pinned(self, id):
+        return id in self.held or id in self.dirty or id in self.writes
+
+
+    def cached(self, id):
+        #The campaign if it's in memory, without loading it or counting a
+        #cache lookup.
+        return self.cache.entries.get(id)
+
+
+    async def load_campaign(self, id, blocking = False,
+                            timeout = LOCK_TIMEOUT):
+        await self.acquire(id, timeout)
+
+        campaign = self.cache.get(id)
+        if campaign is None:
+            logging.info('Reading {0}'.format(id))
+            start = time.perf_counter()
+            try:
+                campaign, size = await self.run_io(self.read, id)
+            except FileNotFoundError:
+                self.release(id)
+                self.campaigns.record(id, False)
+                return None
+            except BaseException:
+                self.release(id)
+                raise
+            self.metrics.observe('dnd_storage_seconds',
+                                 time.perf_counter() - start,
+                                 operation = 'read')
+            if size is not None:
+                self.metrics.increment('dnd_storage_read_bytes_total', size,
+                                       campaign = id)
+            self.cache.put(id, campaign, size)
+
+        if not blocking:
+            self.release(id)
+        else:
+            logging.info('Acquired lock for {0}'.format(id))
+
+        return campaign
+
+
+    @contextlib.asynccontextmanager
+    async def edit(self, id, timeout = LOCK_TIMEOUT):
+        #Holds the campaign's lock for the body of an async with block. The
+        #changes are saved when the block ends normally, and rolled back if
+        #it raises; either way the lock is released.
+        campaign = await self.load_campaign(id, True, timeout)
+        if campaign is None:
+            raise MissingCampaign('No campaign with ID {0}'.format(id))
+        async with self.changes(campaign):
+            yield campaign
+
+
+    @contextlib.asynccontextmanager
+    async def commit(self, campaign, version, timeout = LOCK_TIMEOUT):
+        #Optimistic counterpart to edit(): the caller has already validated
+        #against campaign without holding the lock, so the body only runs if
+        #the cached campaign is still that object at that revision. Otherwise
+        #VersionConflict is raised and the caller should validate again.
+        await self.acquire(campaign.id, timeout)
+        if (self.cache.entries.get(campaign.id) is not campaign
+                or campaign.revision != version):
+            self.release(campaign.id)
+            self.metrics.increment('dnd_commit_conflicts_total')
+            raise VersionConflict('Campaign {0} changed since revision {1}'
+                                  .format(campaign.id, version))
+        async with self.changes(campaign):
+            yield campaign
+
+
+    @contextlib.asynccontextmanager
+    async def changes(self, campaign):
+        #Expects the campaign's lock to be held already.
+        id = campaign.id
+        committed = len(campaign.journal)
+        try:
+            yield campaign
+        except BaseException:
+            try:
+                if len(campaign.journal) > committed:
+                    await self.rollback(campaign, campaign.journal[:committed])
+            finally:
+                self.release(id)
+            raise
+
+        if len(campaign.journal) > committed:
+            await self.save_campaign(campaign)
+        else:
+            self.release(id)
+
+
+    async def rollback(self, campaign, committed):
+        #The stored copy plus any saved but unwritten entries is the state
+        #from before the failed edit.
+        logging.info('Rolling back {0}'.format(campaign.id))
+        self.metrics.increment('dnd_rollbacks_total')
+        try:
+            restored, size = await self.run_io(self.backend.read, campaign.id)
+        except Exception:
+            logging.exception('Could not roll back {0}'.format(campaign.id))
+            return
+        for revision, entry in committed:
+            if revision > restored.revision:
+                restored.apply(entry)
+        restored.journal = list(committed)
+        self.cache.put(campaign.id, restored, size)
+        if campaign.id in self.dirty:
+            self.dirty[campaign.id] = restored
+
+
+    async def save_campaign(self, campaign):
+        if self.durability == 'deferred':
+            #The entries stay in campaign.journal until the next flush.
+            self.dirty[campaign.id] = campaign
+            self.cache.put(campaign.id, campaign)
+            self.release(campaign.id)
+            logging.info('Released lock for {0}'.format(campaign.id))
+            self.schedule_flush()
+            return
+
+        #Another process may take the campaign as soon as its lock is freed,
+        #so the write has to land first.
+        if self.process_locks is not None:
+            try:
+                await self.write_campaign(campaign)
+            finally:
+                self.release(campaign.id)
+                logging.info('Released lock for {0}'.format(campaign.id))
+            self.cache.evict()
+            return
+
+        #Otherwise the lock only covers applying the change. Saves made while
+        #a write is queued are stored by that write, and each save waits for
+        #the write that stores its entries. That write needs the lock, so a
+        #hold() around the commit ends here as well.
+        write = self.writes.get(campaign.id)
+        if write is None:
+            write = asyncio.get_running_loop().create_future()
+            self.writes[campaign.id] = write
+            writer = asyncio.ensure_future(
+                self.write_through(campaign, write))
+            self.writers.add(writer)
+            writer.add_done_callback(self.writers.discard)
+        self.depths[campaign.id] = 1
+        self.release(campaign.id)
+        logging.info('Released lock for {0}'.format(campaign.id))
+        await asyncio.shield(write)
+
+
+    async def write_through(self, campaign, write):
+        id = campaign.id
+        await self.acquire(id)
+        #Entries saved from here on need the next write.
+        del self.writes[id]
+        try:
+            #A rollback may have replaced the campaign, or a deletion made
+            #the write pointless.
+            campaign = self.cache.entries.get(id, campaign)
+            if self.campaigns.lookup(id) is not False:
+                await self.write_campaign(campaign)
+        except Exception as error:
+            write.set_exception(error)
+        else:
+            write.set_result(None)
+        finally:
+            if not write.done():
+                write.cancel()
+            self.release(id)
+            self.cache.evict()
+
+
+    def read(self, id):
+        #Runs on an I/O thread, so taking the stamp costs no extra hop.
+        campaign, size = self.backend.read(id)
+        if self.process_locks is not None:
+            self.stamps[id] = self.backend.stamp(id)
+        return campaign, size
+
+
+    def save(self, campaign, entries):
+        result = self.backend.save(campaign, entries)
+        if self.process_locks is not None:
+            self.stamps[campaign.id] = self.backend.stamp(campaign.id)
+        return result
+
+
+    async def write_campaign(self, campaign):
+        entries, campaign.journal = campaign.journal, []
+        start = time.perf_counter()
+        try:
+            size, rewritten = await self.run_io(self.save, campaign, entries)
+        except BaseException:
+            campaign.journal[0:0] = entries
+            raise
+        self.metrics.observe('dnd_storage_seconds', time.perf_counter() - start,
+                             operation = 'write')
+        if size is not None:
+            self.metrics.increment('dnd_storage_written_bytes_total', size,
+                                   campaign = campaign.id)
+        if rewritten:
+            self.cache.put(campaign.id, campaign, size)
+        elif size:
+            self.cache.grow(campaign.id, size)
+
+
+    def schedule_flush(self):
+        if self.flushing is not None:
+            return
+        if len(self.dirty) >= self.flush_threshold:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+            self.start_flush()
+        elif self.flush_timer is None:
+            loop = asyncio.get_running_loop()
+            self.flush_timer = loop.call_later(self.flush_delay,
+                                               self.start_flush)
+
+
+    def start_flush(self):
+        self.flush_timer = None
+        self.flushing = asyncio.ensure_future(self.flush())
+
+
+    async def flush(self):
+        try:
+            while self.dirty:
+                dirty, self.dirty = self.dirty, {}
+                logging.info('Flushing {0} campaigns'.format(len(dirty)))
+                for id, campaign in dirty.items():
+                    await self.acquire(id)
+                    #A rollback while waiting may have replaced the campaign.
+                    campaign = self.cache.entries.get(id, campaign)
+                    try:
+                        await self.write_campaign(campaign)
+                    except Exception:
+                        logging.exception('Failed to flush {0}'.format(id))
+                        self.dirty.setdefault(id, campaign)
+                    finally:
+                        self.release(id)
+                if self.dirty and all(id in dirty for id in self.dirty):
+                    break #Only failed campaigns are left; retry later.
+        finally:
+            self.flushing = None
+            self.cache.evict()
+            if self.dirty and self.flush_timer is None:
+                loop = asyncio.get_running_loop()
+                self.flush_timer = loop.call_later(self.flush_delay,
+                                                   self.start_flush)
+
+
+    async def close(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.flushing is not None:
+            await self.flushing
+        if self.dirty:
+            await self.flush()
+        if self.writers:
+            await asyncio.wait(self.writers)
+        self.executor.shutdown()
+
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.warned = False #Whether the sender was told about the limit.
+
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+        return self.tokens
+
+
+    def take(self):
+        self.tokens -= 1
+        self.warned = False
+
+
+
+#Commands that change a campaign; they and GM commands run first.
+MUTATIONS = frozenset(('initialize', 'delete', 'register', 'reregister',
+                       'convert', 'transact', 'bulk', 'approve', 'deny'))
+#Commands that can take a while, which are the first to be turned away.
+EXPENSIVE = frozenset(('audit', 'roll', 'odds', 'history'))
+
+
+class CommandScheduler:
+    #Admits commands through per-user and per-channel token buckets, then
+    #runs them from a priority queue with a fixed number of workers. As the
+    #queue grows, lower priorities are turned away first, and commands that
+    #waited longer than the timeout are dropped rather than run late.
+    def __init__(self, process, workers = COMMAND_WORKERS,
+                 limit = QUEUE_LIMIT, timeout = QUEUE_TIMEOUT,
+                 metrics = metrics):
+        self.process = process
+        self.workers = workers
+        self.limit = limit
+        self.timeout = timeout
+        self.queue = None #Created with the workers, inside the event loop.
+        self.tasks = []
+        self.sequence = itertools.count()
+        self.users = {}
+        self.channels = {}
+        self.busy = 0
+        self.metrics = metrics
+        metrics.sources.add(self)
+
+
+    def collect_metrics(self, metrics):
+        metrics.set('dnd_queue_depth', self.queue.qsize() if self.queue else 0)
+        metrics.set('dnd_command_workers_busy', self.busy)
+
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.ensure_future(self.work())
+                      for _ in range(self.workers)]
+
+
+    def priority(self, message, name):
+        if name in MUTATIONS:
+            return 0
+        campaign = dbm.cached(message.channel.id)
+        if campaign is not None and message.author.id in campaign.gms:
+            return 0
+        return 2 if name in EXPENSIVE else 1
+
+
+    def bucket(self, buckets, id, rate, burst, now):
+        bucket = buckets.get(id)
+        if bucket is not None:
+            bucket.refill(now)
+            return bucket
+        if len(buckets) >= RATE_BUCKETS:
+            #A full bucket is the same as a new one, so it can be forgotten.
+            for key in [key for key, idle in buckets.items()
+                        if idle.refill(now) >= idle.burst]:
+                del buckets[key]
+        bucket = buckets[id] = TokenBucket(rate, burst, now)
+        return bucket
+
+
+    async def submit(self, message):
+        content = message.content
+        if not content.startswith(bot.command_prefix):
+            return
+        name = content[len(bot.command_prefix):].split(None, 1)[:1]
+        name = name[0] if name else ''
+        if self.queue is None:
+            self.start()
+
+        now = time.monotonic()
+        user = self.bucket(self.users, message.author.id, USER_RATE,
+                           USER_BURST, now)
+        channel = self.bucket(self.channels, message.channel.id, CHANNEL_RATE,
+                              CHANNEL_BURST, now)
+        for reason, bucket in (('user', user), ('channel', channel)):
+            if bucket.tokens < 1:
+                self.metrics.increment('dnd_commands_rejected_total',
+                                       reason = reason)
+                #Only the first rejected command gets a reply, so a flood
+                #of them doesn't become a flood of replies.
+                if not bucket.warned:
+                    bucket.warned = True
+                    logging.info('Rate limited {0} in #{1}.'.format(
+                        message.author.name, message.channel.name))
+                    await message.channel.send('You are sending commands too '
+                                               'quickly; please wait a moment.')
+                return
+
+        priority = self.priority(message, name)
+        if self.queue.qsize() >= self.limit*QUEUE_SHARES[priority]:
+            self.metrics.increment('dnd_commands_rejected_total',
+                                   reason = 'queue')
+            if not user.warned:
+                user.warned = True
+                logging.warning('Command queue full; turning away {0}.'.format(
+                    name))
+                await message.channel.send('The bot is busy right now; '
+                                           'please try again shortly.')
+            return
+        user.take()
+        channel.take()
+        self.queue.put_nowait((priority, next(self.sequence), now, message))
+
+
+    async def work(self):
+        while True:
+            _priority, _sequence, queued, message = await self.queue.get()
+            waited = time.monotonic() - queued
+            self.metrics.observe('dnd_queue_wait_seconds', waited)
+            self.busy += 1
+            try:
+                if waited > self.timeout:
+                    self.metrics.increment('dnd_commands_rejected_total',
+                                           reason = 'timeout')
+                    logging.warning('Dropping {0} after {1:.1f}s in the '
+                                    'queue.'.format(message.content, waited))
+                    await message.channel.send('The bot is busy right now; '
+                                               'please try again shortly.')
+                else:
+                    await self.process(message)
+            except Exception as error:
+                logging.error('Error in {0}: {1}'.format(message.content,
+                                                         error))
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
+
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions = True)
+        self.tasks = []
+        self.queue = None
+
+
+scheduler = CommandScheduler(bot.process_commands)
+
+
+
+async def parse_indices(ctx, campaign, terms):
+    try:
+        selection = parse_selection(terms)
+    except CommandSyntaxError as error:
+        await log_syntax_error(ctx, error)
+        return None
+
+    pending = campaign.pending.visible(ctx.author.id,
+                                       ctx.author.id in campaign.gms)
+    indices = set()
+    if selection.keyword == 'last':
+        if pending:
+            indices.add(len(pending) - 1)
+    elif selection.keyword == 'all':
+        indices.update(range(len(pending)))
+    else:
+        for start, end in selection.ranges:
+            if start < 1 or end > len(pending):
+                problem = start if start < 1 else end
+                logging.info('Encountered invalid index; aborting.')
+                await ctx.send('"{0}" is an invalid ID.'.format(problem))
+                return None
+            indices.update(range(start - 1, end))
+    return [pending[index].id for index in sorted(indices)]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                                .replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in labels)
+    return '{' + ','.join(pairs) + '}'
+
+
+async def serve_metrics(host, port):
+    server = await asyncio.start_server(handle_metrics, host, port)
+    logging.info('Serving metrics on {0}:{1}.'.format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+async def handle_metrics(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), METRICS_TIMEOUT)
+        while True: #Headers are read but ignored.
+            line = await asyncio.wait_for(reader.readline(), METRICS_TIMEOUT)
+            if line in (b'', b'\n', b'\r\n'):
+                break
+        parts = request.split()
+        if len(parts) > 1 and parts[0] == b'GET' and \
+           parts[1].split(b'?')[0] == b'/metrics':
+            status = '200 OK'
+            body = metrics.render().encode()
+        else:
+            status = '404 Not Found'
+            body = b'Not found\n'
+        writer.write('HTTP/1.0 {0}\r\nContent-Type: text/plain; version=0.0.4'
+                     '\r\nContent-Length: {1}\r\n\r\n'.format(
+                         status, len(body)).encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def optimistic(handler):
+    #Reruns a command whose campaign changed between validating it and
+    #committing the result. Handlers must not reply before they commit.
+    @functools.wraps(handler)
+    async def wrapper(ctx, *args, **kwargs):
+        #Validating while another command holds the lock would only be
+        #against state that is about to change, so queue for it instead.
+        #Shared storage keeps the lock for the whole write, which is long
+        #enough that most unlocked validations would conflict.
+        attempts = COMMIT_RETRIES
+        if dbm.process_locks is not None or dbm.is_locked(ctx.channel.id):
+            attempts = 0
+        for _ in range(attempts):
+            try:
+                return await handler(ctx, *args, **kwargs)
+            except VersionConflict:
+                metrics.increment('dnd_command_retries_total',
+                                  command = handler.__name__)
+                logging.info('Campaign changed; retrying.')
+        #Busy campaigns can keep winning the race, so the last attempt holds
+        #the lock throughout and cannot conflict.
+        async with dbm.hold(ctx.channel.id):
+            return await handler(ctx, *args, **kwargs)
+    return wrapper
+
+
+async def channel_campaign(ctx):
+    #A campaign deleted by another process sharing the storage is only
+    #noticed when it fails to load, after has_campaign() has found it.
+    campaign = await dbm.load_campaign(ctx.channel.id)
+    if campaign is None:
+        raise MissingCampaign('No campaign with ID {0}'.format(ctx.channel.id))
+    return campaign
+
+
+def paginate(header, lines, limit = MESSAGE_LIMIT):
+    #Splits between lines, so no message goes over the limit.
+    pages = []
+    page = header
+    for line in lines:
+        if len(page) + 1 + len(line) > limit:
+            pages.append(page)
+            page = line
+        else:
+            page += '\n' + line
+    pages.append(page)
+    return pages
+
+
+async def send_listing(ctx, header, items, name):
+    #Items are (label, text) pairs, shown as "label`text`". Listings too long
+    #for a few messages are attached as a text file instead.
+    items = list(items)
+    width = MESSAGE_LIMIT - 3
+    lines = []
+    for label, text in items:
+        if len(label) + len(text) > width:
+            text = text[:width - len(label) - 3] + '...'
+        lines.append('{0}`{1}`'.format(label, text))
+    pages = paginate(header, lines)
+    if len(pages) <= LISTING_MESSAGES:
+        for page in pages:
+            await ctx.send(page)
+        return
+    text = '\n'.join(label + text for label, text in items)
+    file = io.BytesIO((header + '\n' + text + '\n').encode())
+    await ctx.send('{0} ({1} entries attached)'.format(header.rstrip(':'),
+                                                       len(items)),
+                   file = discord.File(file, name))
+
+
+async def log_syntax_error(ctx, error = None):
+    logging.info('Invalid syntax; aborting.')
+    if error is None:
+        await ctx.send(':x: Invalid syntax. Use `dnd-help [command]` to view '
+                       'info.')
+    else:
+        await ctx.send(':x: Invalid syntax: {0} Use `dnd-help [command]` to '
+                       'view info.'.format(error))
+
+
+class CommandError(ValueError):
+    pass
+
+
+
+class CommandSyntaxError(CommandError):
+    pass
+
+
+TransactCommand = collections.namedtuple(
+    'TransactCommand', 'initiator mode amounts offset participant reason')
+ConvertCommand = collections.namedtuple('ConvertCommand',
+                                        'initiator conversions')
+RegisterCommand = collections.namedtuple('RegisterCommand', 'user name')
+BalanceCommand = collections.namedtuple('BalanceCommand',
+                                        'target moment row until')
+SelectionCommand = collections.namedtuple('SelectionCommand', 'keyword ranges')
+SplitCommand = collections.namedtuple('SplitCommand',
+                                      'amounts recipients source reason')
+
+
+def command_arguments(content):
+    parts = content.split(None, 1)
+    return parts[1].strip() if len(parts) > 1 else ''
+
+
+def parse_amounts(text):
+    amounts = {'cp': 0, 'sp': 0, 'gp': 0, 'pp': 0}
+    for term in text.split(','):
+        match = AMOUNT.fullmatch(term.strip())
+        if match is None:
+            raise CommandSyntaxError('"{0}" is not an amount such as "5 gp".'
+                                     .format(term.strip()))
+        amount, unit = match.groups()
+        unit = unit.lower()
+        if unit == 'egp':
+            if len(amount.partition('.')[2]) > 2:
+                raise CommandSyntaxError('EGP amounts may have at most two '
+                                         'decimals.')
+            convert_from_egp(decimal.Decimal(amount), amounts)
+        elif '.' not in amount:
+            amounts[unit] += int(amount)
+        else:
+            raise CommandSyntaxError('Only EGP amounts may have decimals.')
+    return amounts
+
+
+def parse_transact(text):
+    #Splits the words at each keyword; "for" takes the rest of the line.
+    words = text.split()
+    if not words or words[0] not in TRANSACT_KEYWORDS:
+        raise CommandSyntaxError('Expected a keyword such as "give" first.')
+    clauses = {}
+    keyword = None
+    start = 0
+    for index, word in enumerate(words + ['for']):
+        if word not in TRANSACT_KEYWORDS:
+            continue
+        if keyword is not None:
+            if keyword in clauses:
+                raise CommandSyntaxError('"{0}" is used twice.'.format(keyword))
+            clauses[keyword] = ' '.join(words[start:index])
+            if not clauses[keyword]:
+                raise CommandSyntaxError('"{0}" needs a value.'.format(keyword))
+        keyword = word
+        start = index + 1
+        if word == 'for':
+            clauses['for'] = ' '.join(words[start:])
+            break
+
+    if ('give' in clauses) == ('take' in clauses):
+        raise CommandSyntaxError('Use exactly one of "give" and "take".')
+    mode = 'give' if 'give' in clauses else 'take'
+    if 'to' in clauses and mode != 'give':
+        raise CommandSyntaxError('"to" only goes with "give".')
+    if 'from' in clauses and mode != 'take':
+        raise CommandSyntaxError('"from" only goes with "take".')
+
+    offset = None
+    if 'at' in clauses:
+        match = OFFSET.fullmatch(clauses['at'])
+        if match is None:
+            raise CommandSyntaxError('"{0}" is not an offset such as "-10%".'
+                                     .format(clauses['at']))
+        offset = int(match.group(1))
+
+    return TransactCommand(clauses.get('as'), mode,
+                           parse_amounts(clauses[mode]), offset,
+                           clauses.get('to', clauses.get('from')),
+                           clauses.get('for') or None)
+
+
+def parse_convert(text):
+    initiator = None
+    match = AS_PREFIX.fullmatch(text)
+    if match:
+        initiator, text = match.group(1), match.group(2) or ''
+
+    conversions = []
+    for term in text.split(','):
+        match = CONVERSION.fullmatch(term.strip())
+        if match is None:
+            raise CommandSyntaxError('"{0}" is not a conversion such as "5 gp '
+                                     'to sp".'.format(term.strip()))
+        amount, source, target = match.groups()
+        conversions.append((int(amount), source.lower(), target.lower()))
+    return ConvertCommand(initiator, conversions)
+
+
+def parse_registration(text):
+    match = REGISTRATION.fullmatch(text)
+    if match is None:
+        raise CommandSyntaxError('Expected "as [name]".')
+    user, name = match.groups()
+    return RegisterCommand(int(user) if user else None, name)
+
+
+def parse_balance(text):
+    match = BALANCE_TARGET.fullmatch(text)
+    if match is None:
+        raise CommandSyntaxError('Expected nothing, "of [name]" and/or '
+                                 '"at [date or #number]".')
+    target, moment = match.groups()
+    row = until = None
+    if moment is not None:
+        number = BALANCE_ROW.fullmatch(moment)
+        if number is not None:
+            row = int(number.group(1))
+        else:
+            until = parse_moment(moment)
+    return BalanceCommand(target, moment, row, until)
+
+
+def parse_moment(text):
+    #A date or time covers everything approved before it ends, so this
+    #returns when it ends.
+    for format, length in BALANCE_TIMES:
+        try:
+            start = datetime.datetime.strptime(text, format)
+        except ValueError:
+            continue
+        return (start.replace(tzinfo = datetime.timezone.utc)
+                + length).timestamp()
+    raise CommandSyntaxError('Expected a date such as 2024-05-01, a time such '
+                             'as 2024-05-01T18:30 or a transaction number '
+                             'such as #12 after "at".')
+
+
+def parse_selection(text):
+    terms = [term.strip() for term in text.split(',')]
+    if 'last' in terms:
+        return SelectionCommand('last', [])
+    if 'all' in terms:
+        return SelectionCommand('all', [])
+
+    ranges = []
+    for term in terms:
+        match = SELECTION.fullmatch(term)
+        if match is None:
+            raise CommandSyntaxError('"{0}" is not an ID or ID slice.'.format(
+                term))
+        start = int(match.group(1))
+        if match.group(2) is None:
+            ranges.append((start, start))
+            continue
+        end = int(match.group(2))
+        if start >= end:
+            raise CommandSyntaxError('Start ID must be lower than end ID.')
+        ranges.append((start, end))
+    return SelectionCommand(None, ranges)
+
+
+def parse_split(text):
+    match = SPLIT.fullmatch(text)
+    if match is None:
+        raise CommandSyntaxError('Expected "split [amounts] among [names]".')
+    amounts, recipients, source, reason = match.groups()
+    recipients = recipients.replace(',', ' ').split()
+    if recipients == ['all']:
+        recipients = None
+    return SplitCommand(parse_amounts(amounts), recipients, source,
+                        reason.strip() if reason else None)
+
+
+def split_amounts(amounts, count):
+    #Shares differ by at most a copper, with the spare copper going first.
+    share, spare = divmod(convert_to_copper(amounts), count)
+    return [convert_from_copper(share + (index < spare))
+            for index in range(count)]
+
+
+def bulk_lines(data, name):
+    #Attachments hold either a JSON list or CSV rows, both keyed by the
+    #dnd-transact keywords; each becomes one line of transact arguments.
+    text = data.decode('utf-8-sig')
+    if name.lower().endswith('.json'):
+        try:
+            rows = json.loads(text)
+        except ValueError:
+            raise CommandSyntaxError('{0} is not valid JSON.'.format(name))
+        if not isinstance(rows, list):
+            raise CommandSyntaxError('{0} must hold a list.'.format(name))
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+
+    lines = []
+    for row in rows:
+        if isinstance(row, dict):
+            row = {str(key).strip().lower(): str(value).strip()
+                   for key, value in row.items() if value not in (None, '')}
+            row = ' '.join('{0} {1}'.format(keyword, row[keyword])
+                           for keyword in ('as', 'give', 'take', 'at', 'to',
+                                           'from', 'for') if keyword in row)
+        elif not isinstance(row, str):
+            raise CommandSyntaxError('{0} holds an entry that is neither '
+                                     'text nor an object.'.format(name))
+        lines.append(row)
+    return lines
+
+
+def bulk_transactions(campaign, author, line):
+    def player(name):
+        if name not in campaign.names:
+            raise CommandError('No player with name "{0}" exists in this '
+                               'campaign.'.format(name))
+        return campaign.players[campaign.names[name]]
+
+    if line.split(None, 1)[0] == 'split':
+        command = parse_split(line)
+        if command.recipients is None:
+            recipients = [recipient for recipient in campaign.players.values()
+                          if command.source is None
+                          or recipient.name != command.source]
+        else:
+            recipients = [player(name) for name in command.recipients]
+        if not recipients:
+            raise CommandError('There is nobody to split between.')
+        source = None if command.source is None else player(command.source)
+        #A source sharing in its own split simply keeps its share, and
+        #shares that round down to nothing are left out.
+        transactions = [Transaction(recipient, 'take', share, source,
+                                    command.reason)
+                        for recipient, share in zip(recipients, split_amounts(
+                            command.amounts, len(recipients)))
+                        if recipient is not source
+                        and convert_to_copper(share)]
+        if not transactions:
+            raise CommandError('The split is too small to give anybody a '
+                               'share.')
+        return transactions
+
+    command = parse_transact(line)
+    if command.initiator is not None:
+        initiator = player(command.initiator)
+    elif author in campaign.players:
+        initiator = campaign.players[author]
+    else:
+        raise CommandError('You are not registered in this campaign.')
+
+    amounts = command.amounts
+    if command.offset is not None:
+        copper = apply_offset(convert_to_copper(amounts), command.offset)
+        amounts = convert_from_copper(copper)
+    participant = None
+    if command.participant is not None:
+        participant = player(command.participant)
+    return [Transaction(initiator, command.mode, amounts, participant,
+                        command.reason)]
+
+
+def to_coins(amounts):
+    if isinstance(amounts, dict):
+        return tuple(amounts[coin] for coin in COINS)
+    return tuple(amounts)
+
+
+def convert_to_copper(amounts):
+    if isinstance(amounts, dict):
+        amounts = to_coins(amounts)
+    cp, sp, gp, pp = amounts
+    return (cp*CONVERSIONS['cp'] + sp*CONVERSIONS['sp'] + gp*CONVERSIONS['gp']
+            + pp*CONVERSIONS['pp'])
+
+
+def settle(balances, row):
+    #Adds an archived transaction to a mapping of copper balances.
+    initiator, mode, participant, *coins, _reason, _time = row
+    copper = convert_to_copper(coins)*(-1 if mode == 'give' else 1)
+    balances[initiator] = balances.get(initiator, 0) + copper
+    if participant is not None:
+        balances[participant] = balances.get(participant, 0) - copper
+
+
+def convert_from_copper(copper, amounts = None):
+    if amounts is None:
+        amounts = {'cp': 0, 'sp': 0, 'gp': 0, 'pp': 0}
+    sign = -1 if copper < 0 else 1
+    gp, copper = divmod(abs(copper), CONVERSIONS['gp'])
+    sp, cp = divmod(copper, CONVERSIONS['sp'])
+    amounts['gp'] += sign*gp
+    amounts['sp'] += sign*sp
+    amounts['cp'] += sign*cp
+    return amounts
+
+
+def convert_from_egp(amount, amounts = None):
+    copper = decimal.Decimal(amount).scaleb(2).to_integral_value()
+    return convert_from_copper(int(copper), amounts)
+
+
+def apply_offset(copper, percent):
+    #Rounds half a copper away from zero without leaving integers.
+    scaled = copper*(100 + percent)
+    sign = -1 if scaled < 0 else 1
+    return sign*((abs(scaled) + 50)//100)
+
+
+def format_egp(copper):
+    sign = '-' if copper < 0 else ''
+    egp, copper = divmod(abs(copper), 100)
+    return '{0}{1}.{2:02d}'.format(sign, egp, copper)
+
+
+def roll_dice(count, sides):
+    if sides > 2**53: #random.choices loses uniformity past float precision.
+        return [1 + random.randrange(sides) for _ in range(count)]
+    return random.choices(range(1, sides + 1), k = count)
+
+
+def roll_sum(count, sides):
+    if count <= BREAKDOWN_DICE:
+        return sum(roll_dice(count, sides))
+
+    if distribution_cost(count, sides) <= EXACT_BUDGET:
+        totals, cumulative = sum_distribution(count, sides)
+        return random.choices(totals, cum_weights = cumulative)[0]
+
+    total = 0
+    if numpy is not None and sides*DICE_CHUNK < 2**63: #No int64 overflow.
+        generator = numpy.random.default_rng(random.getrandbits(64))
+        while count:
+            batch = min(count, DICE_CHUNK)
+            total += int(generator.integers(1, sides + 1, batch,
+                                            dtype = numpy.int64).sum())
+            count -= batch
+        return total
+
+    while count:
+        batch = min(count, DICE_CHUNK)
+        total += sum(roll_dice(batch, sides))
+        count -= batch
+    return total
+
+
+def distribution_cost(count, sides):
+    return count*(count*(sides - 1) + 1)
+
+
+@functools.lru_cache(maxsize = DISTRIBUTION_CACHE)
+def sum_distribution(count, sides):
+    #Probabilities of every total of countdsides, built one die at a time
+    #with a sliding window sum, then accumulated for random.choices.
+    if numpy is not None:
+        die = numpy.full(sides, 1/sides)
+        probabilities = die
+        for _ in range(count - 1):
+            probabilities = numpy.convolve(probabilities, die)
+        probabilities = probabilities.tolist()
+    else:
+        probabilities = [1/sides]*sides
+        for _ in range(count - 1):
+            convolved = []
+            window = 0.0
+            for index in range(len(probabilities) + sides - 1):
+                if index < len(probabilities):
+                    window += probabilities[index]
+                if index >= sides:
+                    window -= probabilities[index - sides]
+                convolved.append(window/sides)
+            probabilities = convolved
+    totals = range(count, count*sides + 1)
+    return totals, list(itertools.accumulate(probabilities))
+
+
+class DiceError(ValueError):
+    pass
+
+
+
+class DiceConstant:
+    def __init__(self, value):
+        self.value = value
+
+
+    def evaluate(self):
+        return self.value, str(self.value)
+
+
+    def distribution(self, budget):
+        return self.value, [1.0]
+
+
+
+class DicePool:
+    def __init__(self, count, sides):
+        self.count = count
+        self.sides = sides
+        self.explode = False
+        self.keep = None #(mode, number) where mode is one of kh, kl, dh, dl.
+
+
+    def evaluate(self):
+        if self.count > BREAKDOWN_DICE and not self.explode and not self.keep:
+            total = roll_sum(self.count, self.sides)
+            return total, '({0})'.format(total)
+
+        rolls = roll_dice(self.count, self.sides)
+        if self.explode:
+            #Every maximum roll adds another die; each round is one batch.
+            extra = rolls.count(self.sides)
+            for _ in range(EXPLODE_LIMIT):
+                if not extra:
+                    break
+                rerolls = roll_dice(extra, self.sides)
+                rolls += rerolls
+                extra = rerolls.count(self.sides)
+
+        dropped = set()
+        if self.keep:
+            mode, number = self.keep
+            if mode in ('kh', 'kl'):
+                kept = min(number, len(rolls))
+            else:
+                kept = max(len(rolls) - number, 0)
+            order = sorted(range(len(rolls)), key = rolls.__getitem__,
+                           reverse = mode in ('kh', 'dl'))
+            dropped = set(order[kept:])
+
+        total = sum(roll for index, roll in enumerate(rolls)
+                    if index not in dropped)
+        if len(rolls) > BREAKDOWN_DICE:
+            return total, '({0})'.format(total)
+        text = ' + '.join('~~{0}~~'.format(roll) if index in dropped
+                          else str(roll) for index, roll in enumerate(rolls))
+        return total, '({0})'.format(text)
+
+
+    def distribution(self, budget):
+        if self.explode:
+            if self.keep:
+                #Rerolled dice join the pool before keeping, which the
+                #per-die convolution below cannot describe.
+                raise DiceError('Exploding dice cannot be kept or dropped '
+                                'when computing odds.')
+            die = explode_distribution(self.sides, budget)
+        else:
+            #Charged before the faces are allocated, so a huge die is
+            #refused without building them.
+            budget.spend(self.sides, self.sides)
+            die = 1, [1/self.sides]*self.sides
+        if not self.keep:
+            return power_distribution(die, self.count, budget)
+
+        mode, number = self.keep
+        if mode in ('kh', 'kl'):
+            kept = min(number, self.count)
+        else:
+            kept = max(self.count - number, 0)
+        return keep_distribution(die, self.count, kept, mode in ('kh', 'dl'),
+                                 budget)
+
+
+
+class DiceNegation:
+    def __init__(self, operand):
+        self.operand = operand
+
+
+    def evaluate(self):
+        value, text = self.operand.evaluate()
+        return -value, '-' + text
+
+
+    def distribution(self, budget):
+        return negate_distribution(self.operand.distribution(budget))
+
+
+
+class DiceGroup:
+    def __init__(self, inner):
+        self.inner = inner
+
+
+    def evaluate(self):
+        value, text = self.inner.evaluate()
+        return value, '({0})'.format(text)
+
+
+    def distribution(self, budget):
+        return self.inner.distribution(budget)
+
+
+
+class DiceOperation:
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+
+    def evaluate(self):
+        left, left_text = self.left.evaluate()
+        right, right_text = self.right.evaluate()
+        if self.operator == '+':
+            value = left + right
+        elif self.operator == '-':
+            value = left - right
+        elif self.operator == '*':
+            value = left*right
+        elif right:
+            value = left//right #Divisions round down.
+        else:
+            raise DiceError('Division by zero.')
+        return value, '{0} {1} {2}'.format(left_text, self.operator, right_text)
+
+
+    def distribution(self, budget):
+        left = self.left.distribution(budget)
+        right = self.right.distribution(budget)
+        if self.operator == '+':
+            return add_distributions(left, right, budget)
+        if self.operator == '-':
+            return add_distributions(left, negate_distribution(right), budget)
+        return combine_distributions(self.operator, left, right, budget)
+
+
 
-        for coin in self.amounts:
-            val = getattr(self.initiator, coin) + self.amounts[coin]*mult
-            setattr(self.initiator, coin, val)
+class DiceExpression:
+    def __init__(self, text, root, dice):
+        self.text = text
+        self.root = root
+        self.dice = dice
 
-        if self.participant.name:
-            for coin in self.amounts:
-                val = getattr(self.participant, coin) - self.amounts[coin]*mult
-                setattr(self.participant, coin, val)
 
+    def evaluate(self):
+        return self.root.evaluate()
 
-    @property
-    def text(self):
-        initiator = self.initiator.name
 
-        if self.mode == 'give':
-            arrow = '->'
-        elif self.mode == 'take':
-            arrow = '<-'
-        else:
-            raise ValueError('Mode should be "give" or "take"')
+    def distribution(self):
+        return self.root.distribution(DiceBudget(ODDS_BUDGET))
 
-        amount = ''
-        for coin in self.amounts:
-            if self.amounts[coin]:
-                amount += str(self.amounts[coin]) + ' ' + coin.upper() + ', '
-        amount = amount[ :-2]
 
-        if not self.reason:
-            reason = 'No reason given'
-        else:
-            reason = self.reason
 
-        participant = self.participant.name
+class DiceParser:
+    #Recursive descent over the grammar
+    #   expression = term (('+' | '-') term)*
+    #   term = factor (('*' | '/') factor)*
+    #   factor = '-' factor | '(' expression ')' | pool | number
+    #   pool = (number) 'd' (number | '%') ('!' | keep (number) | adv | dis)*
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        self.position = 0
+        self.depth = 0
+        self.dice = 0
 
-        return f'{initiator} {arrow} {participant}: {amount} ({reason})'
+        position = 0
+        text = text.lower().rstrip()
+        while position < len(text):
+            match = DICE_TOKEN.match(text, position)
+            if match is None:
+                raise DiceError('Unexpected "{0}".'.format(
+                    text[position:].strip()[:10]))
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
 
 
+    def parse(self):
+        root = self.expression()
+        if self.peek()[0] is not None:
+            raise DiceError('Unexpected "{0}".'.format(self.peek()[1]))
+        return DiceExpression(self.text, root, self.dice)
 
-class DatabaseManager:
-    def __init__(self):
-        self.campaigns = [int(id) for id in os.listdir('data')]
-        self.locks = {int(id): asyncio.Lock() for id in os.listdir('data')}
-        self.cache = {}
 
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
 
-    async def add_campaign(self, campaign):
-        if campaign.id in self.campaigns:
-            raise FileExistsError('Campaign with this ID already exists')
 
-        logging.info('Created {0}'.format(campaign.id))
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise DiceError('The expression ends too early.')
+        self.position += 1
+        return token
 
-        self.campaigns.append(campaign.id)
-        self.locks[campaign.id] = asyncio.Lock()
 
-        await self.locks[campaign.id].acquire()
-        await self.save_campaign(campaign)
+    def number(self):
+        kind, value = self.take()
+        if kind != 'number':
+            raise DiceError('Expected a number but found "{0}".'.format(value))
+        return int(value)
 
 
-    async def del_campaign(self, id):
-        os.remove('data/{0}'.format(id))
-        self.campaigns.remove(id)
-        self.locks.pop(id)
-        if id in self.cache:
-            self.cache.pop(id)
+    def expression(self):
+        node = self.term()
+        while self.peek() in (('symbol', '+'), ('symbol', '-')):
+            operator = self.take()[1]
+            node = DiceOperation(operator, node, self.term())
+        return node
 
-        logging.info('Successfully deleted {0}'.format(id))
 
+    def term(self):
+        node = self.factor()
+        while self.peek() in (('symbol', '*'), ('symbol', '/')):
+            operator = self.take()[1]
+            node = DiceOperation(operator, node, self.factor())
+        return node
 
-    async def load_campaign(self, id, blocking = False):
-        await self.locks[id].acquire()
 
-        if id not in self.cache:
-            logging.info('Reading {0}'.format(id))
-            try:
-                with open('data/{0}'.format(id), 'rb') as file:
-                    campaign = pickle.load(file)
-            except FileNotFoundError:
-                return None
-            self.cache[id] = campaign
-            while len(self.cache) > 100:
-                self.cache.pop(self.cache.keys()[0])
+    def factor(self):
+        kind, value = self.peek()
+        if (kind, value) == ('symbol', '-'):
+            self.take()
+            return DiceNegation(self.factor())
+
+        if (kind, value) == ('symbol', '('):
+            self.take()
+            self.depth += 1
+            if self.depth > DICE_DEPTH:
+                raise DiceError('Too many nested parentheses.')
+            node = self.expression()
+            if self.take() != ('symbol', ')'):
+                raise DiceError('Unbalanced parentheses.')
+            self.depth -= 1
+            return DiceGroup(node)
+
+        if kind == 'dice':
+            return self.pool(1)
 
-        if not blocking:
-            self.locks[id].release()
+        if kind == 'number':
+            number = self.number()
+            if self.peek()[0] == 'dice':
+                return self.pool(number)
+            return DiceConstant(number)
+
+        self.take()
+        raise DiceError('Unexpected "{0}".'.format(value))
+
+
+    def pool(self, count):
+        if self.take()[1] == 'd%':
+            sides = 100
         else:
-            logging.info('Acquired lock for {0}'.format(id))
-
-        return self.cache[id]
+            sides = self.number()
+        if count < 1 or sides < 1:
+            raise DiceError('Dice need a positive number and sides.')
+        if sides > MAX_SIDES:
+            raise DiceError('Dice can have at most {0} sides.'.format(
+                MAX_SIDES))
+        pool = DicePool(count, sides)
+
+        while True:
+            kind, value = self.peek()
+            if (kind, value) == ('symbol', '!'):
+                self.take()
+                if sides == 1:
+                    raise DiceError('One-sided dice cannot explode.')
+                pool.explode = True
+            elif kind == 'keep':
+                self.take()
+                if pool.keep:
+                    raise DiceError('Only one keep or drop per roll.')
+                number = 1
+                if self.peek()[0] == 'number':
+                    number = self.number()
+                pool.keep = ('kh' if value == 'k' else value, number)
+            elif kind == 'advantage':
+                self.take()
+                if pool.keep or pool.count != 1:
+                    raise DiceError('Only a single die can be rolled with '
+                                    'advantage or disadvantage.')
+                pool.count = 2
+                pool.keep = ('kh' if value == 'adv' else 'kl', 1)
+            else:
+                break
+
+        self.dice += pool.count
+        if self.dice > MAX_DICE:
+            raise DiceError('At most {0} dice can be rolled at once.'.format(
+                MAX_DICE))
+        return pool
+
+
+@functools.lru_cache(maxsize = DICE_CACHE)
+def compile_dice(text):
+    if len(text) > DICE_LENGTH:
+        raise DiceError('Expressions are limited to {0} characters.'.format(
+            DICE_LENGTH))
+    return DiceParser(text).parse()
+
+
+
+class DiceBudget:
+    def __init__(self, limit):
+        self.limit = limit
+
+
+    def spend(self, cost, span = 0):
+        self.limit -= cost
+        if self.limit < 0 or span > ODDS_SPAN:
+            raise DiceError('The roll is too large to compute odds for.')
+
+
+
+class DiceOdds:
+    #Distributions are (lowest total, probabilities) pairs, where
+    #probabilities[index] is the chance of rolling lowest + index.
+    def __init__(self, text, lowest, probabilities):
+        self.text = text
+        self.lowest = lowest
+        self.probabilities = array.array('d', probabilities)
+        self.highest = lowest + len(probabilities) - 1
+        self.mean = sum((lowest + index)*probability
+                        for index, probability in enumerate(probabilities))
+        self.variance = sum((lowest + index - self.mean)**2*probability
+                            for index, probability in enumerate(probabilities))
+
+
+    def percentile(self, fraction):
+        total = 0.0
+        for index, probability in enumerate(self.probabilities):
+            total += probability
+            if total >= fraction - ODDS_EPSILON:
+                return self.lowest + index
+        return self.highest
+
+
+    def chance(self, comparison, target):
+        tests = {
+            '>=': lambda total: total >= target,
+            '<=': lambda total: total <= target,
+            '>': lambda total: total > target,
+            '<': lambda total: total < target,
+            '=': lambda total: total == target,
+        }
+        test = tests[comparison]
+        return min(1.0, sum(probability for index, probability
+                            in enumerate(self.probabilities)
+                            if test(self.lowest + index)))
+
+
+def convolve(left, right, budget):
+    span = len(left) + len(right) - 1
+    if numpy is None:
+        budget.spend(len(left)*len(right), span)
+        result = [0.0]*span
+        for offset, weight in enumerate(left):
+            if weight:
+                for index, probability in enumerate(right, offset):
+                    result[index] += weight*probability
+        return result
+
+    budget.spend(span, span) #Vectorized work is cheap next to the loop above.
+    if min(len(left), len(right)) < FFT_LENGTH:
+        return numpy.convolve(left, right).tolist()
+    result = numpy.fft.irfft(numpy.fft.rfft(left, span)*
+                             numpy.fft.rfft(right, span), span)
+    return numpy.clip(result, 0, None).tolist() #FFT noise can dip below zero.
+
+
+def add_distributions(left, right, budget):
+    return left[0] + right[0], convolve(left[1], right[1], budget)
+
+
+def negate_distribution(distribution):
+    lowest, probabilities = distribution
+    return -(lowest + len(probabilities) - 1), probabilities[::-1]
+
+
+def power_distribution(die, count, budget):
+    #Sums count independent copies of die by repeated squaring.
+    result = 0, [1.0]
+    while count:
+        if count & 1:
+            result = add_distributions(result, die, budget)
+        count >>= 1
+        if count:
+            die = add_distributions(die, die, budget)
+    return result
+
+
+def explode_distribution(sides, budget):
+    #Each maximum roll adds another die until the chance of getting that far
+    #is negligible or the evaluator would stop rerolling anyway.
+    rounds = min(EXPLODE_LIMIT, math.ceil(-math.log(ODDS_EPSILON, sides)))
+    span = sides*(rounds + 1)
+    budget.spend(span, span)
+    probabilities = []
+    for depth in range(rounds + 1):
+        chance = sides**-(depth + 1)
+        probabilities += [chance]*(sides - 1)
+        if depth == rounds:
+            probabilities.append(chance)
+        else:
+            probabilities.append(0.0)
+    return 1, probabilities
+
+
+def keep_distribution(die, count, kept, highest, budget):
+    #Walks the faces from the best kept to the worst, choosing how many of
+    #the remaining dice show each face; the first kept dice placed count.
+    lowest, probabilities = die
+    faces = [(lowest + index, probability)
+             for index, probability in enumerate(probabilities) if probability]
+    if highest:
+        faces.reverse()
+    largest = max(abs(face) for face, _probability in faces)
+    span = 2*kept*largest + 1
+    budget.spend(len(faces)*(count + 1)**2*span, span)
+
+    #states[placed] maps a kept total to its probability.
+    states = [collections.defaultdict(float) for _ in range(count + 1)]
+    states[0][0] = 1.0
+    for face, probability in faces:
+        updated = [collections.defaultdict(float) for _ in range(count + 1)]
+        for placed, totals in enumerate(states):
+            if not totals:
+                continue
+            remaining = count - placed
+            for shown in range(remaining + 1):
+                weight = math.comb(remaining, shown)*probability**shown
+                if not weight:
+                    break
+                gained = face*max(0, min(shown, kept - placed))
+                target = updated[placed + shown]
+                for total, chance in totals.items():
+                    target[total + gained] += chance*weight
+        states = updated
+
+    totals = states[count]
+    low = min(totals)
+    result = [0.0]*(max(totals) - low + 1)
+    for total, chance in totals.items():
+        result[total - low] += chance
+    return low, result
+
+
+def combine_distributions(operator, left, right, budget):
+    budget.spend(len(left[1])*len(right[1]))
+    totals = collections.defaultdict(float)
+    for left_index, left_chance in enumerate(left[1]):
+        if not left_chance:
+            continue
+        for right_index, right_chance in enumerate(right[1]):
+            if not right_chance:
+                continue
+            first = left[0] + left_index
+            second = right[0] + right_index
+            if operator == '*':
+                total = first*second
+            elif second:
+                total = first//second
+            else:
+                raise DiceError('The roll can divide by zero.')
+            totals[total] += left_chance*right_chance
+
+    low = min(totals)
+    span = max(totals) - low + 1
+    budget.spend(span, span)
+    result = [0.0]*span
+    for total, chance in totals.items():
+        result[total - low] = chance
+    return low, result
+
+
+class OddsCache:
+    #Limited by the probabilities held rather than by entries, since one
+    #distribution can be a hundred thousand times the size of another.
+    def __init__(self, limit = ODDS_CACHE):
+        self.entries = collections.OrderedDict()
+        self.limit = limit
+        self.size = 0
+        self.lock = threading.Lock() #Odds are computed on dice_executor.
+
+
+    def get(self, text):
+        with self.lock:
+            odds = self.entries.get(text)
+            if odds is not None:
+                self.entries.move_to_end(text)
+            return odds
+
+
+    def put(self, text, odds):
+        size = len(odds.probabilities)
+        if size > self.limit:
+            return
+        with self.lock:
+            if text in self.entries:
+                return
+            self.entries[text] = odds
+            self.size += size
+            while self.size > self.limit:
+                _text, evicted = self.entries.popitem(last = False)
+                self.size -= len(evicted.probabilities)
 
 
-    async def save_campaign(self, campaign):
-        logging.info('Writing {0}'.format(campaign.id))
-        with open('data/{0}'.format(campaign.id), 'wb') as file:
-            pickle.dump(campaign, file)
-        self.cache[campaign.id] = campaign
-        while len(self.cache) > 10:
-            self.cache.pop(self.cache.keys()[0])
-        self.locks[campaign.id].release()
-        logging.info('Released lock for {0}'.format(campaign.id))
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
 
 
 
-async def parse_indices(ctx, campaign, terms):
-    pending = [transaction for transaction in campaign.pending
-               if ctx.author.id in (transaction.participant.id, *campaign.gms)]
-    terms = [term.strip() for term in terms.split(',')]
-    indices = []
-    if 'last' in terms:
-        indices.append(len(pending) - 1)
-    elif 'all' in terms:
-        indices = [i for i in range(len(pending))]
-    else:
-        for term in terms:
-            term = term.split('-')
-            if len(term) == 1:
-                try:
-                    index = int(term[0]) - 1
-                except ValueError:
-                    await log_syntax_error(ctx)
-                    return None
-                if index < len(pending):
-                    if index not in indices:
-                        indices.append(index)
-                else:
-                    logging.info('Encountered invalid index; aborting.')
-                    await ctx.send('"' + term[0] + '" is an invalid ID.')
-                    return None
-            elif len(term) == 2:
-                try:
-                    start_index = int(term[0]) - 1
-                    end_index = int(term[1]) - 1
-                except ValueError:
-                    await log_syntax_error(ctx)
-                    return None
-                if start_index < end_index:
-                    if start_index >= 0 and end_index < len(pending):
-                        for i in range(start_index, end_index + 1):
-                            if i not in indices:
-                                indices.append(i)
-                    else:
-                        if start_index < 0:
-                            problem = str(start_index + 1)
-                        else:
-                            problem = str(end_index + 1)
-                        logging.info('Encountered invalid index; aborting.')
-                        await ctx.send('"' + problem + '" is an invalid ID.')
-                        return None
-                else:
-                    logging.info('Encountered invalid slice; aborting.')
-                    await ctx.send('Start ID must be lower than end ID.')
-                    return None
-            else:
-                await log_syntax_error(ctx)
-                return None
-    player_index = 0
-    corrected_indices = []
-    for global_index, transaction in enumerate(campaign.pending):
-        if ctx.author.id in (transaction.participant.id, *campaign.gms):
-            if player_index in indices:
-                corrected_indices.append(global_index)
-            player_index += 1
-    corrected_indices.sort()
-    return corrected_indices
-
-
-async def log_syntax_error(ctx):
-    logging.info('Invalid syntax; aborting.')
-    await ctx.send(':x: Invalid syntax. Use `dnd-help [command]` to view info.')
+odds_cache = OddsCache()
+dice_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers = DICE_WORKERS, thread_name_prefix = 'dnd-dice')
 
 
-def convert_to_egp(amounts):
-    return (0.01*amounts['cp'] + 0.1*amounts['sp']
-            + 1*amounts['gp'] + 10*amounts['pp'])
+def dice_odds(text):
+    odds = odds_cache.get(text)
+    if odds is None:
+        lowest, probabilities = compile_dice(text).distribution()
+        odds = DiceOdds(text, lowest, probabilities)
+        odds_cache.put(text, odds)
+    return odds
 
 
-def convert_from_egp(amount, amounts = None):
-    if amounts is None:
-        amounts = {'cp': 0, 'sp': 0, 'gp': 0, 'pp': 0}
-    amounts['gp'] += int(amount)
-    amount = round(10*(amount % 1), 1)
-    amounts['sp'] += int(amount)
-    amount = round(10*(amount % 1))
-    amounts['cp'] += int(amount)
-    return amounts
+async def run_dice(function, *args):
+    #Dice work is pure Python, so it gets a few threads of its own rather
+    #than the loop's unbounded default executor or the storage threads.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(dice_executor, function, *args)
 
 #Internal classes and functions end
 ################################################################################
@@ -315,7 +3552,7 @@ full_desc = ('Usage: dnd-initialize\n\n'
 async def initialize(ctx):
     logging.info('Initializing new campaign in {0}.'.format(ctx.channel.id))
 
-    if os.path.isfile('data/{0}'.format(ctx.channel.id)):
+    if await dbm.has_campaign(ctx.channel.id):
         logging.info('Campaign already exists; aborting.')
         await ctx.send('Campaign already exists in this channel.')
         return
@@ -339,12 +3576,12 @@ full_desc = ('Usage: dnd-delete\n\n'
 async def delete(ctx):
     logging.info('Deleting campaign in {0}.'.format(ctx.channel.id))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('No campaign exists in this channel; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = False)
+    campaign = await channel_campaign(ctx)
 
     if ctx.author.id not in campaign.gms:
         logging.info('Unauthorized use of command; aborting.')
@@ -391,29 +3628,25 @@ full_desc = ('Usage: dnd-register ([user ID]) as [name]\n\n'
              '[name] is case sensitive, and may not contain spaces.')
 
 @bot.command(brief = brief_desc, description = full_desc)
+@optimistic
 async def register(ctx):
     logging.info('Registering new player in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('No campaign exists in this channel; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
     try:
-        arguments = ctx.message.content.split(' ')
-        if arguments[1] == 'as':
-            id = ctx.author.id
-            name = arguments[2]
-        elif arguments[2] == 'as':
-            id = int(arguments[1])
-            name = arguments[3]
-        else:
-            raise IndexError('Invalid syntax')
-    except IndexError:
-        await log_syntax_error(ctx)
+        command = parse_registration(command_arguments(ctx.message.content))
+    except CommandSyntaxError as error:
+        await log_syntax_error(ctx, error)
         return
+    id = ctx.author.id if command.user is None else command.user
+    name = command.name
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = False)
+    campaign = await channel_campaign(ctx)
+    version = campaign.revision
 
     if id in campaign.players:
         name = campaign.players[id].name
@@ -431,12 +3664,8 @@ async def register(ctx):
         await ctx.send('That name is a reserved keyword.')
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = True)
-
-    campaign.players[id] = Player(id, name)
-    campaign.names[name] = id
-
-    await dbm.save_campaign(campaign)
+    async with dbm.commit(campaign, version):
+        campaign.add_player(id, name)
 
     logging.info('Player "{0}" successfully registered.'.format(name))
     await ctx.send('Successfully registered {0}.'.format(name))
@@ -452,29 +3681,25 @@ full_desc = ('Usage: dnd-reregister ([user ID]) as [name]\n\n'
              '[name] is case sensitive, and may not contain spaces.')
 
 @bot.command(brief = brief_desc, description = full_desc)
+@optimistic
 async def reregister(ctx):
     logging.info('Reregistering new player in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('No campaign exists in this channel; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
     try:
-        arguments = ctx.message.content.split(' ')
-        if arguments[1] == 'as':
-            id = ctx.author.id
-            name = arguments[2]
-        elif arguments[2] == 'as':
-            id = int(arguments[1])
-            name = arguments[3]
-        else:
-            raise IndexError('Invalid syntax')
-    except IndexError:
-        await log_syntax_error(ctx)
+        command = parse_registration(command_arguments(ctx.message.content))
+    except CommandSyntaxError as error:
+        await log_syntax_error(ctx, error)
         return
+    id = ctx.author.id if command.user is None else command.user
+    name = command.name
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = False)
+    campaign = await channel_campaign(ctx)
+    version = campaign.revision
 
     if id not in campaign.players:
         logging.info('User is not currently registered; aborting.')
@@ -491,13 +3716,8 @@ async def reregister(ctx):
         await ctx.send('That name is a reserved keyword.')
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = True)
-
-    del campaign.names[campaign.players[id].name]
-    campaign.players[id].name = name
-    campaign.names[name] = id
-    
-    await dbm.save_campaign(campaign)
+    async with dbm.commit(campaign, version):
+        campaign.rename_player(id, name)
 
     logging.info('Player "{0}" successfully reregistered.'.format(name))
     await ctx.send('Successfully reregistered as {0}.'.format(name))
@@ -517,25 +3737,27 @@ full_desc = ('Usage: dnd-convert (as [initiator name]) [amounts]\n\nWithout '
              'conversion to take place in the account of [initiator name]')
 
 @bot.command(brief = brief_desc, description = full_desc)
+@optimistic
 async def convert(ctx):
     logging.info('Performing conversion in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('No campaign exists in this channel; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
     try:
-        arguments = ctx.message.content.split(' ', maxsplit = 1)[1].split(',')
-    except IndexError:
-        await log_syntax_error(ctx)
+        command = parse_convert(command_arguments(ctx.message.content))
+    except CommandSyntaxError as error:
+        await log_syntax_error(ctx, error)
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = False)
+    campaign = await channel_campaign(ctx)
+    version = campaign.revision
 
-    if arguments[0].strip().split(' ', maxsplit = 1)[0] == 'as':
+    if command.initiator is not None:
         if ctx.author.id in campaign.gms:
-            _kw, name, arguments[0] = arguments[0].split(' ', maxsplit = 2)
+            name = command.initiator
             if name in campaign.names:
                 initiator = campaign.players[campaign.names[name]]
             else:
@@ -556,29 +3778,19 @@ async def convert(ctx):
             return
 
     amounts = {'cp': 0, 'sp': 0, 'gp': 0, 'pp': 0}
-    for argument in arguments:
-        try:
-            starting, target_unit = argument.lower().split(' to ')
-            starting_amt, starting_unit = starting.strip().split(' ')
-            starting_amt = int(starting_amt)
-            conv_factor = CONVERSIONS[starting_unit]/CONVERSIONS[target_unit]
-            if not (starting_amt*conv_factor).is_integer():
-                logging.info('Invalid up-conversion; aborting.')
-                await ctx.send('Cannot convert {0} {1} to {2}.'.format(
-                    starting_amt, starting_unit.upper(), target_unit.upper()))
-                return
-            amounts[starting_unit] -= starting_amt
-            amounts[target_unit] += int(starting_amt*conv_factor)
-        except (IndexError, ValueError):
-            await log_syntax_error(ctx)
+    for starting_amt, starting_unit, target_unit in command.conversions:
+        target_amt, remainder = divmod(starting_amt*CONVERSIONS[starting_unit],
+                                       CONVERSIONS[target_unit])
+        if remainder:
+            logging.info('Invalid up-conversion; aborting.')
+            await ctx.send('Cannot convert {0} {1} to {2}.'.format(
+                starting_amt, starting_unit.upper(), target_unit.upper()))
             return
+        amounts[starting_unit] -= starting_amt
+        amounts[target_unit] += target_amt
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = True)
-    
-    transaction = Transaction(initiator, 'take', amounts, None, 'conversion')
-    transaction.complete()
-
-    await dbm.save_campaign(campaign)
+    async with dbm.commit(campaign, version):
+        campaign.convert(initiator, amounts)
 
     logging.info('Conversion successful.')
     await ctx.send('Successfully converted currency.')
@@ -621,41 +3833,27 @@ full_desc = ('Usage: dnd-transact (as [initiator name]) give/take [amounts] '
              'to player2 for buying used scale mail')
 
 @bot.command(brief = brief_desc, description = full_desc)
+@optimistic
 async def transact(ctx):
     logging.info('Attempting transaction in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('Campaign is not initialized; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
-    keywords = {'as', 'give', 'take', 'at', 'to', 'from', 'for'}
-    arguments = ctx.message.content.split(' ')[-1:0:-1]
-    active_kw = arguments.pop()
-
-    if active_kw not in keywords:
-        await log_syntax_error(ctx)
+    try:
+        command = parse_transact(command_arguments(ctx.message.content))
+    except CommandSyntaxError as error:
+        await log_syntax_error(ctx, error)
         return
 
-    parsed_args = {}
-    while arguments:
-        argument = arguments.pop()
-        if active_kw == 'for':
-            parsed_args[active_kw] = argument
-            while arguments:
-                parsed_args[active_kw] += ' ' + arguments.pop()
-        elif argument in keywords:
-            active_kw = argument
-        elif active_kw in parsed_args:
-            parsed_args[active_kw] += ' ' + argument
-        else:
-            parsed_args[active_kw] = argument
-
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = False)
+    campaign = await channel_campaign(ctx)
+    version = campaign.revision
 
-    if 'as' in parsed_args:
+    if command.initiator is not None:
         if ctx.author.id in campaign.gms:
-            name = parsed_args['as']
+            name = command.initiator
             if name in campaign.names:
                 initiator = campaign.players[campaign.names[name]]
             else:
@@ -675,91 +3873,123 @@ async def transact(ctx):
             await ctx.send('You are not registered in this campaign.')
             return
 
-    if 'give' in parsed_args:
-        mode = 'give'
-    elif 'take' in parsed_args:
-        mode = 'take'
+    mode = command.mode
+    amounts = command.amounts
+    if command.offset is not None:
+        copper = apply_offset(convert_to_copper(amounts), command.offset)
+        amounts = convert_from_copper(copper)
+
+    if command.participant is None:
+        participant = None
+    elif command.participant in campaign.names:
+        participant = campaign.players[campaign.names[command.participant]]
     else:
-        await log_syntax_error(ctx)
+        logging.info('Invalid participant name; aborting.')
+        await ctx.send('No player with name "{0}"'.format(command.participant)
+                       + ' exists in this campaign.')
         return
 
-    amounts = {'cp': 0, 'sp': 0, 'gp': 0, 'pp': 0}
-    intake = [term.strip() for term in parsed_args[mode].split(',')]
-    for term in intake:
-        term = term.split(' ')
-        try:
-            amount = float(term[0])
-        except ValueError:
-            await log_syntax_error(ctx)
-            return
-        if term[1].lower() in amounts:
-            amounts[term[1].lower()] += int(amount)
-        elif term[1].lower() == 'egp':
-            convert_from_egp(amount, amounts)
-        else:
-            await log_syntax_error(ctx)
-            return
+    reason = command.reason
 
-    if 'at' in parsed_args:
-        intake = parsed_args['at']
-        try:
-            amount = int(intake[1:-1])
-        except ValueError:
-            await log_syntax_error(ctx)
-            return
-        if intake[0] == '+':
-            mult = 1
-        elif intake[0] == '-':
-            mult = -1
-        else:
-            await log_syntax_error(ctx)
-            return
-        egp_eq = convert_to_egp(amounts)
-        egp_eq = egp_eq*(1 + 0.01*amount*mult)
-        amounts = convert_from_egp(egp_eq)
-
-    if 'to' in parsed_args:
-        if mode == 'give':
-            intake = parsed_args['to']
-            participant = True
-        else:
-            await log_syntax_error(ctx)
-            return
-    elif 'from' in parsed_args:
-        if mode == 'take':
-            intake = parsed_args['from']
-            participant = True
-        else:
-            await log_syntax_error(ctx)
-            return
-    else:
-        participant = False
+    async with dbm.commit(campaign, version):
+        campaign.add_transaction(Transaction(initiator, mode, amounts,
+                                             participant, reason))
 
-    if participant:
-        if intake in campaign.names:
-            participant = campaign.players[campaign.names[intake]]
-        else:
-            logging.info('Invalid participant name; aborting.')
-            await ctx.send('No player with name "{0}"'.format(initiator)
-                           + ' exists in this campaign.')
-            return
-    else:
-        participant = None
+    logging.info('Successfully added transaction to queue.')
+    await ctx.send('Transaction recorded; waiting for approval.')
 
-    if 'for' in parsed_args:
-        reason = parsed_args['for']
-    else:
-        reason = None
+################################################################################
+
+brief_desc = 'Add many transactions at once'
+full_desc = ('Usage: dnd-bulk (approve)\n[lines]\n\n'
+             'Add a transaction for every following line of the message and '
+             'for every entry of any attached file, all at once. Only the GM '
+             'may use this command. Each line takes the same arguments as '
+             'dnd-transact, such as "as player1 give 5 gp to player2 for '
+             'rope". A line may instead split an amount evenly between '
+             'players, as in "split 100 egp among all for loot" or "split 30 '
+             'gp among player1, player2 from player3". Shares differ by at '
+             'most one copper.\n\nAttached files may be CSV with a header '
+             'row or a JSON list. Their columns or keys are named after the '
+             'dnd-transact keywords (as, give, take, at, to, from, for), and '
+             'JSON lists may also hold plain lines.\n\nIf any line is '
+             'invalid, nothing is added. With "approve", the transactions are '
+             'approved immediately instead of waiting in the queue.')
+
+@bot.command(brief = brief_desc, description = full_desc)
+@optimistic
+async def bulk(ctx):
+    logging.info('Adding bulk transactions in #{0}.'.format(ctx.channel.name))
+
+    if not await dbm.has_campaign(ctx.channel.id):
+        logging.info('Campaign is not initialized; aborting.')
+        await ctx.send('No campaign exists in this channel.')
+        return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = True)
+    campaign = await channel_campaign(ctx)
+    version = campaign.revision
 
-    transaction = Transaction(initiator, mode, amounts, participant, reason)
-    campaign.add_transaction(transaction)
+    if ctx.author.id not in campaign.gms:
+        logging.info('Unauthorized bulk transaction; aborting.')
+        await ctx.send('Only the GM can add bulk transactions.')
+        return
 
-    await dbm.save_campaign(campaign)
+    lines = command_arguments(ctx.message.content).split('\n')
+    approve = lines[0].strip() == 'approve'
+    if approve:
+        lines.pop(0)
+    try:
+        for attachment in ctx.message.attachments:
+            if attachment.size > BULK_BYTES:
+                raise CommandSyntaxError('{0} is too large.'.format(
+                    attachment.filename))
+            lines += bulk_lines(await attachment.read(), attachment.filename)
+    except CommandSyntaxError as error:
+        await log_syntax_error(ctx, error)
+        return
+    lines = [(number, line.strip()) for number, line in enumerate(lines, 1)
+             if line.strip()]
 
-    logging.info('Successfully added transaction to queue.')
-    await ctx.send('Transaction recorded; waiting for approval.')
+    transactions = []
+    errors = []
+    for number, line in lines:
+        try:
+            transactions += bulk_transactions(campaign, ctx.author.id, line)
+        except CommandError as error:
+            errors.append('Line {0}: {1}'.format(number, error))
+
+    if errors:
+        logging.info('Invalid bulk transactions; aborting.')
+        msg = 'Nothing was added:\n' + '\n'.join(errors[:BULK_ERRORS])
+        if len(errors) > BULK_ERRORS:
+            msg += '\n...and {0} more.'.format(len(errors) - BULK_ERRORS)
+        await ctx.send(msg)
+        return
+
+    if not transactions:
+        await log_syntax_error(ctx)
+        return
+
+    if len(transactions) > BULK_LIMIT:
+        logging.info('Too many bulk transactions; aborting.')
+        await ctx.send('At most {0} transactions can be added at once.'.format(
+            BULK_LIMIT))
+        return
+
+    async with dbm.commit(campaign, version):
+        first = campaign.next_transaction
+        for transaction in transactions:
+            campaign.add_transaction(transaction)
+        if approve:
+            campaign.approve(range(first, campaign.next_transaction))
+
+    logging.info('Successfully added bulk transactions.')
+    if approve:
+        await ctx.send('{0} transaction(s) recorded and approved.'.format(
+            len(transactions)))
+    else:
+        await ctx.send('{0} transaction(s) recorded; waiting for approval.'
+                       .format(len(transactions)))
 
 ################################################################################
 
@@ -768,33 +3998,32 @@ full_desc = ('Usage: dnd-pending\n\n'
              'Show all transactions that can be approved by the user calling '
              'this command. Note that only the participant in the transaction '
              '(not the initiator) can approve pending transactions, with only '
-             'the GM being able to view (and approve) all transactions.')
+             'the GM being able to view (and approve) all transactions. Long '
+             'lists are sent as a text file.')
 
 @bot.command(brief = brief_desc, description = full_desc)
 async def pending(ctx):
     logging.info('Displaying pending in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('Campaign is not initialized; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id)
+    campaign = await channel_campaign(ctx)
 
-    msg = ''
-    id = 1
-    for transaction in campaign.pending:
-        if ctx.author.id in (transaction.participant.id, *campaign.gms):
-            msg += str(id) + ': `' + transaction.text + '`\n'
-            id += 1
-    msg = msg[ :-1]
-
-    if not msg:
+    visible = campaign.pending.visible(ctx.author.id,
+                                       ctx.author.id in campaign.gms)
+
+    if not visible:
         logging.info('No pending transactions.')
         await ctx.send('You have no pending transactions.')
     else:
         logging.info('Transactions successfully displayed.')
-        await ctx.send('Pending transactions:\n' + msg)
+        await send_listing(ctx, 'Pending transactions:',
+                           (('{0}: '.format(id), transaction.text)
+                            for id, transaction in enumerate(visible, 1)),
+                           'pending.txt')
 
 ################################################################################
 
@@ -811,34 +4040,30 @@ full_desc = ('Usage: dnd-approve [IDs and slices]\n\n'
              'additionally add the respective transactions to the list.')
 
 @bot.command(brief = brief_desc, description = full_desc)
+@optimistic
 async def approve(ctx):
     logging.info('Approving transactions in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('Campaign is not initialized; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = False)
+    campaign = await channel_campaign(ctx)
+    version = campaign.revision
 
-    try:
-        terms = ctx.message.content.split(' ', 1)[1].strip()
-        approved_indices = await parse_indices(ctx, campaign, terms)
-    except IndexError:
-        await log_syntax_error(ctx)
-        return
+    terms = command_arguments(ctx.message.content)
+    approved_ids = await parse_indices(ctx, campaign, terms)
 
-    if approved_indices is None:
+    if approved_ids is None:
         return
-    elif not approved_indices:
+    elif not approved_ids:
         logging.info('No accessible transactions; aborting.')
         await ctx.send('Invalid indicies or no pending transactions.')
+        return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = True)
-
-    campaign.approve(approved_indices)
-
-    await dbm.save_campaign(campaign)
+    async with dbm.commit(campaign, version):
+        campaign.approve(approved_ids)
 
     logging.info('Successfully approved transactions.')
     await ctx.send('Transaction(s) successfully approved.')
@@ -858,30 +4083,30 @@ full_desc = ('Usage: dnd-deny [IDs and slices]\n\n'
              'additionally add the respective transactions to the list.')
 
 @bot.command(brief = brief_desc, description = full_desc)
+@optimistic
 async def deny(ctx):
     logging.info('Denying transactions in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('Campaign is not initialized; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = False)
+    campaign = await channel_campaign(ctx)
+    version = campaign.revision
 
-    terms = ctx.message.content.split(' ', 1)[1].strip()
-    denied_indices = await parse_indices(ctx, campaign, terms)
+    terms = command_arguments(ctx.message.content)
+    denied_ids = await parse_indices(ctx, campaign, terms)
 
-    if denied_indices is None:
+    if denied_ids is None:
         return
-    elif not denied_indices:
+    elif not denied_ids:
         logging.info('No accessible transactions; aborting.')
         await ctx.send('Invalid indicies or no pending transactions.')
+        return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = True)
-
-    campaign.deny(denied_indices)
-
-    await dbm.save_campaign(campaign)
+    async with dbm.commit(campaign, version):
+        campaign.deny(denied_ids)
 
     logging.info('Successfully denied transactions.')
     await ctx.send('Transaction(s) denied.')
@@ -889,38 +4114,42 @@ async def deny(ctx):
 ################################################################################
 
 brief_desc = 'View the account balance of a user'
-full_desc = ('Usage: dnd-balance (of [name])\n\n'
+full_desc = ('Usage: dnd-balance (of [name]) (at [date or #number])\n\n'
              'Show the balance in the account of a player. Only the GM may use '
              'the optional (of [name]) argument. When this argument is not '
              'supplied, the balance of the user calling the command is shown.'
              '\n\nIf the keyword "all" is supplied instead of a player name,'
-             'the balances of all registered players is displayed.')
+             'the balances of all registered players is displayed, as a text '
+             'file if there are too many to fit in a few messages.\n\n'
+             'The optional (at [date or #number]) argument shows the EGP value '
+             'of the balance as it was at the end of a day, written as '
+             'YYYY-MM-DD, or a minute, written as YYYY-MM-DDTHH:MM (both UTC), '
+             'or right after the transaction with that number in '
+             'dnd-history, with #0 being before any were approved.')
 
 @bot.command(brief = brief_desc, description = full_desc)
 async def balance(ctx):
     logging.info('Displaying balance in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('Campaign is not initialized; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id)
+    campaign = await channel_campaign(ctx)
 
-    arguments = ctx.message.content.split(' ')
-    if len(arguments) > 1:
-        try:
-            if arguments[1] == 'of':
-                if ctx.author.id in campaign.gms:
-                    target = arguments[2]
-                else:
-                    logging.info('Unauthorized use of "of"; aborting.')
-                    await ctx.send('You are not authorized to use "of".')
-                    return
-            else:
-                raise IndexError('Invalid syntax')
-        except IndexError:
-            await log_syntax_error(ctx)
+    try:
+        command = parse_balance(command_arguments(ctx.message.content))
+    except CommandSyntaxError as error:
+        await log_syntax_error(ctx, error)
+        return
+
+    if command.target is not None:
+        if ctx.author.id in campaign.gms:
+            target = command.target
+        else:
+            logging.info('Unauthorized use of "of"; aborting.')
+            await ctx.send('You are not authorized to use "of".')
             return
     elif ctx.author.id in campaign.players:
         target = campaign.players[ctx.author.id].name
@@ -929,93 +4158,215 @@ async def balance(ctx):
         await ctx.send('You are not registered in this campaign.')
         return
 
-    if target == 'all':
-        msg = ''
-        for id in campaign.players:
-            msg += '`' + campaign.players[id].name + ': '
-            msg += campaign.players[id].balance + '`\n'
-    elif target in campaign.names:
-        msg = '`' + campaign.players[campaign.names[target]].balance + '`'
-    else:
+    if target != 'all' and target not in campaign.names:
         logging.info('Invalid participant name; aborting.')
         await ctx.send('No player with name "{0}"'.format(target)
                        + ' exists in this campaign.')
         return
 
+    if command.moment is not None:
+        if command.row is not None and command.row > len(campaign.archive):
+            logging.info('Invalid transaction number; aborting.')
+            await ctx.send('Only {0} transaction(s) have been approved.'.format(
+                len(campaign.archive)))
+            return
+        #Replayed on another thread from a copy, as for dnd-history, keeping
+        #any checkpoints that had to be filled in on the way.
+        view = campaign.view()
+        row, balances = await dbm.run_io(functools.partial(
+            view.past_balances, command.row, command.until))
+        campaign.archive.adopt(view.archive.checkpoints)
+        if command.until is not None:
+            when = ' as of {0} (after transaction #{1})'.format(
+                command.moment, row)
+        elif row:
+            when = ' after transaction #{0}'.format(row)
+        else:
+            when = ' before any transactions were approved'
+        balance = lambda player: '{0} EGP'.format(
+            format_egp(balances.get(player.id, 0)))
+    else:
+        when = ''
+        balance = lambda player: player.balance
+
+    if target == 'all':
+        logging.info('Successfully displayed balance of all.')
+        await send_listing(ctx, 'Account balance for all{0}:'.format(when),
+                           (('', player.name + ': ' + balance(player))
+                            for player in campaign.players.values()),
+                           'balances.txt')
+        return
+    msg = '`' + balance(campaign.players[campaign.names[target]]) + '`'
+
     logging.info('Successfully displayed balance of {0}.'.format(target))
-    await ctx.send('Account balance for {0}:\n'.format(target) + msg)
+    await ctx.send('Account balance for {0}{1}:\n'.format(target, when) + msg)
 
 ################################################################################
 
-brief_desc = 'Roll dice of the given type and quantity'
-full_desc = ('Usage: dnd-roll ([number])d[sides](+[offset])\n\n'
-             'Roll [number] [sides]-sided dice with a [offset] roll modifier. '
-             'Only the [sides] argument is required, but all values must be '
-             'positive integers. For example, "dnd-roll 4d8+3" is valid.')
+brief_desc = 'Check player balances against the transaction history'
+full_desc = ('Usage: dnd-audit (of [name])\n\n'
+             'Recompute the EGP value of each player\'s account from the '
+             'approved transaction history and report any account whose '
+             'balance does not match. Only the GM may use this command. When '
+             'the optional (of [name]) argument is supplied, only that player '
+             'is checked.')
 
 @bot.command(brief = brief_desc, description = full_desc)
-async def roll(ctx):
-    logging.info('Rolling dice in #{0}.'.format(ctx.channel.name))
+async def audit(ctx):
+    logging.info('Auditing balances in #{0}.'.format(ctx.channel.name))
 
-    try:
-        intake = ctx.message.content.split(' ')[1]
-    except IndexError:
-        await log_syntax_error(ctx)
+    if not await dbm.has_campaign(ctx.channel.id):
+        logging.info('Campaign is not initialized; aborting.')
+        await ctx.send('No campaign exists in this channel.')
         return
 
-    if len(intake.split('d')) != 2:
-        await log_syntax_error()
+    campaign = await channel_campaign(ctx)
+
+    if ctx.author.id not in campaign.gms:
+        logging.info('Unauthorized use of command; aborting.')
+        await ctx.send('Only the GM can audit balances.')
         return
 
-    rolls = intake.split('d')[0]
-    if rolls:
-        try:
-            rolls = int(rolls)
-        except ValueError:
-            logging.info('Invalid roll number; aborting.')
-            await ctx.send('"{0}" is an invalid number of rolls.'.format(rolls))
+    arguments = ctx.message.content.split()
+    if len(arguments) == 1:
+        players = list(campaign.players.values())
+    elif len(arguments) == 3 and arguments[1] == 'of':
+        if arguments[2] not in campaign.names:
+            logging.info('Invalid participant name; aborting.')
+            await ctx.send('No player with name "{0}"'.format(arguments[2])
+                           + ' exists in this campaign.')
             return
+        players = [campaign.players[campaign.names[arguments[2]]]]
     else:
-        rolls = 1
+        await log_syntax_error(ctx)
+        return
 
-    sides = intake.split('d')[1].split('+')[0]
-    try:
-        sides = int(sides)
-    except ValueError:
-        logging.info('Invalid roll sides; aborting.')
-        await ctx.send('"{0}" is an invalid number of sides.'.format(rolls))
+    #The history is read on another thread, from a copy that matches the
+    #balances taken alongside it.
+    recorded = {player.id: player.copper for player in players}
+    expected = await dbm.run_io(campaign.view().audit_balances)
+
+    msg = ''
+    for player in players:
+        if expected[player.id] != recorded[player.id]:
+            msg += '`{0}: {1} EGP recorded, {2} EGP in history`\n'.format(
+                player.name, format_egp(recorded[player.id]),
+                format_egp(expected[player.id]))
+
+    logging.info('Audited {0} players.'.format(len(players)))
+    if msg:
+        await ctx.send('Mismatched balances:\n' + msg)
+    else:
+        await ctx.send('All audited balances match the history.')
+
+################################################################################
+
+brief_desc = 'Show how the bot is performing'
+full_desc = ('Usage: dnd-stats\n\n'
+             'Show command counts and latencies, lock waits, cache use and the '
+             'storage traffic of this campaign since the bot started. Only the '
+             'GM may use this command. Latencies are the upper bounds of '
+             'histogram buckets, so they are approximate.')
+
+@bot.command(brief = brief_desc, description = full_desc)
+async def stats(ctx):
+    logging.info('Displaying stats in #{0}.'.format(ctx.channel.name))
+
+    if not await dbm.has_campaign(ctx.channel.id):
+        logging.info('Campaign is not initialized; aborting.')
+        await ctx.send('No campaign exists in this channel.')
         return
 
-    try:
-        offset = int(intake.split('d')[1].split('+')[1])
-    except IndexError:
-        offset = 0
-    except ValueError:
-        logging.info('Invalid roll offset; aborting.')
-        await ctx.send('"{0}" is an invalid offset.'.format(rolls))
+    campaign = await channel_campaign(ctx)
+
+    if ctx.author.id not in campaign.gms:
+        logging.info('Unauthorized stats request; aborting.')
+        await ctx.send('Only the GM can view stats.')
         return
 
-    if rolls <= 100:
-        results = [1 + random.randrange(sides) for _ in range(rolls)]
-    else:
-        try:
-            mu = rolls*(sides + 1)/2
-            sigma = math.sqrt(rolls*(sides**2 - 1)/12)
-        except OverflowError:
-            logging.info('Overflow during calculation; aborting')
-            await ctx.send('The number of rolls or sides is too large.')
-            return
-        result = round(random.gauss(mu, sigma))
-        result = min(result, rolls*sides)
-        result = max(result, rolls)
-        results = [result]
+    def milliseconds(name, fraction, **labels):
+        bound = metrics.quantile(name, fraction, **labels)
+        if bound is None:
+            return '>{0:g}'.format(1000*metrics.buckets[-1])
+        return '{0:g}'.format(1000*bound)
+
+    metrics.collect()
+    msg = 'Command latency (count, p50 ms, p95 ms):\n'
+    names = sorted(labels['command'] for labels
+                   in metrics.labelled('dnd_command_seconds'))
+    for name in names:
+        msg += '`{0}: {1} | {2} | {3}`\n'.format(
+            name, metrics.count('dnd_command_seconds', command = name),
+            milliseconds('dnd_command_seconds', 0.5, command = name),
+            milliseconds('dnd_command_seconds', 0.95, command = name))
+    if not names:
+        msg += '`No commands yet`\n'
+
+    hits = metrics.value('dnd_cache_hits_total')
+    lookups = hits + metrics.value('dnd_cache_misses_total')
+    msg += ('Locks: `{0} acquired | {1} contended | {2} timed out | '
+            'p95 wait {3} ms | {4} rollbacks`\n').format(
+        metrics.count('dnd_lock_wait_seconds'),
+        metrics.value('dnd_lock_contended_total'),
+        metrics.value('dnd_lock_timeouts_total'),
+        milliseconds('dnd_lock_wait_seconds', 0.95),
+        metrics.value('dnd_rollbacks_total'))
+    msg += 'Cache: `{0:.1%} hits | {1} evictions | {2} campaigns`\n'.format(
+        hits/lookups if lookups else 0,
+        metrics.value('dnd_cache_evictions_total'),
+        metrics.value('dnd_cache_campaigns'))
+    msg += ('Queue: `{0} waiting | {1} rate limited | '
+            '{2} turned away`\n').format(
+        metrics.value('dnd_queue_depth'),
+        sum(metrics.value('dnd_commands_rejected_total', reason = reason)
+            for reason in ('user', 'channel')),
+        sum(metrics.value('dnd_commands_rejected_total', reason = reason)
+            for reason in ('queue', 'timeout')))
+    msg += 'This campaign: `{0} bytes read | {1} bytes written`'.format(
+        metrics.value('dnd_storage_read_bytes_total', campaign = campaign.id),
+        metrics.value('dnd_storage_written_bytes_total',
+                      campaign = campaign.id))
+
+    logging.info('Stats successfully displayed.')
+    await ctx.send(msg)
+
+################################################################################
+
+brief_desc = 'Roll dice using a dice expression'
+full_desc = ('Usage: dnd-roll [expression]\n\n'
+             'Roll the dice described by [expression] and show each die. '
+             'Expressions combine dice such as "4d6" or "d20" and numbers '
+             'with +, -, *, / (rounding down) and parentheses. Dice can be '
+             'followed by "kh[n]" or "kl[n]" to keep the highest or lowest '
+             '[n] dice, "dh[n]" or "dl[n]" to drop them, "!" to roll again '
+             'on the highest result, and a single die by "adv" or "dis" to '
+             'roll with advantage or disadvantage. "d%" is a hundred-sided '
+             'die. For example, "dnd-roll 4d6kh3 + 2d8 - 1" is valid.')
+
+@bot.command(brief = brief_desc, description = full_desc)
+async def roll(ctx):
+    logging.info('Rolling dice in #{0}.'.format(ctx.channel.name))
 
-    final = sum(results) + offset
+    try:
+        intake = ctx.message.content.split(' ', 1)[1].strip()
+    except IndexError:
+        intake = None
+    if not intake:
+        await log_syntax_error(ctx)
+        return
 
-    breakdown = ' + '.join(str(result) for result in results)
-    breakdown = '||({0}) + {1}||'.format(breakdown, offset)
+    try:
+        expression = compile_dice(intake)
+        if expression.dice > BREAKDOWN_DICE:
+            final, breakdown = await run_dice(expression.evaluate)
+        else:
+            final, breakdown = expression.evaluate()
+    except DiceError as error:
+        logging.info('Invalid dice expression; aborting.')
+        await ctx.send('"{0}" cannot be rolled: {1}'.format(intake, error))
+        return
 
-    msg = 'Rolled {0}: **{1}**\n{2}'.format(intake, final, breakdown)
+    msg = 'Rolled {0}: **{1}**\n||{2}||'.format(intake, final, breakdown)
     if len(msg) >= 2000:
         msg = 'Roll result: {0}'.format(final)
         if len(msg) >= 2000:
@@ -1025,26 +4376,175 @@ async def roll(ctx):
 
 ################################################################################
 
+brief_desc = 'Show the odds of a dice expression'
+full_desc = ('Usage: dnd-odds [expression] ([comparison] [target])\n\n'
+             'Compute the exact distribution of [expression], written as for '
+             'dnd-roll, and show its mean, standard deviation and '
+             'percentiles. A [comparison] of >=, <=, >, < or = against a '
+             '[target] total also shows the chance of that outcome. For '
+             'example, "dnd-odds 3d6+4 >= 15" is valid. Very large rolls '
+             'are refused rather than approximated.')
+
+@bot.command(brief = brief_desc, description = full_desc)
+async def odds(ctx):
+    logging.info('Computing odds in #{0}.'.format(ctx.channel.name))
+
+    try:
+        intake = ctx.message.content.split(' ', 1)[1].strip()
+    except IndexError:
+        intake = None
+    if not intake:
+        await log_syntax_error(ctx)
+        return
+
+    comparison = None
+    match = ODDS_TARGET.match(intake)
+    if match:
+        intake = match.group('expression')
+        comparison = match.group('comparison')
+        target = int(match.group('target'))
+
+    try:
+        result = await run_dice(dice_odds, intake)
+    except DiceError as error:
+        logging.info('Invalid dice expression; aborting.')
+        await ctx.send('Cannot compute odds for "{0}": {1}'.format(intake,
+                                                                  error))
+        return
+
+    msg = 'Odds for {0}:\n`Mean {1:.2f} | Std dev {2:.2f} | Range {3} to {4}`'
+    msg = msg.format(intake, result.mean, math.sqrt(result.variance),
+                     result.lowest, result.highest)
+    percentiles = ' | '.join('{0}% {1}'.format(percent,
+                             result.percentile(percent/100))
+                             for percent in (5, 25, 50, 75, 95))
+    msg += '\n`Percentiles: {0}`'.format(percentiles)
+    if comparison:
+        msg += '\n`Chance of {0} {1}: {2:.2%}`'.format(
+            comparison, target, result.chance(comparison, target))
+    if len(result.probabilities) <= ODDS_ROWS:
+        lines = ['{0:>4}: {1:>7.2%}'.format(result.lowest + index, probability)
+                 for index, probability in enumerate(result.probabilities)]
+        msg += '\n```\n{0}\n```'.format('\n'.join(lines))
+
+    await ctx.send(msg)
+
+################################################################################
+
 brief_desc = 'Export the transaction history of this campaign'
-full_desc = ('Usage: dnd-history\n\n'
-             'Export the campaign transaction history as a .csv file. ')
+full_desc = ('Usage: dnd-history (of [name]) (from [date]) (until [date]) '
+             '(rows [first]-[last]) (gzip)\n'
+             '       dnd-history page ([number])\n\n'
+             'Export the campaign transaction history as a .csv file, or show '
+             'one page of it with "page". Pages hold {0} transactions each, '
+             'oldest first, and the last page is shown if [number] is left '
+             'out.\n\n'.format(HISTORY_ROWS) +
+             'The optional (of [name]) argument limits the export to '
+             'transactions involving [name]. The optional (from [date]) and '
+             '(until [date]) arguments limit it to transactions approved '
+             'between the given dates, inclusive, written as YYYY-MM-DD (UTC). '
+             'The optional (rows [first]-[last]) argument limits it to the '
+             'given rows of the full history. Adding "gzip" compresses the '
+             'file, which is useful for very long campaigns.')
 
 @bot.command(brief = brief_desc, description = full_desc)
 async def history(ctx):
     logging.info('Exporting history in #{0}.'.format(ctx.channel.name))
 
-    if ctx.channel.id not in dbm.campaigns:
+    if not await dbm.has_campaign(ctx.channel.id):
         logging.info('No campaign exists in this channel; aborting.')
         await ctx.send('No campaign exists in this channel.')
         return
 
-    campaign = await dbm.load_campaign(ctx.channel.id, blocking = False)
+    campaign = await channel_campaign(ctx)
+    #Pages are read on another thread, from a copy taken while nothing else
+    #can be changing the archive.
+    campaign = campaign.view()
+
+    filters = {}
+    compress = False
+    arguments = ctx.message.content.split()[1:]
+
+    if arguments[:1] == ['page']:
+        pages = max(1, -(-len(campaign.archive) // HISTORY_ROWS))
+        try:
+            number = int(arguments[1]) if len(arguments) > 1 else pages
+        except ValueError:
+            number = None
+        if len(arguments) > 2 or number is None:
+            await log_syntax_error(ctx)
+            return
+        if not 0 < number <= pages:
+            logging.info('Invalid history page; aborting.')
+            await ctx.send('There are only {0} page(s) of history.'.format(
+                pages))
+            return
+        if not campaign.archive:
+            logging.info('No archived transactions.')
+            await ctx.send('No transactions have been approved yet.')
+            return
+
+        first = (number - 1)*HISTORY_ROWS
+        rows = await dbm.run_io(lambda: list(
+            campaign.archive.rows(first, first + HISTORY_ROWS)))
+        msg = 'History page {0} of {1}:'.format(number, pages)
+        for row_number, row in enumerate(rows, first + 1):
+            transaction = campaign.archived(row)
+            text = transaction.text
+            if len(text) > 70: #Keeps a full page within one message.
+                text = text[:67] + '...'
+            msg += '\n{0}: `{1}`'.format(row_number, text)
+            if transaction.time is not None:
+                msg += ' ' + datetime.datetime.fromtimestamp(
+                    transaction.time, datetime.timezone.utc).strftime(
+                        '%Y-%m-%d')
+
+        logging.info('History page successfully displayed.')
+        await ctx.send(msg)
+        return
+    try:
+        while arguments:
+            keyword = arguments.pop(0)
+            if keyword == 'gzip':
+                compress = True
+            elif keyword == 'of':
+                name = arguments.pop(0)
+                if name not in campaign.names:
+                    logging.info('Invalid participant name; aborting.')
+                    await ctx.send('No player with name "{0}"'.format(name)
+                                   + ' exists in this campaign.')
+                    return
+                filters['player'] = campaign.names[name]
+            elif keyword in ('from', 'until'):
+                day = datetime.datetime.strptime(arguments.pop(0), '%Y-%m-%d')
+                day = day.replace(tzinfo = datetime.timezone.utc)
+                if keyword == 'from':
+                    filters['start'] = day.timestamp()
+                else:
+                    filters['end'] = (day + datetime.timedelta(days = 1)
+                                      ).timestamp()
+            elif keyword == 'rows':
+                first, last = (int(row) for row in
+                               arguments.pop(0).split('-'))
+                if not 0 < first <= last:
+                    raise ValueError('Invalid row range')
+                filters['rows'] = (first, last)
+            else:
+                raise ValueError('Invalid keyword')
+    except (IndexError, ValueError):
+        await log_syntax_error(ctx)
+        return
 
-    csv = Campaign.to_csv(campaign)
+    file = tempfile.SpooledTemporaryFile(max_size = CSV_SPOOL)
+    await dbm.run_io(functools.partial(campaign.export_csv, file, compress,
+                                       **filters))
+    file.seek(0)
     name = '{0}.csv'.format(ctx.channel.name)
+    if compress:
+        name += '.gz'
 
     logging.info('Generated history for #{0}.'.format(ctx.channel.name))
-    await ctx.send(file=discord.File(io.StringIO(csv), name))
+    await ctx.send(file = discord.File(file, name))
 
 #Commands end
 ################################################################################
@@ -1055,11 +4555,26 @@ async def on_message(message):
     if message.author == bot.user:
         return
 
-    await bot.process_commands(message)
+    await scheduler.submit(message)
 
 
 @bot.event
 async def on_command_error(ctx, error):
+    original = getattr(error, 'original', error)
+    if isinstance(original, MissingCampaign):
+        logging.info('Campaign was deleted elsewhere; aborting.')
+        await ctx.send('No campaign exists in this channel.')
+        return
+    command = ctx.command.name if ctx.command is not None else 'unknown'
+    metrics.increment('dnd_command_errors_total', command = command)
+    if isinstance(original, LockTimeout):
+        logging.warning('Lock timeout in {0}'.format(ctx.message.content))
+        await ctx.send('This campaign is busy; please try again shortly.')
+        return
+    if isinstance(original, VersionConflict):
+        logging.warning('Version conflict in {0}'.format(ctx.message.content))
+        await ctx.send('This campaign is busy; please try again shortly.')
+        return
     logging.error('Error in {0}: {1}"'.format(ctx.message.content, error))
     await ctx.send('Error processing command. Use `dnd-help` to view help.')
 
@@ -1096,7 +4611,21 @@ if __name__ == '__main__':
     else:
         logging.info("Token acquired from code.")
 
-    dbm = DatabaseManager()
-    logging.info('{0} existing campaigns loaded.'.format(len(dbm.campaigns)))
+    backend = storage_backend()
+    logging.info('Using {0} storage backend.'.format(
+        os.environ.get('DND_STORAGE', 'file')))
+
+    if bot.shard_count is not None:
+        logging.info('Running shard {0} of {1}.'.format(bot.shard_id,
+                                                        bot.shard_count))
+    shared = bot.shard_count is not None or 'DND_SHARED' in os.environ
+
+    durability = os.environ.get('DND_DURABILITY', DURABILITY)
+    dbm = DatabaseManager(backend, durability = durability, shared = shared)
+
+    if 'DND_METRICS_PORT' in os.environ:
+        host = os.environ.get('DND_METRICS_HOST', METRICS_HOST)
+        port = int(os.environ['DND_METRICS_PORT'])
+        bot.loop.create_task(serve_metrics(host, port))
 
     bot.run(token)
@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+import dnd_bot
+from benchmark import (PLAYER_BASE, FakeAuthor, FakeChannel, FakeContext,
+                       FakeMessage, build_campaign, make_backend)
+
+#Relative frequency of each command in synthetic traces.
+COMMAND_MIX = {'transact': 40, 'balance': 20, 'roll': 15, 'pending': 10,
+               'approve': 8, 'deny': 3, 'history': 4}
+
+################################################################################
+#Traces start
+
+def user_id(channel, index):
+    #Every simulated channel has its own players, and its GM is the user
+    #after the last player.
+    return channel*PLAYER_BASE + index
+
+
+def synthetic_trace(args):
+    rng = random.Random(args.seed)
+    channels = list(range(1, args.channels + 1))
+    #A few busy channels and a long tail of quiet ones.
+    weights = [1/rank**args.skew for rank in range(1, len(channels) + 1)]
+    names = list(COMMAND_MIX)
+    mix = list(COMMAND_MIX.values())
+    trace = []
+    for index in range(args.messages):
+        channel = rng.choices(channels, weights)[0]
+        name = rng.choices(names, mix)[0]
+        player = rng.randrange(args.players)
+        author = user_id(channel, player)
+        text = ''
+        if name == 'transact':
+            if args.players > 1 and rng.random() < 0.5:
+                other = (player + rng.randrange(1, args.players)) % args.players
+                text = 'give {0} gp to player{1} for trade'.format(
+                    rng.randint(1, 20), other)
+            else:
+                text = 'take {0} sp for loot'.format(rng.randint(1, 50))
+        elif name in ('approve', 'deny'):
+            author = user_id(channel, args.players)
+            text = '1-5' if name == 'approve' else '1'
+        elif name == 'balance' and rng.random() < 0.1:
+            author = user_id(channel, args.players)
+            text = 'of all'
+        elif name == 'roll':
+            text = rng.choice(('d20+5', '4d6kh3', '8d6', 'd20adv'))
+        elif name == 'history':
+            text = 'page 1' if rng.random() < 0.8 else ''
+        content = 'dnd-' + name + (' ' + text if text else '')
+        trace.append({'time': index/args.rate, 'channel': channel,
+                      'author': author, 'content': content})
+    return trace
+
+
+def read_trace(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_trace(path, trace):
+    with open(path, 'w') as file:
+        for entry in trace:
+            file.write(json.dumps(entry) + '\n')
+
+#Traces end
+################################################################################
+#Replay start
+
+class Replay:
+    def __init__(self, args):
+        self.args = args
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.completed = 0
+
+
+    async def run(self, entry, arrived):
+        #Latency runs from when the message arrived to when the handler
+        #returned, so it includes any time spent queued.
+        content = entry['content']
+        name = content.split(None, 1)[0][len(dnd_bot.bot.command_prefix):]
+        command = dnd_bot.bot.get_command(name)
+        if command is None:
+            self.errors['unknown command ' + name] += 1
+            return
+        ctx = FakeContext(content, entry['author'], entry['channel'])
+        try:
+            await command.callback(ctx)
+        except Exception as error:
+            self.errors[type(error).__name__] += 1
+            return
+        self.latencies[name].append(time.perf_counter() - arrived)
+        self.completed += 1
+
+
+    async def replay(self, trace):
+        start = time.perf_counter()
+        if self.args.scheduler:
+            await self.through_scheduler(trace, start)
+        else:
+            await self.direct(trace, start)
+        return time.perf_counter() - start
+
+
+    async def arrive(self, entry, start):
+        if self.args.speed:
+            delay = start + entry['time']/self.args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return time.perf_counter()
+
+
+    async def direct(self, trace, start):
+        slots = asyncio.Semaphore(self.args.concurrency)
+        tasks = []
+
+        async def run(entry, arrived):
+            try:
+                await self.run(entry, arrived)
+            finally:
+                slots.release()
+
+        for entry in trace:
+            arrived = await self.arrive(entry, start)
+            await slots.acquire()
+            tasks.append(asyncio.ensure_future(run(entry, arrived)))
+        await asyncio.gather(*tasks)
+
+
+    async def through_scheduler(self, trace, start):
+        async def process(message):
+            await self.run(message.entry, message.arrived)
+
+        scheduler = dnd_bot.CommandScheduler(process,
+                                             workers = self.args.concurrency)
+        channels = {}
+        for entry in trace:
+            arrived = await self.arrive(entry, start)
+            channel = channels.get(entry['channel'])
+            if channel is None:
+                channel = channels[entry['channel']] = FakeChannel(
+                    entry['channel'])
+            message = FakeMessage(entry['content'],
+                                  FakeAuthor(entry['author']), channel)
+            message.entry = entry
+            message.arrived = arrived
+            await scheduler.submit(message)
+        if scheduler.queue is not None:
+            await scheduler.queue.join()
+        await scheduler.close()
+
+#Replay end
+################################################################################
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(fraction*len(samples)))]
+
+
+def directory_size(path):
+    files = 0
+    size = 0
+    for root, _dirs, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def total(metrics, name):
+    #Sum of a counter over all of its labels.
+    return sum(value for (metric, _labels), value in metrics.values.items()
+               if metric == name)
+
+
+def summarize(replay, elapsed, messages, path):
+    metrics = dnd_bot.metrics
+    metrics.collect()
+    commands = {}
+    for name, samples in sorted(replay.latencies.items()):
+        samples.sort()
+        commands[name] = {
+            'count': len(samples),
+            'p50_ms': 1000*percentile(samples, 0.50),
+            'p95_ms': 1000*percentile(samples, 0.95),
+            'p99_ms': 1000*percentile(samples, 0.99),
+            'max_ms': 1000*samples[-1],
+        }
+    samples = sorted(sample for latencies in replay.latencies.values()
+                     for sample in latencies)
+    files, size = directory_size(path)
+    wait = metrics.quantile('dnd_lock_wait_seconds', 0.95)
+    return {
+        'messages': messages,
+        'completed': replay.completed,
+        'seconds': elapsed,
+        'messages_per_sec': messages/elapsed if elapsed else float('inf'),
+        'p50_ms': 1000*percentile(samples, 0.50) if samples else None,
+        'p99_ms': 1000*percentile(samples, 0.99) if samples else None,
+        'commands': commands,
+        'locks_acquired': metrics.count('dnd_lock_wait_seconds'),
+        'locks_contended': metrics.value('dnd_lock_contended_total'),
+        'lock_timeouts': metrics.value('dnd_lock_timeouts_total'),
+        'lock_wait_p95_ms': None if wait is None else 1000*wait,
+        'commit_conflicts': metrics.value('dnd_commit_conflicts_total'),
+        'command_retries': total(metrics, 'dnd_command_retries_total'),
+        'rollbacks': metrics.value('dnd_rollbacks_total'),
+        'writes': metrics.count('dnd_storage_seconds', operation = 'write'),
+        'written_bytes': total(metrics, 'dnd_storage_written_bytes_total'),
+        'files': files,
+        'stored_bytes': size,
+        'rate_limited': sum(metrics.value('dnd_commands_rejected_total',
+                                          reason = reason)
+                            for reason in ('user', 'channel')),
+        'turned_away': sum(metrics.value('dnd_commands_rejected_total',
+                                         reason = reason)
+                           for reason in ('queue', 'timeout')),
+        'errors': dict(replay.errors),
+        'leaked_locks': sorted(dnd_bot.dbm.held),
+    }
+
+
+def report(summary, scheduler):
+    print('Replayed {0} messages in {1:.2f} s ({2:.1f} messages/s), {3} '
+          'completed.'.format(summary['messages'], summary['seconds'],
+                              summary['messages_per_sec'],
+                              summary['completed']))
+    print('{0:<12} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9}'.format(
+        'command', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name, command in summary['commands'].items():
+        print('{0:<12} {1:>7} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}'.format(
+            name, command['count'], command['p50_ms'], command['p95_ms'],
+            command['p99_ms'], command['max_ms']))
+
+    wait = summary['lock_wait_p95_ms']
+    print('Locks: {0} acquired | {1} contended | {2} timed out | p95 wait '
+          '{3} ms'.format(summary['locks_acquired'], summary['locks_contended'],
+                          summary['lock_timeouts'],
+                          '>10000' if wait is None else '{0:g}'.format(wait)))
+    print('Commits: {0} conflicts | {1} retries | {2} rollbacks'.format(
+        summary['commit_conflicts'], summary['command_retries'],
+        summary['rollbacks']))
+    print('Storage: {0} writes | {1:.1f} KiB written | {2} files, {3:.1f} KiB '
+          'stored'.format(summary['writes'], summary['written_bytes']/1024,
+                          summary['files'], summary['stored_bytes']/1024))
+    if scheduler:
+        print('Scheduler: {0} rate limited | {1} turned away'.format(
+            summary['rate_limited'], summary['turned_away']))
+    print('Errors: {0}'.format(', '.join(
+        '{0} x{1}'.format(name, count) for name, count
+        in sorted(summary['errors'].items())) or 'none'))
+    print('Leaked locks: {0}'.format(', '.join(
+        map(str, summary['leaked_locks'])) or 'none'))
+
+
+async def run(args, trace, path):
+    backend = make_backend(args.backend, path)
+    dnd_bot.dbm = dnd_bot.DatabaseManager(backend, durability = args.durability,
+                                          shared = args.shared)
+    for channel in sorted({entry['channel'] for entry in trace}):
+        campaign = build_campaign(channel, args.players, args.pending,
+                                  args.archive, seed = channel,
+                                  gm = user_id(channel, args.players),
+                                  player_base = user_id(channel, 0))
+        await dnd_bot.dbm.add_campaign(campaign)
+    #Only the replay itself should show up in the numbers.
+    dnd_bot.metrics.values.clear()
+    dnd_bot.metrics.histograms.clear()
+
+    replay = Replay(args)
+    elapsed = await replay.replay(trace)
+    await dnd_bot.dbm.close()
+    return summarize(replay, elapsed, len(trace), path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Replay command traces through the bot\'s handlers '
+                      'without Discord.')
+    parser.add_argument('--trace', help = 'JSON lines trace to replay, each '
+                        'with time, channel, author and content')
+    parser.add_argument('--save-trace', help = 'write the replayed trace here')
+    parser.add_argument('--messages', type = int, default = 5000)
+    parser.add_argument('--channels', type = int, default = 20)
+    parser.add_argument('--skew', type = float, default = 1.0,
+                        help = 'how much busier the first channels are')
+    parser.add_argument('--rate', type = float, default = 200.0,
+                        help = 'messages per second in synthetic traces')
+    parser.add_argument('--speed', type = float, default = 0.0,
+                        help = 'replay at this multiple of the trace\'s own '
+                        'timing; 0 replays as fast as possible')
+    parser.add_argument('--concurrency', type = int, default = 50,
+                        help = 'commands in flight, or scheduler workers')
+    parser.add_argument('--scheduler', action = 'store_true',
+                        help = 'admit messages through the command scheduler, '
+                        'best combined with --speed')
+    parser.add_argument('--players', type = int, default = 8)
+    parser.add_argument('--pending', type = int, default = 20)
+    parser.add_argument('--archive', type = int, default = 500)
+    parser.add_argument('--backend', choices = ('file', 'sqlite'),
+                        default = 'file')
+    parser.add_argument('--durability', choices = ('sync', 'write',
+                                                   'deferred'),
+                        default = dnd_bot.DURABILITY)
+    parser.add_argument('--shared', action = 'store_true',
+                        help = 'lock and revalidate as shard processes do')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--json', help = 'write the summary to this file')
+    args = parser.parse_args()
+    if not 0 < args.players < PLAYER_BASE:
+        parser.error('--players must be between 1 and {0}'.format(
+            PLAYER_BASE - 1))
+
+    logging.disable(logging.WARNING) #Turned away commands are expected.
+    random.seed(args.seed)
+    trace = read_trace(args.trace) if args.trace else synthetic_trace(args)
+    if args.save_trace:
+        write_trace(args.save_trace, trace)
+
+    with tempfile.TemporaryDirectory() as path:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            summary = asyncio.run(run(args, trace, path))
+        finally:
+            os.chdir(cwd)
+    report(summary, args.scheduler)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'args': vars(args), 'summary': summary}, file,
+                      indent = 2)
+    if summary['errors'] or summary['leaked_locks']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
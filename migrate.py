@@ -0,0 +1,32 @@
+import sys
+
+from dnd_bot import DATA_DIR, DATABASE, FileBackend, SQLiteBackend
+
+def main():
+    source = FileBackend(sys.argv[1] if len(sys.argv) > 1 else DATA_DIR)
+    target = SQLiteBackend(sys.argv[2] if len(sys.argv) > 2 else DATABASE)
+    existing = set(target.list_campaigns())
+
+    migrated = 0
+    for id in source.list_campaigns():
+        if id in existing:
+            print(f'Skipping {id}: already in {target.path}.')
+            continue
+        try:
+            campaign, _size = source.read(id)
+        except EOFError:
+            print(f'Skipping {id}: file is empty.')
+            continue
+        conn = target.connect()
+        with conn:
+            target.write_campaign(conn, campaign)
+        migrated += 1
+        print(f'Migrated {id}: {len(campaign.players)} players, '
+              f'{len(campaign.pending)} pending, '
+              f'{len(campaign.archive)} archived.')
+
+    print(f'{migrated} campaigns migrated to {target.path}.')
+
+
+if __name__ == '__main__':
+    main()
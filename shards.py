@@ -0,0 +1,47 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+def start(shard, count):
+    env = dict(os.environ, DND_SHARD_ID = str(shard),
+               DND_SHARD_COUNT = str(count))
+    #Every shard serves its own metrics, on consecutive ports.
+    if 'DND_METRICS_PORT' in os.environ:
+        env['DND_METRICS_PORT'] = str(int(os.environ['DND_METRICS_PORT'])
+                                      + shard)
+    return subprocess.Popen([sys.executable, 'dnd_bot.py'], env = env,
+                            stdin = subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Run the bot as several gateway shards sharing storage.')
+    parser.add_argument('count', type = int, help = 'number of shards')
+    args = parser.parse_args()
+
+    if os.environ.get('DND_DURABILITY') == 'deferred':
+        sys.exit('Shards cannot use deferred durability.')
+
+    processes = [start(shard, args.count) for shard in range(args.count)]
+    print(f'Started {args.count} shards.')
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+        for shard, process in enumerate(processes):
+            if process.returncode is not None:
+                print(f'Shard {shard} exited with {process.returncode}; '
+                      'stopping the others.')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
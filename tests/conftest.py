@@ -0,0 +1,42 @@
+import pickle
+import sys
+
+import pytest
+
+import dnd_bot
+
+LEGACY_CLASSES = ('Campaign', 'Player', 'Transaction')
+
+
+@pytest.fixture
+def legacy_campaign(monkeypatch, tmp_path):
+    #Writes data/1 the way the bot did when it ran as a script: a pickle of
+    #a campaign with list pending and archive, whose classes are stored as
+    #part of __main__.
+    campaign = dnd_bot.Campaign(1, 100)
+    campaign.add_player(10, 'Alice')
+    campaign.add_player(11, 'Bob')
+    alice, bob = campaign.players[10], campaign.players[11]
+    approved = dnd_bot.Transaction(alice, 'give', (0, 0, 3, 0), bob, 'rent')
+    approved.time = 1700000000.0
+    alice.adjust(approved.coins, approved.copper, -1)
+    bob.adjust(approved.coins, approved.copper, 1)
+    waiting = dnd_bot.Transaction(bob, 'take', (0, 5, 0, 0), None, 'loot')
+    campaign.archive = [approved]
+    campaign.pending = [waiting]
+    del campaign.next_transaction
+    campaign.journal = []
+
+    main = sys.modules['__main__']
+    with monkeypatch.context() as patch:
+        for name in LEGACY_CLASSES:
+            cls = getattr(dnd_bot, name)
+            patch.setattr(cls, '__module__', '__main__')
+            patch.setattr(main, name, cls, raising = False)
+        data = pickle.dumps(campaign)
+    assert b'__main__' in data
+
+    directory = tmp_path/'data'
+    directory.mkdir()
+    (directory/'1').write_bytes(data)
+    return directory
@@ -0,0 +1,47 @@
+import pytest
+
+import add_gm
+from dnd_bot import Campaign, FileBackend, SQLiteBackend
+
+
+def run_add_gm(monkeypatch, campaign, gm):
+    answers = iter([str(campaign), str(gm)])
+    monkeypatch.setattr('builtins.input', lambda _prompt: next(answers))
+    add_gm.main()
+
+
+def test_adds_gm_to_pickles_written_by_the_bot_as_a_script(
+        legacy_campaign, monkeypatch):
+    monkeypatch.chdir(legacy_campaign.parent)
+    monkeypatch.delenv('DND_STORAGE', raising = False)
+    monkeypatch.delenv('DND_DATA', raising = False)
+    run_add_gm(monkeypatch, 1, 200)
+
+    campaign, _size = FileBackend(str(legacy_campaign)).read(1)
+    assert campaign.gms == [100, 200]
+    assert campaign.names == {'Alice': 10, 'Bob': 11}
+    assert campaign.audit_balances() == {10: -300, 11: 300}
+
+
+@pytest.mark.parametrize('storage', ['file', 'sqlite'])
+def test_adds_gm_to_configured_storage(storage, monkeypatch, tmp_path):
+    if storage == 'sqlite':
+        path = str(tmp_path/'bot.db')
+        monkeypatch.setenv('DND_DATABASE', path)
+        backend = SQLiteBackend(path)
+    else:
+        path = str(tmp_path/'campaigns')
+        (tmp_path/'campaigns').mkdir()
+        monkeypatch.setenv('DND_DATA', path)
+        backend = FileBackend(path)
+    monkeypatch.setenv('DND_STORAGE', storage)
+    campaign = Campaign(1, 100)
+    campaign.record(('register', 10, 'Alice'))
+    backend.save(campaign, campaign.journal)
+    run_add_gm(monkeypatch, 1, 200)
+    run_add_gm(monkeypatch, 1, 200)
+
+    reader = SQLiteBackend(path) if storage == 'sqlite' else FileBackend(path)
+    stored, _size = reader.read(1)
+    assert stored.gms == [100, 200]
+    assert stored.revision == campaign.revision + 1
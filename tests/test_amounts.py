@@ -0,0 +1,26 @@
+import pytest
+
+from dnd_bot import CommandSyntaxError, convert_to_copper, parse_amounts
+
+
+@pytest.mark.parametrize('text, copper', [
+    ('2.34 egp', 234),
+    ('2.3 egp', 230),
+    ('2. egp', 200),
+    ('.05 EGP', 5),
+    ('-1.5 egp', -150),
+    ('1 gp, 2.01 egp', 301),
+])
+def test_egp_amounts_keep_every_copper(text, copper):
+    assert convert_to_copper(parse_amounts(text)) == copper
+
+
+@pytest.mark.parametrize('text', ['2.345 egp', '2.340 egp', '.001 egp'])
+def test_egp_amounts_with_more_than_two_decimals_are_rejected(text):
+    with pytest.raises(CommandSyntaxError):
+        parse_amounts(text)
+
+
+def test_only_egp_amounts_may_have_decimals():
+    with pytest.raises(CommandSyntaxError):
+        parse_amounts('2.5 gp')
@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from dnd_bot import (ARCHIVE_PAGE, CHECKPOINT_ROWS, MODES, Campaign,
+                     FileBackend, settle)
+
+PLAYERS = range(10, 15)
+ROWS = 2*ARCHIVE_PAGE + CHECKPOINT_ROWS + 17
+LEGACY_ROWS = CHECKPOINT_ROWS + 40 #Rows approved before times were kept.
+STOPS = [0, 1, CHECKPOINT_ROWS - 1, CHECKPOINT_ROWS, CHECKPOINT_ROWS + 1,
+         ARCHIVE_PAGE - 1, ARCHIVE_PAGE, ARCHIVE_PAGE + 1, 2*ARCHIVE_PAGE,
+         ROWS - 1, ROWS]
+
+
+def build_campaign():
+    generator = random.Random(3)
+    campaign = Campaign(1, 100)
+    for id in PLAYERS:
+        campaign.apply(('register', id, 'Player {0}'.format(id)))
+    timestamp = 1700000000.0
+    while len(campaign.archive) < ROWS:
+        ids = []
+        for _ in range(min(generator.randint(1, 40),
+                           ROWS - len(campaign.archive))):
+            initiator, participant = generator.sample(PLAYERS, 2)
+            coins = (generator.randint(0, 99), 0, generator.randint(-5, 50), 0)
+            ids.append(campaign.next_transaction)
+            campaign.apply(('transact', initiator, generator.choice(MODES),
+                            coins, generator.choice([participant, None]), 'r',
+                            campaign.next_transaction))
+        timestamp += generator.randint(1, 5000)
+        legacy = len(campaign.archive) < LEGACY_ROWS
+        campaign.apply(('approve_ids', tuple(ids),
+                        None if legacy else timestamp))
+    campaign.journal = []
+    return campaign
+
+
+@pytest.fixture
+def archive(tmp_path):
+    #Read back from storage, so that all but the tail comes from sealed
+    #pages.
+    backend = FileBackend(str(tmp_path))
+    backend.save(build_campaign(), [])
+    campaign, _size = backend.read(1)
+    assert len(campaign.archive.index) == 2
+    return campaign.archive
+
+
+def replayed(archive, stop):
+    balances = {}
+    for row in list(archive.rows())[:stop]:
+        settle(balances, row)
+    return balances
+
+
+def position(archive, timestamp):
+    return sum(1 for row in archive.rows()
+               if row[-1] is None or row[-1] < timestamp)
+
+
+@pytest.mark.parametrize('checkpoints', [True, False])
+def test_balances_at_matches_replay(archive, checkpoints):
+    if not checkpoints:
+        archive.checkpoints = []
+    stops = STOPS + random.Random(5).sample(range(ROWS), 20)
+    for stop in stops:
+        assert archive.balances_at(stop) == replayed(archive, stop), stop
+    assert len(archive.checkpoints) == ROWS // CHECKPOINT_ROWS
+
+
+@pytest.mark.parametrize('checkpoints', [True, False])
+def test_position_before_matches_replay(archive, checkpoints):
+    if not checkpoints:
+        archive.checkpoints = []
+    times = [row[-1] for row in archive.rows() if row[-1] is not None]
+    assert times
+    boundaries = [time for time, _balances in archive.checkpoints]
+    tests = [0, times[0], times[0] + 0.5, times[-1], times[-1] + 1]
+    tests += [time for time in boundaries if time is not None]
+    tests += random.Random(7).sample(times, 20)
+    for timestamp in tests:
+        assert archive.position_before(timestamp) == \
+            position(archive, timestamp), timestamp
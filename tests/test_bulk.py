@@ -0,0 +1,36 @@
+import pytest
+
+from dnd_bot import Campaign, CommandError, bulk_transactions
+
+
+@pytest.fixture
+def campaign():
+    campaign = Campaign(1, 100)
+    for id, name in enumerate(('Alice', 'Bob', 'Carl'), 10):
+        campaign.add_player(id, name)
+    return campaign
+
+
+def shares(transactions):
+    return [(transaction.initiator.name, transaction.copper)
+            for transaction in transactions]
+
+
+def test_split_leaves_out_shares_that_round_to_nothing(campaign):
+    transactions = bulk_transactions(
+        campaign, 100, 'split 1 cp among Alice, Bob, Carl from Bob')
+    assert shares(transactions) == [('Alice', 1)]
+
+
+def test_split_of_nothing_but_empty_shares_is_rejected(campaign):
+    with pytest.raises(CommandError):
+        bulk_transactions(campaign, 100, 'split 0 cp among Alice, Bob, Carl')
+    with pytest.raises(CommandError):
+        bulk_transactions(campaign, 100,
+                          'split 1 cp among Bob, Carl from Bob')
+
+
+def test_split_spreads_the_spare_copper(campaign):
+    transactions = bulk_transactions(campaign, 100,
+                                     'split 1 gp among Alice, Bob, Carl')
+    assert shares(transactions) == [('Alice', 34), ('Bob', 33), ('Carl', 33)]
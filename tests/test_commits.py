@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+import dnd_bot
+from benchmark import FakeContext, GM_ID
+from dnd_bot import Campaign, DatabaseManager, FileBackend, Transaction
+
+COMMANDS = 10
+
+
+class CountingBackend(FileBackend):
+    def __init__(self, path):
+        super().__init__(path)
+        self.saves = 0
+        self.failures = 0
+
+
+    def save(self, campaign, entries):
+        self.saves += 1
+        if self.failures:
+            self.failures -= 1
+            raise OSError('Disk full')
+        return super().save(campaign, entries)
+
+
+
+async def start(path, monkeypatch):
+    backend = CountingBackend(str(path))
+    dbm = DatabaseManager(backend, durability = 'write')
+    campaign = Campaign(1, GM_ID)
+    campaign.add_player(GM_ID, 'Alice')
+    campaign.journal = []
+    await dbm.add_campaign(campaign)
+    backend.saves = 0
+    monkeypatch.setattr(dnd_bot, 'dbm', dbm, raising = False)
+    return dbm, backend
+
+
+def test_write_through_commits_share_writes(monkeypatch, tmp_path):
+    async def run():
+        dbm, backend = await start(tmp_path, monkeypatch)
+        conflicts = dbm.metrics.value('dnd_commit_conflicts_total')
+        command = dnd_bot.bot.get_command('transact')
+        contexts = [FakeContext('dnd-transact take {0} cp'.format(i + 1))
+                    for i in range(COMMANDS)]
+        await asyncio.gather(*(command.callback(ctx) for ctx in contexts))
+
+        assert all(ctx.sent for ctx in contexts)
+        assert backend.saves < COMMANDS
+        assert dbm.metrics.value('dnd_commit_conflicts_total') == conflicts
+        assert not dbm.held and not dbm.writes
+        campaign = dbm.cached(1)
+        stored, _size = FileBackend(str(tmp_path)).read(1)
+        assert stored.revision == campaign.revision
+        assert len(stored.pending) == len(campaign.pending) == COMMANDS
+        await dbm.close()
+
+    asyncio.run(run())
+
+
+def test_failed_write_reaches_every_command(monkeypatch, tmp_path):
+    async def run():
+        dbm, backend = await start(tmp_path, monkeypatch)
+        backend.failures = 1
+
+        async def save(coins):
+            async with dbm.edit(1) as campaign:
+                campaign.add_transaction(Transaction(
+                    campaign.players[GM_ID], 'take', coins, None, 'loot'))
+
+        results = await asyncio.gather(save((1, 0, 0, 0)), save((2, 0, 0, 0)),
+                                       return_exceptions = True)
+        assert [type(result) for result in results] == [OSError, OSError]
+        assert not dbm.held and not dbm.writes
+        #The entries stay in the journal for the next write.
+        await save((3, 0, 0, 0))
+        stored, _size = FileBackend(str(tmp_path)).read(1)
+        assert len(stored.pending) == 3
+        await dbm.close()
+
+    asyncio.run(run())
+
+
+def test_queued_write_skips_deleted_campaign(monkeypatch, tmp_path):
+    async def run():
+        dbm, backend = await start(tmp_path, monkeypatch)
+        async with dbm.edit(1) as campaign:
+            deleting = asyncio.ensure_future(dbm.del_campaign(1))
+            await asyncio.sleep(0)
+            campaign.add_transaction(Transaction(
+                campaign.players[GM_ID], 'take', (1, 0, 0, 0), None, 'loot'))
+        await deleting
+
+        assert backend.saves == 0
+        assert not backend.exists(1)
+        assert not (tmp_path/'1.journal').exists()
+        await dbm.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('error, message', [
+    (dnd_bot.LockTimeout('Campaign 1 is busy'), 'Lock timeout'),
+    (dnd_bot.VersionConflict('Campaign 1 changed'), 'Version conflict')])
+def test_busy_errors_are_logged_apart(error, message, caplog):
+    ctx = FakeContext('dnd-transact take 5 gp')
+    ctx.command = dnd_bot.bot.get_command('transact')
+    asyncio.run(dnd_bot.on_command_error(ctx, error))
+    assert ctx.sent == ['This campaign is busy; please try again shortly.']
+    assert [record.getMessage() for record in caplog.records] == \
+        ['{0} in dnd-transact take 5 gp'.format(message)]
@@ -0,0 +1,56 @@
+import tracemalloc
+
+import pytest
+
+import dnd_bot
+from dnd_bot import DiceBudget, DiceError, DicePool
+
+
+def test_huge_die_is_rejected_by_the_parser():
+    with pytest.raises(DiceError):
+        dnd_bot.compile_dice('d1000000000')
+    with pytest.raises(DiceError):
+        dnd_bot.dice_odds('d1000000000')
+
+
+@pytest.mark.parametrize('explode', [False, True])
+def test_huge_die_odds_are_refused_without_allocating(explode):
+    pool = DicePool(1, 10**9)
+    pool.explode = explode
+    tracemalloc.start()
+    try:
+        with pytest.raises(DiceError):
+            pool.distribution(DiceBudget(dnd_bot.ODDS_BUDGET))
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 1024*1024
+
+
+def test_largest_die_still_rolls():
+    total, _text = dnd_bot.compile_dice(
+        'd{0}'.format(dnd_bot.MAX_SIDES)).evaluate()
+    assert 1 <= total <= dnd_bot.MAX_SIDES
+
+
+def test_odds_are_stored_compactly():
+    odds = dnd_bot.dice_odds('3d6')
+    assert odds.probabilities.typecode == 'd'
+    assert odds.probabilities[0] == pytest.approx(1/216)
+
+
+def test_odds_cache_is_limited_by_probabilities():
+    cache = dnd_bot.OddsCache(limit = 100)
+    for sides in (40, 40, 30):
+        cache.put('d{0}'.format(sides), dnd_bot.DiceOdds('', 1,
+                                                         [1/sides]*sides))
+    cache.put('2d20', dnd_bot.dice_odds('2d20'))
+    assert cache.size <= 100
+    assert list(cache.entries) == ['d30', '2d20']
+    cache.put('d101', dnd_bot.DiceOdds('', 1, [1/101]*101))
+    assert cache.get('d101') is None
+
+
+def test_odds_refuse_distributions_wider_than_the_span():
+    with pytest.raises(DiceError):
+        dnd_bot.dice_odds('d{0}'.format(dnd_bot.ODDS_SPAN + 1))
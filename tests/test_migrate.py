@@ -0,0 +1,26 @@
+import migrate
+from dnd_bot import FileBackend, SQLiteBackend
+
+
+def test_migrates_pickles_written_by_the_bot_as_a_script(
+        legacy_campaign, monkeypatch, tmp_path):
+    database = str(tmp_path/'campaigns.db')
+    monkeypatch.setattr('sys.argv', ['migrate.py', str(legacy_campaign),
+                                     database])
+    migrate.main()
+
+    campaign, _size = SQLiteBackend(database).read(1)
+    assert campaign.gms == [100]
+    assert campaign.names == {'Alice': 10, 'Bob': 11}
+    assert campaign.players[10].copper == -300
+    assert campaign.players[11].copper == 300
+    assert [transaction.reason for transaction in campaign.pending] == ['loot']
+    assert list(campaign.archive.rows()) == [
+        (10, 'give', 11, 0, 0, 3, 0, 'rent', 1700000000.0)]
+
+
+def test_file_backend_reads_pickles_written_by_the_bot_as_a_script(
+        legacy_campaign):
+    campaign, _size = FileBackend(str(legacy_campaign)).read(1)
+    assert campaign.names == {'Alice': 10, 'Bob': 11}
+    assert campaign.audit_balances() == {10: -300, 11: 300}
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+import dnd_bot
+from benchmark import FakeContext, GM_ID
+from dnd_bot import Campaign, DatabaseManager, FileBackend, MissingCampaign
+
+
+@pytest.mark.parametrize('content', ['dnd-balance of all',
+                                     'dnd-transact take 5 gp'])
+def test_campaign_deleted_by_another_process(content, monkeypatch, tmp_path):
+    async def run():
+        ours = DatabaseManager(FileBackend(str(tmp_path)), shared = True)
+        theirs = DatabaseManager(FileBackend(str(tmp_path)), shared = True)
+        campaign = Campaign(1, GM_ID)
+        campaign.add_player(GM_ID, 'Alice')
+        campaign.journal = []
+        await ours.add_campaign(campaign)
+        await theirs.del_campaign(1)
+
+        monkeypatch.setattr(dnd_bot, 'dbm', ours, raising = False)
+        command = dnd_bot.bot.get_command(content.split()[0][4:])
+        ctx = FakeContext(content)
+        with pytest.raises(MissingCampaign) as error:
+            await command.callback(ctx)
+        await dnd_bot.on_command_error(ctx, error.value)
+        assert ctx.sent == ['No campaign exists in this channel.']
+        assert not ours.held
+        await ours.close()
+        await theirs.close()
+
+    asyncio.run(run())
@@ -0,0 +1,156 @@
+import os
+
+import pytest
+
+import dnd_bot
+from dnd_bot import (CAMPAIGN_MAGIC, CHECKPOINT_ROWS, FORMAT_HEADER,
+                     BinaryReader, Campaign, FileBackend, SQLiteBackend,
+                     decode_campaign, decode_checkpoints, encode_campaign,
+                     encode_checkpoints)
+
+
+def record_batch(campaign, start, count):
+    #Adds count transactions between the two players, approving every
+    #other one.
+    for number in range(start, start + count):
+        campaign.record(('transact', 10, 'give', (number, 0, 1, 0), 11,
+                         'batch {0}'.format(number), campaign.next_transaction))
+        if number % 2:
+            ids = tuple(campaign.pending.ids_at(range(2)))
+            campaign.record(('approve_ids', ids, 1700000000.0 + number))
+
+
+def new_campaign():
+    campaign = Campaign(1, 100)
+    campaign.record(('register', 10, 'Alice'))
+    campaign.record(('register', 11, 'Bob'))
+    record_batch(campaign, 0, 5)
+    return campaign
+
+
+def state(campaign):
+    return (campaign.id, campaign.VERSION, campaign.revision,
+            campaign.next_transaction, list(campaign.gms),
+            {id: (player.name, tuple(player.coins))
+             for id, player in campaign.players.items()},
+            [(transaction.id, transaction.row)
+             for transaction in campaign.pending],
+            list(campaign.archive.rows()), list(campaign.archive.checkpoints))
+
+
+def save(backend, campaign):
+    entries, campaign.journal = campaign.journal, []
+    return backend.save(campaign, entries)
+
+
+def make_backend(kind, path):
+    if kind == 'file':
+        return FileBackend(str(path))
+    return SQLiteBackend(str(path/'campaigns.db'))
+
+
+@pytest.mark.parametrize('compression', [0, 1])
+def test_campaign_round_trip(compression):
+    campaign = new_campaign()
+    decoded = decode_campaign(encode_campaign(campaign, compression))
+    assert state(decoded) == state(campaign)
+
+
+@pytest.mark.parametrize('kind', ['file', 'sqlite'])
+def test_backend_round_trip(kind, tmp_path):
+    campaign = new_campaign()
+    save(make_backend(kind, tmp_path), campaign)
+    record_batch(campaign, 5, 4)
+    save(make_backend(kind, tmp_path), campaign)
+
+    stored, _size = make_backend(kind, tmp_path).read(1)
+    assert state(stored) == state(campaign)
+
+
+def test_torn_journal_record_is_discarded(tmp_path):
+    backend = FileBackend(str(tmp_path))
+    campaign = new_campaign()
+    save(backend, campaign)
+    record_batch(campaign, 5, 2)
+    save(backend, campaign)
+    expected = state(campaign)
+    path = tmp_path/'1.journal'
+    size = path.stat().st_size
+    record_batch(campaign, 8, 1)
+    assert len(campaign.journal) == 1
+    save(backend, campaign)
+    with open(path, 'rb+') as file:
+        file.truncate(path.stat().st_size - 3)
+
+    stored, stored_size = FileBackend(str(tmp_path)).read(1)
+    assert state(stored) == expected
+    assert path.stat().st_size == size
+    assert stored_size == (tmp_path/'1').stat().st_size + size
+
+    #Appending after the truncation leaves a journal that replays cleanly.
+    record_batch(stored, 9, 2)
+    save(backend, stored)
+    reread, _size = FileBackend(str(tmp_path)).read(1)
+    assert state(reread) == state(stored)
+
+
+def test_journal_compaction(monkeypatch, tmp_path):
+    monkeypatch.setattr(dnd_bot, 'JOURNAL_LIMIT', 4)
+    backend = FileBackend(str(tmp_path))
+    campaign = new_campaign()
+    assert save(backend, campaign)[1]
+    record_batch(campaign, 5, 2)
+    assert not save(backend, campaign)[1]
+    assert os.path.exists(tmp_path/'1.journal')
+    snapshot = (tmp_path/'1').read_bytes()
+
+    record_batch(campaign, 7, 2)
+    size, rewritten = save(backend, campaign)
+    assert rewritten
+    assert not os.path.exists(tmp_path/'1.journal')
+    assert backend.journal_sizes[1] == 0
+    data = (tmp_path/'1').read_bytes()
+    assert data != snapshot and size == len(data)
+    assert state(decode_campaign(data)) == state(campaign)
+
+
+@pytest.mark.parametrize('checkpoints', [
+    [],
+    [(None, {10: 5, 11: -5}), (1700000000.5, {10: 7, 12: 0}),
+     (1700000100.0, {})]])
+def test_checkpoint_round_trip(checkpoints):
+    out = []
+    encode_checkpoints(checkpoints, out)
+    reader = BinaryReader(b''.join(out))
+    assert decode_checkpoints(reader) == checkpoints
+    assert reader.offset == len(reader.data)
+
+
+@pytest.mark.parametrize('kind', ['file', 'sqlite'])
+def test_checkpoints_are_stored(kind, tmp_path):
+    campaign = new_campaign()
+    record_batch(campaign, 5, 2*CHECKPOINT_ROWS + 10)
+    assert len(campaign.archive.checkpoints) == 2
+    decoded = decode_campaign(encode_campaign(campaign))
+    assert decoded.archive.checkpoints == campaign.archive.checkpoints
+
+    save(make_backend(kind, tmp_path), campaign)
+    stored, _size = make_backend(kind, tmp_path).read(1)
+    assert stored.archive.checkpoints == campaign.archive.checkpoints
+
+
+def test_version_1_campaign_has_no_checkpoints():
+    #Version 1 snapshots end where the checkpoint count now starts.
+    campaign = new_campaign()
+    record_batch(campaign, 5, CHECKPOINT_ROWS + 10)
+    campaign.archive.checkpoints = []
+    data = encode_campaign(campaign, 0)
+    assert data.endswith(bytes(4))
+    data = FORMAT_HEADER.pack(CAMPAIGN_MAGIC, 1, 0) + \
+        data[FORMAT_HEADER.size:-4]
+
+    decoded = decode_campaign(data)
+    assert decoded.archive.checkpoints == []
+    assert decoded.archive.balances_at(len(decoded.archive)) == \
+        campaign.audit_balances()
+    assert len(decoded.archive.checkpoints) == 1